@@ -0,0 +1,274 @@
+"""
+Admission control for LLM calls.
+
+Every Gemini call goes through ``controller.admit(prompt_type, patient_id)``.
+Calls wait in per-priority queues for one of ``CAREBEARS_LLM_CONCURRENCY``
+slots. Higher priorities are always dispatched first, and the last
+``CAREBEARS_LLM_RESERVED_SLOTS`` slots are kept for critical work, so symptom
+checks still start promptly when bulk work has filled everything else.
+Within a priority, patients take turns, so one patient's burst can't starve
+the others.
+
+Work is shed instead of queueing without bound:
+
+* 429 when a patient already has ``CAREBEARS_LLM_PER_PATIENT`` calls
+  queued or running
+* 503 when the priority's queue is full or a call waits longer than
+  ``CAREBEARS_LLM_MAX_WAIT_SECONDS``
+
+Both carry a ``Retry-After`` estimated from the queue depth and recent call
+durations. Limits apply per worker process.
+
+Routes that call the model from a worker thread acquire the slot first with
+``async with controller.admit_async(...)``, so queued calls wait on the event
+loop instead of each holding one of the threadpool's threads. ``admit`` in
+the worker thread then uses the slot that was already granted.
+"""
+import asyncio
+import contextvars
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+
+import logfire
+
+CRITICAL, INTERACTIVE, BULK, BACKGROUND = range(4)
+PRIORITY_NAMES = {CRITICAL: "critical", INTERACTIVE: "interactive", BULK: "bulk", BACKGROUND: "background"}
+
+PROMPT_PRIORITIES = {
+    "symptom_check": CRITICAL,
+    "base": INTERACTIVE,
+    "medication_reminder": INTERACTIVE,
+    "appointment_preparation": INTERACTIVE,
+    "find_care_groups": BULK,
+    "patient_extraction": BACKGROUND,
+}
+
+MAX_CONCURRENCY = int(os.getenv("CAREBEARS_LLM_CONCURRENCY", "8"))
+RESERVED_SLOTS = int(os.getenv("CAREBEARS_LLM_RESERVED_SLOTS", "2"))
+PER_PATIENT_LIMIT = int(os.getenv("CAREBEARS_LLM_PER_PATIENT", "2"))
+MAX_WAIT_SECONDS = float(os.getenv("CAREBEARS_LLM_MAX_WAIT_SECONDS", "30"))
+QUEUE_LIMITS = {CRITICAL: 64, INTERACTIVE: 32, BULK: 16, BACKGROUND: 8}
+
+_queue_wait = logfire.metric_histogram(
+    "llm_admission_queue_wait", unit="s", description="Time LLM calls wait for an admission slot"
+)
+_rejections = logfire.metric_counter(
+    "llm_admission_rejections", description="LLM calls shed by admission control"
+)
+
+class AdmissionRejected(Exception):
+    """An LLM call was shed; maps to an HTTP status with Retry-After"""
+
+    def __init__(self, status_code, retry_after, detail):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.detail = detail
+
+# Slot granted to ``admit_async``, carried into run_in_threadpool with the context
+_held_ticket = contextvars.ContextVar("admission_held_ticket", default=None)
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+class _Ticket:
+    __slots__ = ("priority", "patient_id", "granted", "enqueued_at", "waiter", "waited", "used")
+
+    def __init__(self, priority, patient_id, waiter=None):
+        self.priority = priority
+        self.patient_id = patient_id
+        self.granted = threading.Event()
+        self.enqueued_at = time.monotonic()
+        # (loop, future) completed when an async waiter is granted its slot
+        self.waiter = waiter
+        self.waited = 0.0
+        self.used = False
+
+class AdmissionController:
+    """Priority queues with fair per-patient dispatch and a global concurrency cap"""
+
+    def __init__(self, concurrency=MAX_CONCURRENCY, reserved=RESERVED_SLOTS, per_patient=PER_PATIENT_LIMIT,
+                 max_wait=MAX_WAIT_SECONDS, queue_limits=None):
+        self.concurrency = concurrency
+        self.reserved = min(reserved, concurrency - 1)
+        self.per_patient = per_patient
+        self.max_wait = max_wait
+        self.queue_limits = dict(queue_limits or QUEUE_LIMITS)
+        self._lock = threading.Lock()
+        # priority -> patient_id -> waiting tickets, in turn order
+        self._queues = {priority: OrderedDict() for priority in PRIORITY_NAMES}
+        self._depth = dict.fromkeys(PRIORITY_NAMES, 0)
+        self._patient_load = {}
+        self._running = 0
+        self._service_seconds = 5.0
+        self._waits = {priority: deque(maxlen=500) for priority in PRIORITY_NAMES}
+        self._rejected = dict.fromkeys(PRIORITY_NAMES, 0)
+
+    def _retry_after(self, priority):
+        ahead = sum(depth for p, depth in self._depth.items() if p <= priority) + self._running
+        return max(1, math.ceil(ahead / self.concurrency * self._service_seconds))
+
+    def _reject(self, ticket, status_code, detail):
+        self._rejected[ticket.priority] += 1
+        _rejections.add(1, {"priority": PRIORITY_NAMES[ticket.priority], "status": status_code})
+        return AdmissionRejected(status_code, self._retry_after(ticket.priority), detail)
+
+    def _dispatch(self):
+        """Grant free slots to waiting tickets; caller holds the lock"""
+        while self._running < self.concurrency:
+            for priority, patients in self._queues.items():
+                if not patients:
+                    continue
+                if priority != CRITICAL and self._running >= self.concurrency - self.reserved:
+                    return
+                patient_id, tickets = patients.popitem(last=False)
+                ticket = tickets.popleft()
+                if tickets:
+                    # The patient goes to the back of the line for their next call
+                    patients[patient_id] = tickets
+                self._depth[priority] -= 1
+                self._running += 1
+                ticket.granted.set()
+                if ticket.waiter:
+                    loop, future = ticket.waiter
+                    loop.call_soon_threadsafe(_resolve, future)
+                break
+            else:
+                return
+
+    def _remove(self, ticket):
+        tickets = self._queues[ticket.priority].get(ticket.patient_id)
+        if tickets and ticket in tickets:
+            tickets.remove(ticket)
+            if not tickets:
+                del self._queues[ticket.priority][ticket.patient_id]
+            self._depth[ticket.priority] -= 1
+
+    def _release_patient(self, patient_id):
+        self._patient_load[patient_id] -= 1
+        if not self._patient_load[patient_id]:
+            del self._patient_load[patient_id]
+
+    def _enqueue(self, prompt_type, patient_id, waiter=None):
+        """Queue a ticket, or shed it with AdmissionRejected"""
+        ticket = _Ticket(PROMPT_PRIORITIES.get(prompt_type, INTERACTIVE), patient_id, waiter)
+        with self._lock:
+            if patient_id is not None and self._patient_load.get(patient_id, 0) >= self.per_patient:
+                raise self._reject(ticket, 429, f"Too many requests in progress for patient {patient_id}")
+            if self._depth[ticket.priority] >= self.queue_limits[ticket.priority]:
+                raise self._reject(ticket, 503, f"{PRIORITY_NAMES[ticket.priority].capitalize()} queue is full")
+            self._patient_load[patient_id] = self._patient_load.get(patient_id, 0) + 1
+            self._queues[ticket.priority].setdefault(patient_id, deque()).append(ticket)
+            self._depth[ticket.priority] += 1
+            self._dispatch()
+        return ticket
+
+    def _withdraw(self, ticket):
+        """Take a waiting ticket out of its queue; False if it was granted meanwhile"""
+        with self._lock:
+            if ticket.granted.is_set():
+                return False
+            self._remove(ticket)
+            self._release_patient(ticket.patient_id)
+            return True
+
+    def _timed_out(self, ticket):
+        with self._lock:
+            return self._reject(ticket, 503, "Timed out waiting for model capacity")
+
+    def _start(self, ticket, prompt_type):
+        started = time.monotonic()
+        ticket.waited = started - ticket.enqueued_at
+        self._waits[ticket.priority].append(ticket.waited)
+        _queue_wait.record(ticket.waited, {"priority": PRIORITY_NAMES[ticket.priority], "prompt_type": prompt_type})
+        return started
+
+    def _finish(self, ticket, started=None):
+        with self._lock:
+            self._running -= 1
+            self._release_patient(ticket.patient_id)
+            if started is not None:
+                # Smoothed call duration for Retry-After estimates
+                self._service_seconds += 0.2 * (time.monotonic() - started - self._service_seconds)
+            self._dispatch()
+
+    @contextmanager
+    def admit(self, prompt_type, patient_id=None):
+        """
+        Hold an LLM slot for the duration of the block
+
+        Inside ``admit_async`` the slot it was granted is used instead.
+
+        Raises:
+            AdmissionRejected: if the call is shed instead of queued
+        """
+        held = _held_ticket.get()
+        if held is not None and not held.used and held.patient_id == patient_id:
+            held.used = True
+            yield held.waited
+            return
+
+        ticket = self._enqueue(prompt_type, patient_id)
+        if not ticket.granted.wait(self.max_wait) and self._withdraw(ticket):
+            raise self._timed_out(ticket)
+
+        started = self._start(ticket, prompt_type)
+        try:
+            yield ticket.waited
+        finally:
+            self._finish(ticket, started)
+
+    @asynccontextmanager
+    async def admit_async(self, prompt_type, patient_id=None):
+        """
+        Hold an LLM slot for the block, waiting for it on the event loop
+
+        For routes that run the model call in a worker thread: the thread is
+        only taken once the slot is granted, and ``admit`` inside it uses
+        this slot.
+
+        Raises:
+            AdmissionRejected: if the call is shed instead of queued
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        ticket = self._enqueue(prompt_type, patient_id, waiter=(loop, future))
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.max_wait)
+        except asyncio.TimeoutError:
+            if self._withdraw(ticket):
+                raise self._timed_out(ticket)
+        except asyncio.CancelledError:
+            # The client went away; give back the place in line or the slot
+            if not self._withdraw(ticket):
+                self._finish(ticket)
+            raise
+
+        started = self._start(ticket, prompt_type)
+        token = _held_ticket.set(ticket)
+        try:
+            yield ticket.waited
+        finally:
+            _held_ticket.reset(token)
+            self._finish(ticket, started)
+
+    def stats(self):
+        """Current queue depths, recent wait percentiles and rejection counts"""
+        with self._lock:
+            result = {"running": self._running, "concurrency": self.concurrency, "priorities": {}}
+            for priority, name in PRIORITY_NAMES.items():
+                waits = sorted(self._waits[priority])
+                result["priorities"][name] = {
+                    "queued": self._depth[priority],
+                    "rejected": self._rejected[priority],
+                    "wait_p50": round(waits[len(waits) // 2], 3) if waits else None,
+                    "wait_p95": round(waits[int(len(waits) * 0.95)], 3) if waits else None,
+                }
+            return result
+
+controller = AdmissionController()
@@ -0,0 +1,473 @@
+"""
+Appointment calendar with interval queries, conflict detection and reminders.
+
+Appointments are stored per shard as epoch-second intervals. Triggers keep an
+R*Tree (``appointment_intervals``) in sync with the table, so "everything
+overlapping the next 7 days" is an index lookup whatever the appointment
+lengths are. R*Tree coordinates are 32-bit floats rounded outwards, so
+candidate rows are re-checked against the exact columns. For a handful of
+patients their (patient_id, starts_at) index is cheaper, so range queries
+only start from the R*Tree for larger patient sets.
+
+Conflicts are found with a sweep over the intervals sorted by start time:
+the same patient booked with two providers at once, or, on a caregiver's
+calendar, two patients who both need the caregiver at the same time.
+
+Reminders are sent by ``ReminderScheduler``. It keeps a min-heap of the
+reminders due within the next ``CAREBEARS_REMINDER_HORIZON_SECONDS``, loaded
+from a partial index of unsent reminders, so checking whether anything is due
+is a peek at the top of the heap however many appointments there are. Due
+reminders are claimed in batches with a conditional UPDATE that sets
+``claimed_at``, so several workers can run a scheduler without sending a
+reminder twice, and ``reminded_at`` is set only once delivery succeeded.
+Failed deliveries go back on the heap with exponential backoff. A claim older
+than ``CAREBEARS_REMINDER_CLAIM_TIMEOUT_SECONDS`` that was never delivered
+(the worker crashed) can be claimed again, so reminders are sent at least once.
+
+Only one worker per host runs the scheduler: ``start`` waits for an exclusive
+lock on ``data/reminder-scheduler.lock``, and another worker takes over when
+the holder exits. Claims and deliveries don't bump the patient version.
+"""
+import fcntl
+import heapq
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from database import (
+    DB_DIR, allocate_row_ids, all_shards, get_db_connection, get_directory_connection, patient_write_connection, shard_for_patient
+)
+
+logger = logging.getLogger(__name__)
+
+REMINDER_LEAD_HOURS = float(os.getenv("CAREBEARS_REMINDER_LEAD_HOURS", "24"))
+REMINDER_HORIZON_SECONDS = int(os.getenv("CAREBEARS_REMINDER_HORIZON_SECONDS", "3600"))
+REMINDER_BATCH_SIZE = int(os.getenv("CAREBEARS_REMINDER_BATCH_SIZE", "500"))
+REMINDER_CLAIM_TIMEOUT_SECONDS = int(os.getenv("CAREBEARS_REMINDER_CLAIM_TIMEOUT_SECONDS", "300"))
+REMINDER_RETRY_SECONDS = int(os.getenv("CAREBEARS_REMINDER_RETRY_SECONDS", "30"))
+REMINDER_LOCK_PATH = DB_DIR / "reminder-scheduler.lock"
+# How often a worker without the scheduler lock tries to take it over
+REMINDER_LOCK_RETRY_SECONDS = 30
+PROMPT_APPOINTMENTS = 5
+# Patients per shard from which range queries start from the R*Tree
+RTREE_MIN_PATIENTS = 50
+
+APPOINTMENT_COLUMNS = (
+    "id", "patient_id", "provider", "location", "purpose", "starts_at", "ends_at",
+    "status", "remind_at", "reminded_at",
+)
+_TIME_COLUMNS = ("starts_at", "ends_at", "remind_at", "reminded_at")
+
+def _epoch(value) -> int:
+    """Epoch seconds for a datetime (naive means UTC), ISO string or number"""
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return int(value.timestamp())
+
+def _iso(seconds) -> Optional[str]:
+    if seconds is None:
+        return None
+    return datetime.fromtimestamp(seconds, tz=timezone.utc).isoformat()
+
+def _to_dict(row) -> Dict[str, Any]:
+    appointment = {column: row[column] for column in APPOINTMENT_COLUMNS}
+    for column in _TIME_COLUMNS:
+        appointment[column] = _iso(appointment[column])
+    return appointment
+
+def _remind_at(starts_at: int, remind_before_minutes: Optional[int], now: int) -> Optional[int]:
+    if starts_at <= now:
+        return None
+    lead = REMINDER_LEAD_HOURS * 3600 if remind_before_minutes is None else remind_before_minutes * 60
+    # Appointments booked inside the lead time are reminded straight away
+    return max(int(starts_at - lead), now)
+
+# --- Calendar ---
+
+def add_appointment(patient_id: int, provider: str, starts_at, ends_at, location: Optional[str] = None,
+                    purpose: Optional[str] = None, remind_before_minutes: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Book an appointment and queue its reminder
+
+    Raises:
+        ValueError: if the appointment doesn't end after it starts
+    """
+    starts, ends = _epoch(starts_at), _epoch(ends_at)
+    if ends <= starts:
+        raise ValueError("Appointment must end after it starts")
+    remind_at = _remind_at(starts, remind_before_minutes, int(time.time()))
+    with patient_write_connection(patient_id) as conn:
+        row = conn.execute(
+            f'''
+            INSERT INTO appointments (id, patient_id, provider, location, purpose, starts_at, ends_at, remind_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            RETURNING {", ".join(APPOINTMENT_COLUMNS)}
+            ''',
+            (allocate_row_ids("appointments"), patient_id, provider, location, purpose, starts, ends, remind_at)
+        ).fetchone()
+        conn.commit()
+    scheduler.schedule(patient_id, row["id"], remind_at)
+    return _to_dict(row)
+
+def cancel_appointment(patient_id: int, appointment_id: int) -> bool:
+    """Cancel a scheduled appointment; its pending reminder is dropped"""
+    with patient_write_connection(patient_id) as conn:
+        cursor = conn.execute(
+            "UPDATE appointments SET status = 'cancelled' WHERE id = ? AND patient_id = ? AND status = 'scheduled'",
+            (appointment_id, patient_id)
+        )
+        conn.commit()
+        return cursor.rowcount > 0
+
+def reschedule_appointment(patient_id: int, appointment_id: int, starts_at, ends_at,
+                           remind_before_minutes: Optional[int] = None) -> Optional[Dict[str, Any]]:
+    """Move a scheduled appointment; the reminder is re-armed for the new time"""
+    starts, ends = _epoch(starts_at), _epoch(ends_at)
+    if ends <= starts:
+        raise ValueError("Appointment must end after it starts")
+    remind_at = _remind_at(starts, remind_before_minutes, int(time.time()))
+    with patient_write_connection(patient_id) as conn:
+        row = conn.execute(
+            f'''
+            UPDATE appointments SET starts_at = ?, ends_at = ?, remind_at = ?, reminded_at = NULL, claimed_at = NULL
+            WHERE id = ? AND patient_id = ? AND status = 'scheduled'
+            RETURNING {", ".join(APPOINTMENT_COLUMNS)}
+            ''',
+            (starts, ends, remind_at, appointment_id, patient_id)
+        ).fetchone()
+        conn.commit()
+    if row is None:
+        return None
+    scheduler.schedule(patient_id, appointment_id, remind_at)
+    return _to_dict(row)
+
+def get_appointments(patient_ids: Iterable[int], start, end, include_cancelled: bool = False) -> List[Dict[str, Any]]:
+    """
+    Appointments overlapping [start, end) for any of the patients, by start time
+
+    Patients are grouped by shard so each shard is queried once.
+    """
+    start, end = _epoch(start), _epoch(end)
+    by_shard = {}
+    for patient_id in set(patient_ids):
+        by_shard.setdefault(shard_for_patient(patient_id), []).append(patient_id)
+
+    status_filter = "" if include_cancelled else "AND a.status != 'cancelled'"
+    result = []
+    for shard, ids in by_shard.items():
+        if len(ids) >= RTREE_MIN_PATIENTS:
+            # CROSS JOIN keeps the R*Tree as the outer loop; left to itself the
+            # planner walks every patient's history through the B-tree index
+            source = "appointment_intervals r CROSS JOIN appointments a ON a.id = r.id"
+            bounds = "r.starts_at < ? AND r.ends_at > ? AND"
+            params = (end, start, end, start, *ids)
+        else:
+            source, bounds, params = "appointments a", "", (end, start, *ids)
+        with get_db_connection(shard) as conn:
+            rows = conn.execute(
+                f'''
+                SELECT {", ".join(f"a.{column}" for column in APPOINTMENT_COLUMNS)}
+                FROM {source}
+                WHERE {bounds} a.starts_at < ? AND a.ends_at > ?
+                  AND a.patient_id IN ({", ".join("?" for _ in ids)})
+                  {status_filter}
+                ''',
+                params
+            ).fetchall()
+        result.extend(_to_dict(row) for row in rows)
+    result.sort(key=lambda appointment: (appointment["starts_at"], appointment["id"]))
+    return result
+
+def get_upcoming_appointments(patient_id: int, days: int = 30, limit: int = PROMPT_APPOINTMENTS) -> List[Dict[str, Any]]:
+    """The patient's next scheduled appointments"""
+    now = int(time.time())
+    return get_appointments([patient_id], now, now + days * 86400)[:limit]
+
+def get_caregiver_patient_ids(caregiver_id: int) -> List[int]:
+    """Ids of the patients on a caregiver's dashboard"""
+    with get_directory_connection() as conn:
+        rows = conn.execute(
+            'SELECT patient_id FROM caregiver_patients WHERE caregiver_id = ?', (caregiver_id,)
+        ).fetchall()
+    return [row["patient_id"] for row in rows]
+
+# --- Conflicts ---
+
+def find_conflicts(appointments: List[Dict[str, Any]], across_patients: bool = False) -> List[Dict[str, Any]]:
+    """
+    Overlapping pairs of appointments, found with a sweep over start times
+
+    Within a patient, any overlap is a conflict (two providers at once, or the
+    same provider booked twice). With ``across_patients`` overlaps between
+    different patients are reported too, for a caregiver who has to attend
+    both.
+    """
+    intervals = sorted(
+        ((_epoch(a["starts_at"]), _epoch(a["ends_at"]), a) for a in appointments if a["status"] != "cancelled"),
+        key=lambda interval: (interval[0], interval[1])
+    )
+    conflicts = []
+    active = []  # min-heap of (ends_at, index) for intervals still open
+    for index, (starts, ends, appointment) in enumerate(intervals):
+        while active and active[0][0] <= starts:
+            heapq.heappop(active)
+        for other_ends, other_index in active:
+            other = intervals[other_index][2]
+            same_patient = other["patient_id"] == appointment["patient_id"]
+            if not same_patient and not across_patients:
+                continue
+            conflicts.append({
+                "kind": "patient_double_booked" if same_patient else "caregiver_overlap",
+                # Appointment ids are per shard, so both halves carry the patient
+                "appointments": [
+                    {"patient_id": a["patient_id"], "appointment_id": a["id"], "provider": a["provider"]}
+                    for a in (other, appointment)
+                ],
+                "overlap_minutes": (min(ends, other_ends) - starts) // 60,
+            })
+        heapq.heappush(active, (ends, index))
+    return conflicts
+
+def check_appointment_conflicts(appointment: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Conflicts between an appointment and the rest of its patient's calendar"""
+    overlapping = get_appointments([appointment["patient_id"]], appointment["starts_at"], appointment["ends_at"])
+    return [
+        conflict for conflict in find_conflicts(overlapping)
+        if appointment["id"] in [entry["appointment_id"] for entry in conflict["appointments"]]
+    ]
+
+def get_caregiver_calendar(caregiver_id: int, days: int = 7) -> Dict[str, Any]:
+    """The next ``days`` of appointments for all of a caregiver's patients, with conflicts"""
+    now = int(time.time())
+    appointments = get_appointments(get_caregiver_patient_ids(caregiver_id), now, now + days * 86400)
+    return {"appointments": appointments, "conflicts": find_conflicts(appointments, across_patients=True)}
+
+# --- Reminders ---
+
+def log_reminders(reminders: List[Dict[str, Any]]):
+    """Default delivery: write each reminder to the log"""
+    for reminder in reminders:
+        logger.info(
+            f"Reminder for patient {reminder['patient_id']}: {reminder['provider']} at {reminder['starts_at']}"
+            + (f" ({reminder['purpose']})" if reminder["purpose"] else "")
+        )
+
+class ReminderScheduler:
+    """Min-heap of upcoming reminders, refilled from the database one horizon at a time"""
+
+    def __init__(self, deliver: Callable[[List[Dict[str, Any]]], None] = log_reminders,
+                 horizon: int = REMINDER_HORIZON_SECONDS, batch_size: int = REMINDER_BATCH_SIZE,
+                 claim_timeout: int = REMINDER_CLAIM_TIMEOUT_SECONDS, retry_seconds: int = REMINDER_RETRY_SECONDS):
+        self.deliver = deliver
+        self.horizon = horizon
+        self.batch_size = batch_size
+        self.claim_timeout = claim_timeout
+        self.retry_seconds = retry_seconds
+        self._lock = threading.Lock()
+        self._heap = []  # (due_at, patient_id, appointment_id)
+        self._queued = set()
+        self._attempts = {}  # (patient_id, appointment_id) -> failed deliveries
+        self._loaded_until = 0
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock_file = None
+
+    def _push(self, entry):
+        if entry not in self._queued:
+            self._queued.add(entry)
+            heapq.heappush(self._heap, entry)
+
+    def schedule(self, patient_id: int, appointment_id: int, remind_at: Optional[int]):
+        """Queue a reminder now if it falls inside the loaded horizon, otherwise the next refill finds it"""
+        if remind_at is None:
+            return
+        with self._lock:
+            if remind_at > self._loaded_until:
+                return
+            self._push((remind_at, patient_id, appointment_id))
+        self._wake.set()
+
+    def refill(self, now: Optional[int] = None) -> int:
+        """
+        Load every unsent reminder due before ``now + horizon``
+
+        Reminders claimed but never delivered are queued for when their
+        claim expires, so a restarted worker resends them.
+        """
+        now = int(now if now is not None else time.time())
+        until = now + self.horizon
+        # Raise the horizon first so appointments booked during the scan
+        # are pushed by schedule(); duplicates are dropped by _push
+        with self._lock:
+            self._loaded_until = max(self._loaded_until, until)
+        loaded = 0
+        for shard in all_shards():
+            with get_db_connection(shard) as conn:
+                rows = conn.execute(
+                    '''
+                    SELECT id, patient_id, remind_at, claimed_at FROM appointments
+                    WHERE reminded_at IS NULL AND status = 'scheduled' AND remind_at <= ?
+                    ''',
+                    (until,)
+                ).fetchall()
+            with self._lock:
+                for row in rows:
+                    due_at = row["remind_at"]
+                    if row["claimed_at"] is not None:
+                        due_at = max(due_at, row["claimed_at"] + self.claim_timeout)
+                    self._push((due_at, row["patient_id"], row["id"]))
+            loaded += len(rows)
+        return loaded
+
+    def next_due(self) -> Optional[int]:
+        """When the earliest queued reminder is due"""
+        with self._lock:
+            return self._heap[0][0] if self._heap else None
+
+    def _pop_due(self, now):
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                entry = heapq.heappop(self._heap)
+                self._queued.discard(entry)
+                due.append(entry)
+        return due
+
+    def _claim(self, shard, entries, now):
+        """
+        Claim reminders for delivery and return their appointments
+
+        Entries that are stale, already sent or claimed by a live worker
+        match nothing.
+        """
+        with get_db_connection(shard) as conn:
+            rows = conn.execute(
+                f'''
+                UPDATE appointments SET claimed_at = ?
+                WHERE (id, patient_id) IN (VALUES {", ".join("(?, ?)" for _ in entries)})
+                  AND reminded_at IS NULL AND status = 'scheduled' AND remind_at <= ?
+                  AND (claimed_at IS NULL OR claimed_at <= ?)
+                RETURNING {", ".join(APPOINTMENT_COLUMNS)}
+                ''',
+                (now, *[value for _, patient_id, appointment_id in entries for value in (appointment_id, patient_id)],
+                 now, now - self.claim_timeout)
+            ).fetchall()
+            conn.commit()
+        return [_to_dict(row) for row in rows]
+
+    def _settle(self, shard, reminders, delivered_at):
+        """Record delivered reminders, or release the claims on undelivered ones"""
+        with get_db_connection(shard) as conn:
+            if delivered_at is None:
+                conn.executemany(
+                    'UPDATE appointments SET claimed_at = NULL WHERE id = ? AND patient_id = ? AND reminded_at IS NULL',
+                    [(reminder["id"], reminder["patient_id"]) for reminder in reminders]
+                )
+            else:
+                conn.executemany(
+                    'UPDATE appointments SET reminded_at = ? WHERE id = ? AND patient_id = ?',
+                    [(delivered_at, reminder["id"], reminder["patient_id"]) for reminder in reminders]
+                )
+            conn.commit()
+
+    def _retry_later(self, reminders, now):
+        """Re-queue reminders whose delivery failed, backing off exponentially"""
+        with self._lock:
+            for reminder in reminders:
+                key = (reminder["patient_id"], reminder["id"])
+                attempts = self._attempts.get(key, 0)
+                self._attempts[key] = attempts + 1
+                self._push((now + min(self.retry_seconds * 2 ** attempts, self.horizon), *key))
+        self._wake.set()
+
+    def run_due(self, now: Optional[int] = None) -> int:
+        """
+        Send every reminder that is due, in batches per shard
+
+        Returns:
+            Number of reminders delivered
+        """
+        now = int(now if now is not None else time.time())
+        if now + self.horizon // 2 >= self._loaded_until:
+            self.refill(now)
+        by_shard = {}
+        for entry in self._pop_due(now):
+            by_shard.setdefault(shard_for_patient(entry[1]), []).append(entry)
+
+        sent = 0
+        for shard, entries in by_shard.items():
+            for i in range(0, len(entries), self.batch_size):
+                reminders = self._claim(shard, entries[i:i + self.batch_size], now)
+                if not reminders:
+                    continue
+                try:
+                    self.deliver(reminders)
+                except Exception:
+                    logger.exception(f"Delivering {len(reminders)} reminders failed")
+                    self._settle(shard, reminders, None)
+                    self._retry_later(reminders, now)
+                    continue
+                self._settle(shard, reminders, now)
+                with self._lock:
+                    for reminder in reminders:
+                        self._attempts.pop((reminder["patient_id"], reminder["id"]), None)
+                sent += len(reminders)
+        if sent:
+            logger.info(f"Sent {sent} appointment reminders")
+        return sent
+
+    def _acquire_sender_lock(self):
+        """Wait until this process holds the scheduler lock; False if stopped first"""
+        self._lock_file = open(REMINDER_LOCK_PATH, "a")
+        while not self._stop.is_set():
+            try:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                logger.info("This worker sends appointment reminders")
+                return True
+            except BlockingIOError:
+                self._stop.wait(REMINDER_LOCK_RETRY_SECONDS)
+        return False
+
+    def _run(self):
+        if not self._acquire_sender_lock():
+            return
+        while not self._stop.is_set():
+            self._wake.clear()
+            try:
+                self.run_due()
+            except Exception:
+                logger.exception("Reminder sweep failed")
+            next_due = self.next_due()
+            now = time.time()
+            wait = self._loaded_until - self.horizon / 2 - now
+            if next_due is not None:
+                wait = min(wait, next_due - now)
+            self._wake.wait(max(wait, 0.5))
+
+    def start(self):
+        """Run the scheduler on a daemon thread once this process holds the scheduler lock"""
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="reminder-scheduler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._wake.set()
+            self._thread.join()
+            self._thread = None
+        if self._lock_file is not None:
+            # Closing the file releases the lock for another worker
+            self._lock_file.close()
+            self._lock_file = None
+
+scheduler = ReminderScheduler()
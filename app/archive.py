@@ -0,0 +1,180 @@
+"""
+Tiered retention for the interactions table.
+
+Interactions older than the retention window are copied into per-patient,
+append-only archive segments under ``data/archive/patient_<id>/``. Each
+archival batch appends one gzip member of NDJSON rows to the patient's
+current segment, so a segment is a valid multi-member ``.ndjson.gz`` file and
+any single batch can be read back by seeking to its offset.
+
+The hot row keeps its id, prompt type, user input and timestamps plus a short
+response summary; the full response and context snapshots are dropped and
+``archive_ref`` records ``<segment>:<offset>:<length>``. Rows are hydrated
+from the archive when read through the interactions API.
+"""
+import json
+import logging
+import os
+import zlib
+from datetime import datetime, timezone
+from functools import lru_cache
+from pathlib import Path
+
+from database import (
+    DB_DIR, SUMMARY_CHARS, all_shards, get_db_connection, decompress_text, summarize_response, _load_json_column
+)
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_DIR = DB_DIR / "archive"
+RETENTION_DAYS = int(os.getenv("CAREBEARS_INTERACTION_RETENTION_DAYS", "180"))
+SEGMENT_MAX_BYTES = int(os.getenv("CAREBEARS_ARCHIVE_SEGMENT_BYTES", str(8 * 1024 * 1024)))
+
+def _current_segment(patient_dir):
+    """Return the segment to append to, rolling over when it gets too large"""
+    patient_dir.mkdir(parents=True, exist_ok=True)
+    segments = sorted(patient_dir.glob("*.ndjson.gz"))
+    if segments and segments[-1].stat().st_size < SEGMENT_MAX_BYTES:
+        return segments[-1]
+    number = int(segments[-1].name.split(".")[0]) + 1 if segments else 1
+    return patient_dir / f"{number:04d}.ndjson.gz"
+
+def _append_member(patient_id, rows):
+    """Append rows as one gzip member and return its archive ref"""
+    payload = "".join(json.dumps(row, default=str) + "\n" for row in rows).encode("utf-8")
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 31)
+    member = compressor.compress(payload) + compressor.flush()
+
+    segment = _current_segment(ARCHIVE_DIR / f"patient_{patient_id}")
+    with open(segment, "ab") as f:
+        offset = f.tell()
+        f.write(member)
+        f.flush()
+        os.fsync(f.fileno())
+    return f"{segment.relative_to(ARCHIVE_DIR).as_posix()}:{offset}:{len(member)}"
+
+@lru_cache(maxsize=256)
+def _read_member(ref):
+    """Read and index one archived batch by interaction id"""
+    path, offset, length = ref.rsplit(":", 2)
+    with open(ARCHIVE_DIR / path, "rb") as f:
+        f.seek(int(offset))
+        member = f.read(int(length))
+    rows = {}
+    for line in zlib.decompress(member, 31).decode("utf-8").splitlines():
+        row = json.loads(line)
+        rows[row["id"]] = row
+    return rows
+
+def load_archived_interaction(interaction_id, archive_ref):
+    """Return the full archived row for an interaction, or None if missing"""
+    try:
+        return _read_member(archive_ref).get(interaction_id)
+    except (OSError, ValueError, zlib.error) as e:
+        logger.error(f"Failed to read archived interaction {interaction_id} from {archive_ref}: {e}")
+        return None
+
+def hydrate_archived_interactions(interactions):
+    """Replace archived summaries with the full rows from the archive"""
+    result = []
+    for interaction in interactions:
+        if interaction.get("archive_ref"):
+            archived = load_archived_interaction(interaction["id"], interaction["archive_ref"])
+            if archived:
+                interaction = {
+                    **interaction,
+                    **{key: archived[key] for key in ("response", "context_before", "context_after") if key in interaction}
+                }
+        result.append(interaction)
+    return result
+
+def archive_old_interactions(retention_days=None, batch_size=200, max_batches=None, vacuum_pages=1000):
+    """
+    Move interactions older than the retention window into archive segments
+
+    Works in small batches so no write lock is held for long: each batch is
+    read, written and fsynced to the archive, then the hot rows are replaced
+    by summaries in one short transaction. A crash between the two steps only
+    leaves a duplicate copy in the archive, which readers ignore.
+
+    Args:
+        retention_days: Age in days after which interactions are archived
+        batch_size: Rows per batch
+        max_batches: Stop after this many batches (None runs to completion)
+        vacuum_pages: Free pages to release with incremental VACUUM per batch
+
+    Returns:
+        Dictionary with the number of archived rows and batches
+    """
+    retention_days = RETENTION_DAYS if retention_days is None else retention_days
+    archived = batches = 0
+    for shard in all_shards():
+        with get_db_connection(shard) as conn:
+            incremental = conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+            while max_batches is None or batches < max_batches:
+                rows = conn.execute(
+                    '''
+                    SELECT id, patient_id, prompt_type, user_input, response,
+                           context_before, context_after, created_at
+                    FROM interactions
+                    WHERE archived_at IS NULL AND created_at < datetime('now', ?)
+                    ORDER BY created_at
+                    LIMIT ?
+                    ''',
+                    (f"-{retention_days} days", batch_size)
+                ).fetchall()
+                if not rows:
+                    break
+
+                by_patient = {}
+                for row in rows:
+                    full = dict(row)
+                    full["response"] = decompress_text(full["response"])
+                    full["context_before"] = _load_json_column(full["context_before"])
+                    full["context_after"] = _load_json_column(full["context_after"])
+                    by_patient.setdefault(full["patient_id"], []).append(full)
+
+                archived_at = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+                updates = []
+                for patient_id, patient_rows in by_patient.items():
+                    ref = _append_member(patient_id, patient_rows)
+                    updates.extend(
+                        (summarize_response(row["response"]), archived_at, ref, row["id"])
+                        for row in patient_rows
+                    )
+
+                conn.executemany(
+                    '''
+                    UPDATE interactions
+                    SET response = ?, context_before = NULL, context_after = NULL,
+                        archived_at = ?, archive_ref = ?
+                    WHERE id = ? AND archived_at IS NULL
+                    ''',
+                    updates
+                )
+                conn.commit()
+                if incremental and vacuum_pages:
+                    conn.execute(f'PRAGMA incremental_vacuum({int(vacuum_pages)})')
+                    conn.commit()
+
+                archived += len(updates)
+                batches += 1
+    logger.info(f"Archived {archived} interactions in {batches} batches")
+    return {"archived": archived, "batches": batches}
+
+def enable_incremental_vacuum():
+    """
+    Switch existing shard databases to incremental auto-vacuum
+
+    This needs one full VACUUM, which holds an exclusive lock for its
+    duration, so run it during a maintenance window.
+    """
+    converted = False
+    for shard in all_shards():
+        with get_db_connection(shard) as conn:
+            if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+                continue
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.execute('VACUUM')
+            converted = True
+    return converted
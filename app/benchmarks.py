@@ -0,0 +1,444 @@
+"""
+Micro-benchmarks for CareBears storage and request paths.
+
+Run from the app directory, e.g.:
+    python benchmarks.py compression --patients 50 --interactions 40
+    python benchmarks.py sharding --workers 8 --shards 1 4 8
+    python benchmarks.py serialization --context-kb 256
+    python benchmarks.py appointments --appointments 200000
+    python benchmarks.py export --patients 200 --interactions 100
+    python benchmarks.py telemetry --calls 20000
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import random
+import statistics
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import appointments
+import database
+import export
+import serialization
+from fastapi.encoders import jsonable_encoder
+from models import PatientResponse
+
+SAMPLE_RECORD = (Path(__file__).resolve().parent.parent / "testpatients" / "jane.txt")
+
+def _sample_response(rng, patient_name):
+    """Build a markdown response shaped like a typical Gemini answer"""
+    sections = []
+    for heading in rng.sample(
+        ["Medication Schedule", "Side Effects to Watch", "Questions for Your Doctor",
+         "Support Groups Near You", "When to Seek Care", "Next Steps"], 4
+    ):
+        items = "\n".join(
+            f"- **Step {i}**: {rng.choice(['Take', 'Ask about', 'Track', 'Schedule'])} "
+            f"{rng.choice(['tamoxifen', 'docetaxel', 'blood counts', 'your oncologist', 'hydration'])} "
+            f"{rng.choice(['daily', 'every 3 weeks', 'before your visit', 'if symptoms worsen'])}."
+            for i in range(rng.randint(3, 7))
+        )
+        sections.append(f"## {heading}\n\nHi {patient_name}, here is what to focus on.\n\n{items}")
+    return "\n\n".join(sections)
+
+def _sample_context(rng, raw_text):
+    return {
+        "source": "file_upload",
+        "raw_text": raw_text,
+        "zip_code": "94538",
+        "medications": ["Docetaxel 75 mg/m2 IV every 3 weeks", "Tamoxifen 20 mg PO daily"],
+        "notes": [f"note {rng.randint(0, 10_000)}" for _ in range(5)],
+    }
+
+def _populate(patients, interactions, seed):
+    rng = random.Random(seed)
+    raw_text = SAMPLE_RECORD.read_text(encoding="utf-8") if SAMPLE_RECORD.exists() else "Patient record\n" * 40
+    patient_ids = []
+    for i in range(patients):
+        context = _sample_context(rng, raw_text)
+        patient_ids.append(database.add_patient(
+            f"Patient {i}", "01/01/1980", "Fremont, CA 94538", "Breast cancer", "Missing labs", context
+        ))
+        for _ in range(interactions):
+            database.add_interaction(
+                patient_ids[-1], "medication_reminder", "What should I take today?",
+                _sample_response(rng, f"Patient {i}"), context, {**context, "last_prompt": "medication_reminder"}
+            )
+    return patient_ids
+
+def _time_reads(patient_ids, repeats, **kwargs):
+    samples = []
+    for _ in range(repeats):
+        for patient_id in patient_ids:
+            start = time.perf_counter()
+            database.get_patient_interactions(patient_id, limit=10, **kwargs)
+            samples.append(time.perf_counter() - start)
+    return samples
+
+def bench_compression(args):
+    """Compare DB size and read latency across compression codecs"""
+    codecs = ["none", "zlib"] + (["zstd"] if database.zstandard is not None else [])
+    print(f"{'codec':<8} {'db size':>12} {'read p50':>10} {'read p95':>10} {'p50 (no ctx)':>13}")
+    for codec in codecs:
+        with tempfile.TemporaryDirectory() as tmp:
+            database.DB_PATH = Path(tmp) / "bench.db"
+            database.COMPRESSION_CODEC = codec
+            database.init_db()
+            patient_ids = _populate(args.patients, args.interactions, args.seed)
+            with database.get_db_connection() as conn:
+                conn.execute("VACUUM")
+            size = database.DB_PATH.stat().st_size
+            full = sorted(_time_reads(patient_ids, args.repeats))
+            light = sorted(_time_reads(
+                patient_ids, args.repeats,
+                columns=("id", "prompt_type", "user_input", "response", "created_at")
+            ))
+            print(
+                f"{codec:<8} {size / 1024:>10.0f}KB "
+                f"{statistics.median(full) * 1000:>8.2f}ms "
+                f"{full[int(len(full) * 0.95)] * 1000:>8.2f}ms "
+                f"{statistics.median(light) * 1000:>11.2f}ms"
+            )
+
+def _write_interactions(task):
+    """Worker: write interactions for a slice of patients"""
+    db_path, shards, patient_ids, writes, seed = task
+    database.DB_PATH = db_path
+    database.SHARD_COUNT = shards
+    rng = random.Random(seed)
+    response = _sample_response(rng, "Patient")
+    for i in range(writes):
+        patient_id = patient_ids[i % len(patient_ids)]
+        database.add_interaction(
+            patient_id, "medication_reminder", "What should I take today?", response, {}, {"turn": i}
+        )
+    return writes
+
+def bench_sharding(args):
+    """Compare concurrent interaction write throughput across shard counts"""
+    print(f"{'shards':>6} {'workers':>8} {'writes':>8} {'seconds':>9} {'writes/s':>10}")
+    for shards in args.shards:
+        with tempfile.TemporaryDirectory() as tmp:
+            database.DB_PATH = Path(tmp) / "bench.db"
+            database.SHARD_COUNT = shards
+            database.init_db()
+            patient_ids = [
+                database.add_patient(f"Patient {i}", "01/01/1980", "Fremont, CA 94538", "Breast cancer")
+                for i in range(args.patients)
+            ]
+            # Each worker owns a slice of patients, like requests for different patients
+            tasks = [
+                (database.DB_PATH, shards, patient_ids[w::args.workers] or patient_ids, args.writes, args.seed + w)
+                for w in range(args.workers)
+            ]
+            with multiprocessing.Pool(args.workers) as pool:
+                start = time.perf_counter()
+                total = sum(pool.map(_write_interactions, tasks))
+                elapsed = time.perf_counter() - start
+            print(f"{shards:>6} {args.workers:>8} {total:>8} {elapsed:>9.2f} {total / elapsed:>10.0f}")
+
+def _large_context(rng, kilobytes):
+    """A context shaped like one that has accumulated many prompt turns"""
+    context = {"source": "file_upload", "zip_code": "94538", "notes": [], "medications": []}
+    while len(json.dumps(context)) < kilobytes * 1024:
+        context["notes"].append(f"Visit note {rng.randint(0, 10_000)}: " + _sample_response(rng, "Jane")[:400])
+        context["medications"].append({
+            "name": rng.choice(["tamoxifen", "docetaxel", "ondansetron"]),
+            "dose": f"{rng.randint(1, 100)} mg",
+            "schedule": "daily",
+            "side_effects_to_watch": ["nausea", "fatigue", "hot flashes"],
+        })
+    return context
+
+def _time_per_call(func, repeats):
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples)
+
+def bench_serialization(args):
+    """Compare the stdlib/validation path with orjson and JSON passthrough"""
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_PATH = Path(tmp) / "bench.db"
+        database.init_db()
+        context = _large_context(rng, args.context_kb)
+        patient_id = database.add_patient("Jane", "01/01/1980", "Fremont, CA 94538", "Breast cancer", None, context)
+        for _ in range(args.interactions):
+            database.add_interaction(patient_id, "base", "How am I doing?", _sample_response(rng, "Jane"), context, context)
+
+        def patient_stdlib():
+            # Parse the column, validate through the response model, encode again
+            row = database.get_patient(patient_id, raw_json=True)
+            row["context"] = json.loads(row["context"])
+            return PatientResponse.model_validate(row).model_dump_json()
+
+        def patient_construct():
+            row = database.get_patient(patient_id)
+            return serialization.dumps(serialization.construct_trusted(PatientResponse, row).model_dump(mode="json"))
+
+        def patient_passthrough():
+            row = database.get_patient(patient_id, raw_json=True)
+            fields = {key: row[key] for key in ("id", "name", "dob", "location", "diagnosis", "care_gaps", "created_at")}
+            return serialization.json_object(fields, raw={"context": row["context"]})
+
+        def interactions_stdlib():
+            rows = database.get_patient_interactions(patient_id, limit=10, raw_json=True)
+            for row in rows:
+                row["context_before"] = json.loads(row["context_before"])
+                row["context_after"] = json.loads(row["context_after"])
+            return json.dumps(jsonable_encoder({"interactions": rows})).encode("utf-8")
+
+        def interactions_orjson():
+            return serialization.dumps({"interactions": database.get_patient_interactions(patient_id, limit=10)})
+
+        def interactions_passthrough():
+            rows = database.get_patient_interactions(patient_id, limit=10, raw_json=True)
+            return serialization.json_object({}, raw={
+                "interactions": serialization.json_rows(rows, ("context_before", "context_after"))
+            })
+
+        size = len(patient_passthrough()) / 1024
+        print(f"context {size:.0f}KB, orjson {'available' if serialization.orjson else 'missing'}")
+        print(f"{'path':<28} {'p50':>10}")
+        for name, func in [
+            ("patient stdlib+validate", patient_stdlib),
+            ("patient construct+orjson", patient_construct),
+            ("patient passthrough", patient_passthrough),
+            ("interactions stdlib", interactions_stdlib),
+            ("interactions orjson", interactions_orjson),
+            ("interactions passthrough", interactions_passthrough),
+        ]:
+            print(f"{name:<28} {_time_per_call(func, args.repeats) * 1000:>8.2f}ms")
+
+def bench_appointments(args):
+    """Calendar range queries and reminder due checks over a large appointment table"""
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_PATH = Path(tmp) / "bench.db"
+        database.init_db()
+        patient_ids = [database.add_patient(f"Patient {i}", "01/01/1960", "94538", "CHF") for i in range(args.patients)]
+        now = int(time.time())
+        year = 365 * 86400
+        rows = []
+        for _ in range(args.appointments):
+            starts = now + rng.randrange(-year, year) // 900 * 900
+            ends = starts + rng.choice([15, 30, 60, 240]) * 60
+            rows.append((rng.choice(patient_ids), rng.choice(["Cardiology", "Oncology", "Labs", "PT"]),
+                         starts, ends, starts - 86400 if starts - 86400 > now else None))
+        started = time.perf_counter()
+        first_id = database.allocate_row_ids("appointments", len(rows))
+        with database.get_db_connection() as conn:
+            conn.executemany(
+                'INSERT INTO appointments (id, patient_id, provider, starts_at, ends_at, remind_at) VALUES (?, ?, ?, ?, ?, ?)',
+                [(first_id + i, *row) for i, row in enumerate(rows)]
+            )
+            conn.commit()
+        print(f"{args.appointments} appointments for {args.patients} patients, "
+              f"loaded in {time.perf_counter() - started:.1f}s")
+
+        week = (now, now + 7 * 86400)
+
+        def range_query(ids, source, bounds=""):
+            with database.get_db_connection() as conn:
+                return conn.execute(
+                    f'''
+                    SELECT a.* FROM {source}
+                    WHERE {bounds} a.starts_at < ? AND a.ends_at > ? AND a.patient_id IN ({", ".join("?" for _ in ids)})
+                    ''',
+                    (*((week[1], week[0]) if bounds else ()), week[1], week[0], *ids)
+                ).fetchall()
+
+        print(f"{'7-day range':<14} {'patient index':>14} {'R*Tree first':>14} {'get_appointments':>17} {'rows':>6}")
+        for count in args.caregiver_patients:
+            ids = patient_ids[:count]
+            btree = _time_per_call(lambda: range_query(ids, "appointments a"), args.repeats)
+            rtree = _time_per_call(lambda: range_query(
+                ids, "appointment_intervals r CROSS JOIN appointments a ON a.id = r.id", "r.starts_at < ? AND r.ends_at > ? AND"
+            ), args.repeats)
+            calendar = _time_per_call(lambda: appointments.get_appointments(ids, *week), args.repeats)
+            print(f"{count:>5} patients {btree * 1000:>12.2f}ms {rtree * 1000:>12.2f}ms {calendar * 1000:>15.2f}ms "
+                  f"{len(range_query(ids, 'appointments a')):>6}")
+
+        def due_query():
+            with database.get_db_connection() as conn:
+                return conn.execute(
+                    "SELECT MIN(remind_at) FROM appointments WHERE reminded_at IS NULL AND status = 'scheduled'"
+                ).fetchone()
+
+        scheduler = appointments.ReminderScheduler(deliver=lambda reminders: None)
+        started = time.perf_counter()
+        loaded = scheduler.refill(now)
+        print(f"scheduler loaded {loaded} reminders for the next {scheduler.horizon}s "
+              f"in {(time.perf_counter() - started) * 1000:.1f}ms")
+        print(f"next due, partial index query {_time_per_call(due_query, args.repeats) * 1000:>8.3f}ms")
+        print(f"next due, heap peek           {_time_per_call(scheduler.next_due, args.repeats) * 1000:>8.3f}ms")
+
+        started = time.perf_counter()
+        sent = scheduler.run_due(now + scheduler.horizon)
+        print(f"sent {sent} due reminders in {(time.perf_counter() - started) * 1000:.1f}ms")
+
+def bench_export(args):
+    """Export throughput and peak Python memory as the dataset grows"""
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_PATH = Path(tmp) / "bench.db"
+        database.init_db()
+        print(f"{'patients':>8} {'interactions':>13} {'seconds':>8} {'MB out':>8} {'peak MB':>8}")
+        written = 0
+        for step in range(1, args.steps + 1):
+            _populate(args.patients * step - written, args.interactions, args.seed + step)
+            written = args.patients * step
+            counts = {}
+            tracemalloc.start()
+            started = time.perf_counter()
+            size = sum(len(chunk) for chunk in export.export_stream(compression=args.compress, counts=counts))
+            elapsed = time.perf_counter() - started
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f"{counts['patients']:>8} {counts['interactions']:>13} {elapsed:>8.2f} "
+                  f"{size / 1e6:>8.1f} {peak / 1e6:>8.1f}")
+
+# Telemetry setups compared by bench_telemetry: (label, mode, head rate)
+TELEMETRY_SETUPS = [
+    ("no instrumentation", None, None),
+    ("inline (previous setup)", "inline", None),
+    ("full", "full", None),
+    ("sampled", "sampled", 1.0),
+    ("sampled, 10% head", "sampled", 0.1),
+    ("off", "off", None),
+]
+
+class _SlowSink:
+    """A log destination that takes ``latency`` seconds per write, like a backed-up pipe"""
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def write(self, text):
+        if self.latency:
+            time.sleep(self.latency)
+        return len(text)
+
+    def flush(self):
+        pass
+
+def _telemetry_run(task):
+    """Worker: time a route-like call under one telemetry setup, in a fresh process"""
+    import logfire
+    import telemetry
+
+    mode, head_rate, calls, collector, sink_latency = task
+    sink = _SlowSink(sink_latency)
+    # Spans are shipped to a collector that refuses connections
+    options = {
+        "token": "bench-token",
+        "advanced": logfire.AdvancedOptions(base_url=collector),
+        "metrics": False,
+        "inspect_arguments": False,
+    }
+    if mode == "inline":
+        logging.basicConfig(level=logging.INFO, stream=sink, format=telemetry.LOG_FORMAT, force=True)
+        logfire.configure(service_name="bench", console=logfire.ConsoleOptions(output=sink), **options)
+    elif mode is not None:
+        telemetry.HEAD_RATE = head_rate or 1.0
+        if mode == "full":
+            options["console"] = logfire.ConsoleOptions(output=sink)
+        telemetry.configure("bench", mode=mode, **options)
+        telemetry.configure_logging(stream=sink)
+    log = logging.getLogger("bench")
+    payload = {"patient_id": 1, "prompt_type": "base", "care_gaps": ["labs", "imaging"]}
+
+    if mode is None:
+        def route():
+            return json.dumps(payload)
+    else:
+        @logfire.instrument("Bench route")
+        def route():
+            log.info("Processing prompt for patient 1")
+            logfire.info("Prompt processed", prompt_type="base", elapsed_ms=12)
+            return json.dumps(payload)
+
+    for _ in range(200):
+        route()
+    started = time.perf_counter()
+    for _ in range(calls):
+        route()
+    elapsed = time.perf_counter() - started
+    dropped = telemetry._log_handler.dropped if mode not in (None, "inline") else 0
+    return elapsed / calls, dropped
+
+def bench_telemetry(args):
+    """Per-call overhead of tracing and logging under each telemetry mode"""
+    context = multiprocessing.get_context("spawn")
+    baseline = None
+    print(f"log sink latency {args.sink_latency_ms}ms, collector {args.collector}")
+    print(f"{'setup':<26} {'us/call':>9} {'overhead':>10} {'logs dropped':>13}")
+    for label, mode, head_rate in TELEMETRY_SETUPS:
+        with context.Pool(1) as pool:
+            per_call, dropped = pool.apply(
+                _telemetry_run, ((mode, head_rate, args.calls, args.collector, args.sink_latency_ms / 1000),)
+            )
+        baseline = per_call if baseline is None else baseline
+        print(f"{label:<26} {per_call * 1e6:>9.1f} {(per_call - baseline) * 1e6:>8.1f}us {dropped:>13}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    compression = subparsers.add_parser("compression", help="DB size and read latency per codec")
+    compression.add_argument("--patients", type=int, default=50)
+    compression.add_argument("--interactions", type=int, default=40)
+    compression.add_argument("--repeats", type=int, default=5)
+    compression.add_argument("--seed", type=int, default=7)
+    compression.set_defaults(func=bench_compression)
+
+    sharding = subparsers.add_parser("sharding", help="Concurrent write throughput per shard count")
+    sharding.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4])
+    sharding.add_argument("--workers", type=int, default=4)
+    sharding.add_argument("--patients", type=int, default=32)
+    sharding.add_argument("--writes", type=int, default=200, help="Interactions written per worker")
+    sharding.add_argument("--seed", type=int, default=7)
+    sharding.set_defaults(func=bench_sharding)
+
+    serialization_parser = subparsers.add_parser("serialization", help="Patient/interaction response encoding cost")
+    serialization_parser.add_argument("--context-kb", type=int, default=256)
+    serialization_parser.add_argument("--interactions", type=int, default=10)
+    serialization_parser.add_argument("--repeats", type=int, default=50)
+    serialization_parser.add_argument("--seed", type=int, default=7)
+    serialization_parser.set_defaults(func=bench_serialization)
+
+    appointments_parser = subparsers.add_parser("appointments", help="Calendar range query and reminder check latency")
+    appointments_parser.add_argument("--appointments", type=int, default=200000)
+    appointments_parser.add_argument("--patients", type=int, default=2000)
+    appointments_parser.add_argument("--caregiver-patients", type=int, nargs="+", default=[1, 20, 100, 500, 2000])
+    appointments_parser.add_argument("--repeats", type=int, default=50)
+    appointments_parser.add_argument("--seed", type=int, default=7)
+    appointments_parser.set_defaults(func=bench_appointments)
+
+    export_parser = subparsers.add_parser("export", help="Export throughput and peak memory")
+    export_parser.add_argument("--patients", type=int, default=100, help="Patients added per step")
+    export_parser.add_argument("--interactions", type=int, default=50)
+    export_parser.add_argument("--steps", type=int, default=3)
+    export_parser.add_argument("--compress", choices=export.COMPRESSIONS, default="gzip")
+    export_parser.add_argument("--seed", type=int, default=7)
+    export_parser.set_defaults(func=bench_export)
+
+    telemetry_parser = subparsers.add_parser("telemetry", help="Tracing and logging overhead per request")
+    telemetry_parser.add_argument("--calls", type=int, default=20000)
+    telemetry_parser.add_argument("--collector", default="http://127.0.0.1:9",
+                                  help="Logfire base URL; the default refuses connections")
+    telemetry_parser.add_argument("--sink-latency-ms", type=float, default=0.0,
+                                  help="Simulated time per write to the log/console output")
+    telemetry_parser.set_defaults(func=bench_telemetry)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
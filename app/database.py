@@ -1,27 +1,374 @@
+import os
+import re
 import sqlite3
-from contextlib import contextmanager
+import time
+import zlib
+from contextlib import contextmanager, nullcontext
 from pathlib import Path
 import json
 
+from serialization import dumps_text, loads
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional, zlib is always available
+    zstandard = None
+
 # Create the database directory if it doesn't exist
 DB_DIR = Path("./data")
 DB_DIR.mkdir(exist_ok=True)
 DB_PATH = DB_DIR / "carebears.db"
 
-@contextmanager
-def get_db_connection():
-    """Context manager for SQLite database connection"""
-    conn = sqlite3.connect(str(DB_PATH))
+# --- Column compression ---
+# Large text columns (interaction responses, context snapshots and the patient
+# context with its uploaded raw_text) are stored as compressed BLOBs. Every
+# compressed value starts with a short codec tag so plain TEXT rows written
+# before compression was enabled can still be read as-is.
+COMPRESSION_CODEC = os.getenv("CAREBEARS_COMPRESSION", "zlib")  # zlib, zstd or none
+COMPRESSION_MIN_SIZE = int(os.getenv("CAREBEARS_COMPRESSION_MIN_SIZE", "256"))
+ZSTD_DICT_PATH = os.getenv("CAREBEARS_ZSTD_DICT")
+
+ZLIB_TAG = b"Z1"
+ZSTD_TAG = b"S1"
+ZSTD_DICT_TAG = b"D1"
+
+COMPRESSED_COLUMNS = {
+    "patients": ("context",),
+    "interactions": ("response", "context_before", "context_after"),
+    "patient_documents": ("text",),
+}
+
+_zstd_dict = None
+_zstd_compressor = None
+_zstd_decompressors = {}
+
+def _get_zstd_dict():
+    """Load the shared zstd dictionary once, if one is configured"""
+    global _zstd_dict
+    if _zstd_dict is None and ZSTD_DICT_PATH and Path(ZSTD_DICT_PATH).exists():
+        _zstd_dict = zstandard.ZstdCompressionDict(Path(ZSTD_DICT_PATH).read_bytes())
+    return _zstd_dict
+
+def _get_zstd_compressor():
+    global _zstd_compressor
+    if _zstd_compressor is None:
+        dictionary = _get_zstd_dict()
+        if dictionary is not None:
+            _zstd_compressor = zstandard.ZstdCompressor(level=9, dict_data=dictionary)
+        else:
+            _zstd_compressor = zstandard.ZstdCompressor(level=9)
+    return _zstd_compressor
+
+def _get_zstd_decompressor(use_dict):
+    if use_dict not in _zstd_decompressors:
+        if use_dict:
+            dictionary = _get_zstd_dict()
+            if dictionary is None:
+                raise RuntimeError("Row was compressed with a zstd dictionary but CAREBEARS_ZSTD_DICT is not set")
+            _zstd_decompressors[use_dict] = zstandard.ZstdDecompressor(dict_data=dictionary)
+        else:
+            _zstd_decompressors[use_dict] = zstandard.ZstdDecompressor()
+    return _zstd_decompressors[use_dict]
+
+def compress_text(text):
+    """Compress a text value for storage, leaving small values as plain text"""
+    if text is None or COMPRESSION_CODEC == "none":
+        return text
+    data = text.encode("utf-8")
+    if len(data) < COMPRESSION_MIN_SIZE:
+        return text
+    if COMPRESSION_CODEC == "zstd" and zstandard is not None:
+        tag = ZSTD_DICT_TAG if _get_zstd_dict() is not None else ZSTD_TAG
+        return tag + _get_zstd_compressor().compress(data)
+    return ZLIB_TAG + zlib.compress(data, 6)
+
+def decompress_text(value):
+    """Return the text for a stored column value, compressed or not"""
+    if not isinstance(value, bytes):
+        return value
+    tag, payload = value[:2], value[2:]
+    if tag == ZLIB_TAG:
+        return zlib.decompress(payload).decode("utf-8")
+    if tag in (ZSTD_TAG, ZSTD_DICT_TAG):
+        if zstandard is None:
+            raise RuntimeError("Row was compressed with zstd but the zstandard package is not installed")
+        return _get_zstd_decompressor(tag == ZSTD_DICT_TAG).decompress(payload).decode("utf-8")
+    return value.decode("utf-8")
+
+def _load_json_column(value):
+    """Decompress and parse a JSON column"""
+    text = decompress_text(value)
+    return loads(text) if text else text
+
+def train_zstd_dictionary(output_path, sample_limit=2000, dict_size=64 * 1024):
+    """
+    Train a shared zstd dictionary from existing rows
+
+    Args:
+        output_path: Where to write the dictionary file
+        sample_limit: Maximum number of rows sampled per column
+        dict_size: Target dictionary size in bytes
+
+    Returns:
+        Path of the written dictionary
+    """
+    if zstandard is None:
+        raise RuntimeError("Training a dictionary requires the zstandard package")
+    samples = []
+    for shard in all_shards():
+        with get_db_connection(shard) as conn:
+            for table, columns in COMPRESSED_COLUMNS.items():
+                for column in columns:
+                    rows = conn.execute(
+                        f'SELECT {column} FROM {table} WHERE {column} IS NOT NULL ORDER BY id DESC LIMIT ?',
+                        (sample_limit,)
+                    )
+                    samples.extend(decompress_text(row[0]).encode("utf-8") for row in rows)
+    dictionary = zstandard.train_dictionary(dict_size, samples)
+    Path(output_path).write_bytes(dictionary.as_bytes())
+    return Path(output_path)
+
+# --- Sharding ---
+# Patients and everything keyed by patient_id (interactions, documents, ...)
+# live in one of CAREBEARS_SHARDS SQLite files, so writers for different
+# patients don't serialize on a single database lock. Shard 0 is the original
+# carebears.db. A small directory database allocates globally unique patient
+# ids and maps each patient to its shard; patients created before sharding
+# are not in the map and live in shard 0.
+SHARD_COUNT = int(os.getenv("CAREBEARS_SHARDS", "1"))
+SHARD_CACHE_SECONDS = float(os.getenv("CAREBEARS_SHARD_CACHE_SECONDS", "5"))
+
+_shard_cache = {}
+
+def shard_path(shard):
+    """Path of a shard's database file"""
+    if shard == 0:
+        return DB_PATH
+    return DB_PATH.with_name(f"{DB_PATH.stem}-{shard}{DB_PATH.suffix}")
+
+def directory_path():
+    """Path of the patient directory (id allocator and shard map)"""
+    return DB_PATH.with_name(f"{DB_PATH.stem}-directory{DB_PATH.suffix}")
+
+def all_shards():
+    """Every shard that is configured or still has a database file"""
+    shards = set(range(SHARD_COUNT))
+    shard = SHARD_COUNT
+    while shard_path(shard).exists():
+        shards.add(shard)
+        shard += 1
+    return sorted(shards)
+
+def _connect(path):
+    conn = sqlite3.connect(str(path))
     conn.row_factory = sqlite3.Row
+    return conn
+
+@contextmanager
+def get_db_connection(shard=0):
+    """Context manager for SQLite database connection to a shard"""
+    conn = _connect(shard_path(shard))
     try:
         yield conn
     finally:
         conn.close()
 
+@contextmanager
+def get_directory_connection():
+    """Context manager for the patient directory database"""
+    conn = _connect(directory_path())
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+def shard_for_patient(patient_id):
+    """Return the shard that holds a patient"""
+    key = (os.path.abspath(directory_path()), patient_id)
+    cached = _shard_cache.get(key)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+    with get_directory_connection() as conn:
+        row = conn.execute('SELECT shard FROM shard_map WHERE patient_id = ?', (patient_id,)).fetchone()
+    if row is None:
+        # Unmapped ids may be allocated later, so only cache real entries
+        return 0
+    # Entries expire so other worker processes notice moved patients
+    _shard_cache[key] = (row["shard"], time.monotonic() + SHARD_CACHE_SECONDS)
+    return row["shard"]
+
+def forget_shard(patient_id):
+    """Drop a cached shard lookup after a patient has been moved"""
+    _shard_cache.pop((os.path.abspath(directory_path()), patient_id), None)
+
+def get_patient_connection(patient_id):
+    """Context manager for a connection to the shard holding a patient"""
+    return get_db_connection(shard_for_patient(patient_id))
+
+@contextmanager
+def patient_write_connection(patient_id):
+    """
+    Connection to the shard holding a patient, inside a write transaction
+
+    The transaction is opened with BEGIN IMMEDIATE and the patient looked up
+    in it. If another worker has moved the patient away (and this worker's
+    shard cache is stale), the shard is resolved again from the directory, so
+    the write never lands in a shard the patient has left.
+    """
+    for attempt in range(2):
+        conn = _connect(shard_path(shard_for_patient(patient_id)))
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            if attempt or conn.execute('SELECT 1 FROM patients WHERE id = ?', (patient_id,)).fetchone():
+                yield conn
+                return
+            conn.rollback()
+        finally:
+            conn.close()
+        forget_shard(patient_id)
+
+def allocate_patient_id(shard=None):
+    """
+    Allocate a globally unique patient id and record its shard
+
+    Args:
+        shard: Place the patient on this shard instead of routing by id
+
+    Returns:
+        (patient_id, shard) tuple
+    """
+    with get_directory_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('INSERT INTO patient_ids DEFAULT VALUES')
+        patient_id = cursor.lastrowid
+        shard = patient_id % SHARD_COUNT if shard is None else shard
+        cursor.execute('INSERT INTO shard_map (patient_id, shard) VALUES (?, ?)', (patient_id, shard))
+        conn.commit()
+    return patient_id, shard
+
+def _ensure_column(cursor, table, column, declaration):
+    """Add a column to an existing table if it is missing"""
+    existing = {row[1] for row in cursor.execute(f'PRAGMA table_info({table})')}
+    if column not in existing:
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {declaration}')
+
+def _init_directory():
+    """Create the id allocator and shard map"""
+    with get_directory_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('PRAGMA journal_mode = WAL')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS patient_ids (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS shard_map (
+            patient_id INTEGER PRIMARY KEY,
+            shard INTEGER NOT NULL
+        )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_shard_map_shard ON shard_map (shard)')
+
+        # Caregivers span shards, so they live in the directory next to the
+        # shard map. Their patients' dashboard rollups live in the shards.
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS caregivers (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            email TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS caregiver_patients (
+            caregiver_id INTEGER NOT NULL,
+            patient_id INTEGER NOT NULL,
+            relationship TEXT,
+            PRIMARY KEY (caregiver_id, patient_id)
+        ) WITHOUT ROWID
+        ''')
+        # Rollups used to be kept here; they are rebuilt in the shards by init_db
+        cursor.execute('DROP TABLE IF EXISTS patient_rollups')
+
+        # Start allocating above any patient created before the directory existed
+        with get_db_connection(0) as shard_conn:
+            legacy_max = shard_conn.execute('SELECT MAX(id) FROM patients').fetchone()[0] or 0
+        allocated_max = cursor.execute('SELECT MAX(id) FROM patient_ids').fetchone()[0] or 0
+        if legacy_max > allocated_max:
+            cursor.execute('INSERT INTO patient_ids (id) VALUES (?)', (legacy_max,))
+
+        # Next id for each table in GLOBAL_ID_TABLES, kept above every id
+        # already used in any shard (rows written before ids were global)
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS row_ids (
+            name TEXT PRIMARY KEY,
+            next_id INTEGER NOT NULL
+        ) WITHOUT ROWID
+        ''')
+        for table in GLOBAL_ID_TABLES:
+            used_max = 0
+            for shard in all_shards():
+                with get_db_connection(shard) as shard_conn:
+                    used_max = max(used_max, shard_conn.execute(f'SELECT MAX(id) FROM {table}').fetchone()[0] or 0)
+            cursor.execute(
+                '''
+                INSERT INTO row_ids (name, next_id) VALUES (?, ?)
+                ON CONFLICT (name) DO UPDATE SET next_id = MAX(next_id, excluded.next_id)
+                ''',
+                (table, used_max + 1)
+            )
+        conn.commit()
+
+def allocate_row_ids(table, count=1):
+    """
+    Reserve ``count`` consecutive ids for rows of a table in GLOBAL_ID_TABLES
+
+    Call it inside the patient's write transaction: the shard stays locked
+    until the rows commit, so a patient's rows commit in id order.
+
+    Returns:
+        The first reserved id
+    """
+    with get_directory_connection() as conn:
+        next_id = conn.execute(
+            'UPDATE row_ids SET next_id = next_id + ? WHERE name = ? RETURNING next_id', (count, table)
+        ).fetchone()[0]
+        conn.commit()
+    return next_id - count
+
 def init_db():
-    """Initialize the database with required tables"""
-    with get_db_connection() as conn:
+    """Initialize every shard and the patient directory"""
+    for shard in all_shards():
+        _init_shard(shard)
+    _init_directory()
+    rebuild_patient_rollups(missing_only=True)
+
+# Per-patient tables whose ids are allocated in the directory
+# (allocate_row_ids), so they are unique across shards and survive moves
+GLOBAL_ID_TABLES = ("interactions", "patient_documents", "document_chunks", "appointments")
+
+# Tables of per-patient rows whose writes bump the patient's version. A shard
+# move compares the version before and after copying, so every table it
+# copies (see sharding.PATIENT_TABLES) except the derived rollups is here.
+VERSIONED_TABLES = ("interactions", "patient_documents", "document_chunks", "lab_series", "appointments")
+# Bookkeeping columns whose updates don't change what the patient sees, so
+# they don't bump the version (and invalidate ETags). Shard moves copy them
+# again under the final lock instead.
+UNVERSIONED_COLUMNS = {"appointments": ("claimed_at", "reminded_at")}
+
+def _init_shard(shard):
+    """Initialize a shard database with required tables"""
+    with get_db_connection(shard) as conn:
         cursor = conn.cursor()
+
+        # Let the archival job hand freed pages back to the filesystem.
+        # This only takes effect for new databases; existing ones are
+        # converted with `python manage.py enable-incremental-vacuum`.
+        cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        # Readers don't block the writer, and writers don't block readers
+        cursor.execute('PRAGMA journal_mode = WAL')
         
         # Create patients table
         cursor.execute('''
@@ -51,78 +398,292 @@ def init_db():
             FOREIGN KEY (patient_id) REFERENCES patients (id)
         )
         ''')
+
+        # Every write that changes what a patient's pages or APIs return bumps
+        # the patient's version, which is used for HTTP ETags and to detect
+        # writes during a shard move
+        _ensure_column(cursor, 'patients', 'version', 'INTEGER NOT NULL DEFAULT 1')
+        _ensure_column(cursor, 'patients', 'updated_at', 'TIMESTAMP')
+
+        # Archived interactions keep a short summary in the hot table and
+        # point at the full row in an archive segment (see archive.py)
+        _ensure_column(cursor, 'interactions', 'archived_at', 'TIMESTAMP')
+        _ensure_column(cursor, 'interactions', 'archive_ref', 'TEXT')
+
+        # Uploaded patient documents, chunked and indexed for retrieval
+        # (see retrieval.py) instead of being sent whole with every prompt
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS patient_documents (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            patient_id INTEGER NOT NULL,
+            source TEXT,
+            text TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (patient_id) REFERENCES patients (id)
+        )
+        ''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS document_chunks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            patient_id INTEGER NOT NULL,
+            document_id INTEGER NOT NULL,
+            chunk_index INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            term_ids BLOB NOT NULL,
+            term_weights BLOB NOT NULL,
+            FOREIGN KEY (document_id) REFERENCES patient_documents (id)
+        )
+        ''')
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_document_chunks_patient
+        ON document_chunks (patient_id, id)
+        ''')
+        # Re-indexing the same text from the same source is a no-op
+        _ensure_column(cursor, 'patient_documents', 'content_hash', 'TEXT')
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_patient_documents_hash
+        ON patient_documents (patient_id, content_hash)
+        ''')
+
+        # Appointments, with an R*Tree over [starts_at, ends_at] (epoch
+        # seconds) kept in sync by triggers for interval queries (see
+        # appointments.py), and a partial index of reminders still to send.
+        # claimed_at marks a reminder a scheduler is delivering; reminded_at
+        # is only set once delivery succeeded
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS appointments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            patient_id INTEGER NOT NULL,
+            provider TEXT NOT NULL,
+            location TEXT,
+            purpose TEXT,
+            starts_at INTEGER NOT NULL,
+            ends_at INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'scheduled',
+            remind_at INTEGER,
+            reminded_at INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (patient_id) REFERENCES patients (id)
+        )
+        ''')
+        _ensure_column(cursor, 'appointments', 'claimed_at', 'INTEGER')
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_appointments_patient_start
+        ON appointments (patient_id, starts_at)
+        ''')
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_appointments_pending_reminders
+        ON appointments (remind_at) WHERE reminded_at IS NULL AND status = 'scheduled'
+        ''')
+        cursor.execute(
+            'CREATE VIRTUAL TABLE IF NOT EXISTS appointment_intervals USING rtree(id, starts_at, ends_at)'
+        )
+        cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS appointments_interval_insert AFTER INSERT ON appointments BEGIN
+            INSERT INTO appointment_intervals (id, starts_at, ends_at) VALUES (new.id, new.starts_at, new.ends_at);
+        END
+        ''')
+        cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS appointments_interval_update AFTER UPDATE OF starts_at, ends_at ON appointments BEGIN
+            UPDATE appointment_intervals SET starts_at = new.starts_at, ends_at = new.ends_at WHERE id = new.id;
+        END
+        ''')
+        cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS appointments_interval_delete AFTER DELETE ON appointments BEGIN
+            DELETE FROM appointment_intervals WHERE id = old.id;
+        END
+        ''')
+
+        # Caregiver dashboard rollups, one row per patient, written in the same
+        # transaction as the patient's interactions (see get_caregiver_dashboard)
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS patient_rollups (
+            patient_id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            diagnosis TEXT,
+            care_gaps JSON NOT NULL DEFAULT '[]',
+            interaction_count INTEGER NOT NULL DEFAULT 0,
+            prompt_counts JSON NOT NULL DEFAULT '{}',
+            last_interaction_at TIMESTAMP,
+            last_prompt_type TEXT,
+            last_summary TEXT
+        )
+        ''')
+
+        # One row per patient and analyte holding the whole series as packed
+        # NumPy arrays (see labs.py): int64 epoch seconds and float64 values
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS lab_series (
+            patient_id INTEGER NOT NULL,
+            analyte TEXT NOT NULL,
+            unit TEXT,
+            ref_low REAL,
+            ref_high REAL,
+            times BLOB NOT NULL,
+            readings BLOB NOT NULL,
+            count INTEGER NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (patient_id, analyte)
+        ) WITHOUT ROWID
+        ''')
+
+        # Writes to any patient-keyed table bump the patient's version
+        for table in VERSIONED_TABLES:
+            skipped = UNVERSIONED_COLUMNS.get(table)
+            for event, row in (("INSERT", "new"), ("UPDATE", "new"), ("DELETE", "old")):
+                trigger = f"{table}_touch_{event.lower()}"
+                if event == "UPDATE" and skipped:
+                    columns = [column[1] for column in cursor.execute(f'PRAGMA table_info({table})')]
+                    event = f"UPDATE OF {', '.join(column for column in columns if column not in skipped)}"
+                existing = cursor.execute(
+                    "SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = ?", (trigger,)
+                ).fetchone()
+                if existing and f"AFTER {event} ON" not in existing[0]:
+                    # Created before the table's UNVERSIONED_COLUMNS (or a new column)
+                    cursor.execute(f'DROP TRIGGER {trigger}')
+                cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {trigger} AFTER {event} ON {table} BEGIN
+                    UPDATE patients SET version = version + 1, updated_at = CURRENT_TIMESTAMP
+                    WHERE id = {row}.patient_id;
+                END
+                ''')
+
+        # Hot-path index for per-patient history, and a partial index so the
+        # archival job finds old, not-yet-archived rows without a table scan
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_interactions_patient_created
+        ON interactions (patient_id, created_at)
+        ''')
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_interactions_unarchived_created
+        ON interactions (created_at) WHERE archived_at IS NULL
+        ''')
+        # Incremental exports page through interactions by (created_at, id)
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_interactions_created
+        ON interactions (created_at)
+        ''')
         
         conn.commit()
 
 def add_patient(name, dob, location, diagnosis, care_gaps=None, context=None):
     """Add a new patient to the database"""
-    with get_db_connection() as conn:
+    patient_id, shard = allocate_patient_id()
+    with get_db_connection(shard) as conn:
         cursor = conn.cursor()
         cursor.execute(
             '''
-            INSERT INTO patients (name, dob, location, diagnosis, care_gaps, context)
-            VALUES (?, ?, ?, ?, ?, ?)
+            INSERT INTO patients (id, name, dob, location, diagnosis, care_gaps, context)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
             ''',
-            (name, dob, location, diagnosis, care_gaps, json.dumps(context or {}))
+            (patient_id, name, dob, location, diagnosis, care_gaps, compress_text(dumps_text(context or {})))
         )
+        _write_rollup(conn, patient_id, name, diagnosis, _rollup_care_gaps(care_gaps, context))
         conn.commit()
-        return cursor.lastrowid
+    return patient_id
 
-def get_patient(patient_id):
-    """Get patient information by ID"""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM patients WHERE id = ?', (patient_id,))
-        patient = cursor.fetchone()
-        if patient:
-            # Convert SQLite Row to dict
-            patient_dict = dict(patient)
-            # Parse JSON fields
-            if patient_dict['context']:
-                patient_dict['context'] = json.loads(patient_dict['context'])
-            return patient_dict
-        return None
-
-def update_patient_context(patient_id, new_context):
-    """Update a patient's context information"""
-    with get_db_connection() as conn:
+def _patient_row(patient_id, columns):
+    """Read a patient row, resolving the shard again if the patient has just moved away"""
+    for attempt in range(2):
+        with get_patient_connection(patient_id) as conn:
+            row = conn.execute(f'SELECT {columns} FROM patients WHERE id = ?', (patient_id,)).fetchone()
+        if row is not None or attempt:
+            return row
+        forget_shard(patient_id)
+
+def get_patient(patient_id, raw_json=False):
+    """
+    Get patient information by ID
+
+    With ``raw_json`` the context is returned as its stored JSON text instead
+    of being parsed, for callers that pass it through unchanged.
+    """
+    patient = _patient_row(patient_id, '*')
+    if patient:
+        # Convert SQLite Row to dict
+        patient_dict = dict(patient)
+        # Parse JSON fields
+        if patient_dict['context']:
+            load = decompress_text if raw_json else _load_json_column
+            patient_dict['context'] = load(patient_dict['context'])
+        return patient_dict
+    return None
+
+def get_patient_version(patient_id):
+    """
+    Get the cache validators for a patient without loading their record
+
+    Returns:
+        Dictionary with ``version`` and ``updated_at`` (falling back to
+        ``created_at``), or None if the patient does not exist
+    """
+    row = _patient_row(patient_id, 'version, COALESCE(updated_at, created_at) AS updated_at')
+    return dict(row) if row else None
+
+def update_patient_context(patient_id, new_context, conn=None):
+    """Update a patient's context information (committing ``conn`` if given)"""
+    with (nullcontext(conn) if conn else patient_write_connection(patient_id)) as conn:
         cursor = conn.cursor()
         cursor.execute(
-            'UPDATE patients SET context = ? WHERE id = ?',
-            (json.dumps(new_context), patient_id)
+            '''
+            UPDATE patients
+            SET context = ?, version = version + 1, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+            ''',
+            (compress_text(dumps_text(new_context)), patient_id)
         )
         conn.commit()
         return cursor.rowcount > 0
 
 def add_interaction(patient_id, prompt_type, user_input, response, context_before, context_after):
     """Record a patient interaction in the database"""
-    with get_db_connection() as conn:
+    with patient_write_connection(patient_id) as conn:
         cursor = conn.cursor()
         cursor.execute(
             '''
             INSERT INTO interactions 
-            (patient_id, prompt_type, user_input, response, context_before, context_after)
-            VALUES (?, ?, ?, ?, ?, ?)
+            (id, patient_id, prompt_type, user_input, response, context_before, context_after)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
             ''',
             (
+                allocate_row_ids("interactions"),
                 patient_id, 
                 prompt_type, 
                 user_input, 
-                response, 
-                json.dumps(context_before or {}),
-                json.dumps(context_after or {})
+                compress_text(response),
+                compress_text(dumps_text(context_before or {})),
+                compress_text(dumps_text(context_after or {}))
             )
         )
+        interaction_id = cursor.lastrowid
+        _record_interaction_rollup(cursor, patient_id, prompt_type, response, context_after)
         conn.commit()
-        return cursor.lastrowid
+    return interaction_id
+
+INTERACTION_COLUMNS = (
+    "id", "patient_id", "prompt_type", "user_input", "response",
+    "context_before", "context_after", "created_at", "archived_at", "archive_ref"
+)
 
-def get_patient_interactions(patient_id, limit=10):
-    """Get recent interactions for a patient"""
-    with get_db_connection() as conn:
+def get_patient_interactions(patient_id, limit=10, columns=None, raw_json=False):
+    """
+    Get recent interactions for a patient
+
+    Only the requested columns are read and decompressed, so callers that
+    don't need the context snapshots can pass e.g.
+    ``columns=("id", "prompt_type", "user_input", "response", "created_at")``.
+    With ``raw_json`` the context snapshots are returned as JSON text.
+    """
+    load = decompress_text if raw_json else _load_json_column
+    columns = tuple(columns or INTERACTION_COLUMNS)
+    unknown = set(columns) - set(INTERACTION_COLUMNS)
+    if unknown:
+        raise ValueError(f"Unknown interaction columns: {sorted(unknown)}")
+    with get_patient_connection(patient_id) as conn:
         cursor = conn.cursor()
         cursor.execute(
-            '''
-            SELECT * FROM interactions
+            f'''
+            SELECT {", ".join(columns)} FROM interactions
             WHERE patient_id = ?
             ORDER BY created_at DESC
             LIMIT ?
@@ -130,13 +691,264 @@ def get_patient_interactions(patient_id, limit=10):
             (patient_id, limit)
         )
         interactions = cursor.fetchall()
-        # Convert SQLite Row objects to dicts and parse JSON
+        # Convert SQLite Row objects to dicts, decompress and parse JSON
         result = []
         for interaction in interactions:
             interaction_dict = dict(interaction)
-            if interaction_dict['context_before']:
-                interaction_dict['context_before'] = json.loads(interaction_dict['context_before'])
-            if interaction_dict['context_after']:
-                interaction_dict['context_after'] = json.loads(interaction_dict['context_after'])
+            if 'response' in interaction_dict:
+                interaction_dict['response'] = decompress_text(interaction_dict['response'])
+            if interaction_dict.get('context_before'):
+                interaction_dict['context_before'] = load(interaction_dict['context_before'])
+            if interaction_dict.get('context_after'):
+                interaction_dict['context_after'] = load(interaction_dict['context_after'])
             result.append(interaction_dict)
         return result
+
+# --- Caregiver dashboard rollups ---
+# One row per patient in the patient's shard, updated in the same transaction
+# as every interaction write, so a caregiver's dashboard is one indexed read
+# per shard however many patients or interactions there are.
+
+SUMMARY_CHARS = 280
+
+def summarize_response(response):
+    """Build a short plain-text summary of a model response"""
+    text = re.sub(r'<context>.*?</context>', '', response or '', flags=re.DOTALL)
+    text = re.sub(r'[#*_`>]+', '', text)
+    text = " ".join(text.split())
+    if len(text) > SUMMARY_CHARS:
+        text = text[:SUMMARY_CHARS - 1].rstrip() + "…"
+    return text
+
+def _rollup_care_gaps(care_gaps, context):
+    """Return the care gaps JSON for a patient context"""
+    gaps = (context or {}).get("care_gaps", care_gaps)
+    if isinstance(gaps, str):
+        gaps = [gaps] if gaps.strip() else []
+    return json.dumps([str(gap) for gap in gaps or []])
+
+def _write_rollup(conn, patient_id, name, diagnosis, care_gaps):
+    """Create or refresh a patient's rollup row; the caller commits"""
+    conn.execute(
+        '''
+        INSERT INTO patient_rollups (patient_id, name, diagnosis, care_gaps)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (patient_id) DO UPDATE SET
+            name = excluded.name, diagnosis = excluded.diagnosis, care_gaps = excluded.care_gaps
+        ''',
+        (patient_id, name, diagnosis, care_gaps)
+    )
+
+def _record_interaction_rollup(conn, patient_id, prompt_type, response, context_after):
+    """Fold one new interaction into the patient's rollup row; the caller commits"""
+    conn.execute(
+        '''
+        UPDATE patient_rollups SET
+            interaction_count = interaction_count + 1,
+            prompt_counts = json_set(
+                prompt_counts, '$.' || :prompt_type,
+                COALESCE(json_extract(prompt_counts, '$.' || :prompt_type), 0) + 1
+            ),
+            last_interaction_at = CURRENT_TIMESTAMP,
+            last_prompt_type = :prompt_type,
+            last_summary = :summary,
+            care_gaps = CASE WHEN :has_context THEN :care_gaps ELSE care_gaps END
+        WHERE patient_id = :patient_id
+        ''',
+        {
+            "patient_id": patient_id,
+            "prompt_type": prompt_type,
+            "summary": summarize_response(response),
+            "has_context": bool(context_after),
+            "care_gaps": _rollup_care_gaps(None, context_after),
+        }
+    )
+
+def rebuild_patient_rollups(missing_only=False):
+    """
+    Recompute dashboard rollups from the patients and interactions tables
+
+    Used to backfill patients created before rollups existed.
+
+    Returns:
+        Number of rollups written
+    """
+    rebuilt = 0
+    for shard in all_shards():
+        with get_db_connection(shard) as conn:
+            # Only ids are scanned, so a startup check with every rollup in place
+            # never loads (or decompresses) a patient's context
+            query = 'SELECT id FROM patients'
+            if missing_only:
+                query += ' WHERE id NOT IN (SELECT patient_id FROM patient_rollups)'
+            for (patient_id,) in conn.execute(query).fetchall():
+                patient = conn.execute(
+                    'SELECT id, name, diagnosis, care_gaps, context FROM patients WHERE id = ?', (patient_id,)
+                ).fetchone()
+                counts = dict(conn.execute(
+                    'SELECT prompt_type, COUNT(*) FROM interactions WHERE patient_id = ? GROUP BY prompt_type',
+                    (patient["id"],)
+                ).fetchall())
+                last = conn.execute(
+                    '''
+                    SELECT prompt_type, response, context_after, created_at FROM interactions
+                    WHERE patient_id = ? ORDER BY created_at DESC, id DESC LIMIT 1
+                    ''',
+                    (patient["id"],)
+                ).fetchone()
+                # Same source as the incremental path: the latest interaction's context
+                context = _load_json_column(last["context_after"]) if last and last["context_after"] else None
+                if not context:
+                    context = _load_json_column(patient["context"]) if patient["context"] else {}
+                _write_rollup(
+                    conn, patient["id"], patient["name"], patient["diagnosis"],
+                    _rollup_care_gaps(patient["care_gaps"], context)
+                )
+                conn.execute(
+                    '''
+                    UPDATE patient_rollups SET
+                        interaction_count = ?, prompt_counts = ?,
+                        last_interaction_at = ?, last_prompt_type = ?, last_summary = ?
+                    WHERE patient_id = ?
+                    ''',
+                    (
+                        sum(counts.values()), json.dumps(counts),
+                        last["created_at"] if last else None,
+                        last["prompt_type"] if last else None,
+                        summarize_response(decompress_text(last["response"])) if last else None,
+                        patient["id"],
+                    )
+                )
+                rebuilt += 1
+            conn.commit()
+    return rebuilt
+
+def add_caregiver(name, email=None):
+    """Add a caregiver and return their id"""
+    with get_directory_connection() as conn:
+        cursor = conn.execute('INSERT INTO caregivers (name, email) VALUES (?, ?)', (name, email))
+        conn.commit()
+        return cursor.lastrowid
+
+def get_caregiver(caregiver_id):
+    """Get caregiver information by ID"""
+    with get_directory_connection() as conn:
+        row = conn.execute('SELECT * FROM caregivers WHERE id = ?', (caregiver_id,)).fetchone()
+        return dict(row) if row else None
+
+def link_caregiver_patient(caregiver_id, patient_id, relationship=None):
+    """Give a caregiver access to a patient's dashboard entry"""
+    with get_directory_connection() as conn:
+        conn.execute(
+            '''
+            INSERT INTO caregiver_patients (caregiver_id, patient_id, relationship) VALUES (?, ?, ?)
+            ON CONFLICT (caregiver_id, patient_id) DO UPDATE SET relationship = excluded.relationship
+            ''',
+            (caregiver_id, patient_id, relationship)
+        )
+        conn.commit()
+
+def unlink_caregiver_patient(caregiver_id, patient_id):
+    """Remove a patient from a caregiver's dashboard"""
+    with get_directory_connection() as conn:
+        cursor = conn.execute(
+            'DELETE FROM caregiver_patients WHERE caregiver_id = ? AND patient_id = ?', (caregiver_id, patient_id)
+        )
+        conn.commit()
+        return cursor.rowcount > 0
+
+def get_caregiver_dashboard(caregiver_id):
+    """
+    Get the rollup row for every patient a caregiver looks after, most recently active first
+
+    Rollups are read from each shard holding one of the caregiver's patients.
+    ``pending_reminders`` counts the patient's appointment reminders not sent yet.
+    """
+    with get_directory_connection() as conn:
+        links = conn.execute(
+            '''
+            SELECT cp.patient_id, cp.relationship, COALESCE(sm.shard, 0) AS shard
+            FROM caregiver_patients cp LEFT JOIN shard_map sm ON sm.patient_id = cp.patient_id
+            WHERE cp.caregiver_id = ?
+            ''',
+            (caregiver_id,)
+        ).fetchall()
+    relationships = {row["patient_id"]: row["relationship"] for row in links}
+    by_shard = {}
+    for row in links:
+        by_shard.setdefault(row["shard"], []).append(row["patient_id"])
+
+    result = []
+    for shard, patient_ids in by_shard.items():
+        with get_db_connection(shard) as conn:
+            rows = conn.execute(
+                f'''
+                SELECT r.*, (
+                    SELECT COUNT(*) FROM appointments a
+                    WHERE a.patient_id = r.patient_id AND a.status = 'scheduled'
+                      AND a.remind_at IS NOT NULL AND a.reminded_at IS NULL
+                ) AS pending_reminders
+                FROM patient_rollups r
+                WHERE r.patient_id IN ({", ".join("?" for _ in patient_ids)})
+                ''',
+                patient_ids
+            ).fetchall()
+        for row in rows:
+            entry = dict(row)
+            entry["relationship"] = relationships[entry["patient_id"]]
+            entry["care_gaps"] = json.loads(entry["care_gaps"])
+            entry["prompt_counts"] = json.loads(entry["prompt_counts"])
+            result.append(entry)
+    # Stable sorts: by patient id, then latest activity first with inactive patients last
+    result.sort(key=lambda entry: entry["patient_id"])
+    result.sort(key=lambda entry: entry["last_interaction_at"] or "", reverse=True)
+    return result
+
+def migrate_compress_columns(batch_size=200, pause_seconds=0.0):
+    """
+    Compress existing plain-text rows in place
+
+    Runs online: each batch is its own short transaction keyed on the row id,
+    so the app keeps serving requests while the migration makes progress.
+    Rows that are already compressed (or too small to compress) are skipped,
+    which makes the migration safe to re-run or interrupt.
+
+    Returns:
+        Dictionary of ``table.column`` -> number of rows rewritten
+    """
+    stats = {}
+    for shard in all_shards():
+        with get_db_connection(shard) as conn:
+            for table, columns in COMPRESSED_COLUMNS.items():
+                for column in columns:
+                    rewritten = 0
+                    last_id = 0
+                    while True:
+                        rows = conn.execute(
+                            f'''
+                            SELECT id, {column} FROM {table}
+                            WHERE id > ? AND typeof({column}) = 'text' AND length({column}) >= ?
+                            ORDER BY id
+                            LIMIT ?
+                            ''',
+                            (last_id, COMPRESSION_MIN_SIZE, batch_size)
+                        ).fetchall()
+                        if not rows:
+                            break
+                        updates = []
+                        for row in rows:
+                            compressed = compress_text(row[column])
+                            if isinstance(compressed, bytes):
+                                updates.append((compressed, row["id"], row[column]))
+                        # Only rewrite a row if nobody changed it since we read it
+                        conn.executemany(
+                            f'UPDATE {table} SET {column} = ? WHERE id = ? AND {column} = ?',
+                            updates
+                        )
+                        conn.commit()
+                        rewritten += len(updates)
+                        last_id = rows[-1]["id"]
+                        if pause_seconds:
+                            time.sleep(pause_seconds)
+                    stats[f"{table}.{column}"] = stats.get(f"{table}.{column}", 0) + rewritten
+    return stats
@@ -0,0 +1,388 @@
+"""
+Evaluation bench for picking the best model for CareBears care prompts.
+
+Every prompt type in PROMPT_TEMPLATES is run against every patient fixture
+(``testpatients/*.txt`` by default) for each model. Calls run in parallel with
+bounded concurrency and responses are cached on disk, keyed by model, prompt
+template, response schema and a hash of the patient context, so reruns only call the models
+for new or changed cases.
+
+Each fixture is stored in a throwaway database the way an upload stores it
+(record indexed for retrieval, lab lines ingested), and prompts are built
+with ``build_prompt_context`` like ``process_prompt``, so token and latency
+numbers match what production sends.
+
+Like the app, the bench asks for schema-constrained JSON and scores it with
+``parse_structured_response`` when ``CAREBEARS_STRUCTURED_OUTPUT`` is on
+(the default); ``--no-structured`` evaluates the legacy <context> tag mode.
+
+Run from the app directory, e.g.:
+    python evalbench.py --models gemini-2.0-flash,gemini-2.5-flash --concurrency 4
+    python evalbench.py --models fake        # fully offline
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import statistics
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from pydantic import BaseModel
+
+from database import add_patient, get_patient, init_db
+from labs import extract_lab_results, ingest_lab_results
+from models import PROMPT_TEMPLATES
+from retrieval import index_patient_document
+from services import (
+    STRUCTURED_OUTPUT, build_enhanced_context, build_full_prompt, build_prompt_context, extract_context,
+    parse_structured_response, prompt_request
+)
+
+FIXTURES_DIR = Path(__file__).resolve().parent.parent / "testpatients"
+CACHE_DIR = Path("./data/eval_cache")
+
+# A representative user message for each prompt type
+DEFAULT_INPUTS = {
+    "base": "Can you summarize where I am in my treatment and what I should focus on this week?",
+    "find_care_groups": "Are there any support groups near me?",
+    "medication_reminder": "Help me set up a schedule for my medications.",
+    "appointment_preparation": "I have a follow-up with my oncologist next week. What should I ask?",
+    "symptom_check": "I have had a fever of 101F and chills since last night.",
+}
+
+class EvalCase(BaseModel):
+    fixture: str
+    prompt_type: str
+    user_input: str
+    patient: Dict[str, Any]
+    record: str
+    # Set once the fixture is stored in the bench database
+    patient_id: Optional[int] = None
+
+class EvalResult(BaseModel):
+    model: str
+    fixture: str
+    prompt_type: str
+    response: str
+    latency_seconds: float
+    prompt_tokens: int
+    output_tokens: int
+    cached: bool
+    # Structured mode: the response matched the schema; otherwise <context> parsed as JSON
+    context_extracted: bool
+    rubric: Dict[str, bool]
+
+# --- Fixtures ---
+
+def load_fixture(path: Path) -> Dict[str, Any]:
+    """Build a patient record from a plain-text medical record without calling a model"""
+    text = path.read_text(encoding="utf-8")
+
+    def field(pattern, default=""):
+        match = re.search(pattern, text, re.MULTILINE)
+        return match.group(1).strip() if match else default
+
+    return {
+        "name": field(r'^Patient:\s*(.+)$', path.stem.title()),
+        "dob": field(r'Date of birth:\s*(.+)$'),
+        "location": field(r'Location:\s*(.+)$'),
+        "diagnosis": field(r'^Problem List:\s*\n-\s*(.+)$'),
+        "care_gaps": None,
+        "context": {"source": "file_upload"},
+    }
+
+def build_cases(fixtures_dir: Path = FIXTURES_DIR, prompt_types: Optional[List[str]] = None) -> List[EvalCase]:
+    """Cross every fixture with every prompt type"""
+    cases = []
+    for path in sorted(fixtures_dir.glob("*.txt")):
+        patient = load_fixture(path)
+        record = path.read_text(encoding="utf-8")
+        for prompt_type in prompt_types or PROMPT_TEMPLATES:
+            cases.append(EvalCase(
+                fixture=path.name,
+                prompt_type=prompt_type,
+                user_input=DEFAULT_INPUTS.get(prompt_type, "How can you help me today?"),
+                patient=patient,
+                record=record,
+            ))
+    return cases
+
+@contextmanager
+def bench_database():
+    """Point the database layer at an empty database in a temporary directory"""
+    old_cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            Path("data").mkdir()
+            init_db()
+            yield
+        finally:
+            os.chdir(old_cwd)
+
+def store_fixtures(cases: List[EvalCase]):
+    """Store each fixture as a patient the way the upload route does"""
+    patient_ids = {}
+    for case in cases:
+        if case.fixture not in patient_ids:
+            patient = case.patient
+            patient_id = add_patient(
+                name=patient["name"], dob=patient["dob"], location=patient["location"],
+                diagnosis=patient["diagnosis"], care_gaps=patient["care_gaps"], context=patient["context"]
+            )
+            index_patient_document(patient_id, case.record, source=case.fixture)
+            ingest_lab_results(patient_id, extract_lab_results(case.record), skip_mismatched_units=True)
+            patient_ids[case.fixture] = patient_id
+        case.patient_id = patient_ids[case.fixture]
+
+# --- Model backends ---
+
+class GeminiBackend:
+    """Calls a Gemini model through the google-genai client"""
+
+    def __init__(self, model: str):
+        from google import genai
+
+        self.model = model
+        self.client = genai.Client(api_key=os.getenv("GOOGLE_API_KEY"))
+
+    def generate(self, prompt: str, config: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        response = self.client.models.generate_content(model=self.model, contents=prompt, config=config)
+        usage = getattr(response, "usage_metadata", None)
+        return {
+            "text": response.text or "",
+            "prompt_tokens": getattr(usage, "prompt_token_count", None) or len(prompt) // 4,
+            "output_tokens": getattr(usage, "candidates_token_count", None) or len(response.text or "") // 4,
+        }
+
+class FakeBackend:
+    """Deterministic offline stand-in for a model, for CI and dry runs"""
+
+    def __init__(self, model: str = "fake", latency_seconds: float = 0.0):
+        self.model = model
+        self.latency_seconds = latency_seconds
+
+    def generate(self, prompt: str, config: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        context_match = re.search(r'PATIENT CONTEXT:\n(.*)\n\nUSER INPUT:', prompt, re.DOTALL)
+        context = json.loads(context_match.group(1)) if context_match else {}
+        name = context.get("name", "there")
+        markdown = (
+            f"## Hi {name}\n\n"
+            f"Here is a plan based on your diagnosis of **{context.get('diagnosis', 'your condition')}**.\n\n"
+            "### Next steps\n"
+            f"- Look for support groups near {context.get('zip_code', 'you')}\n"
+            "- Take your medication on schedule and watch for side effects\n"
+            "- Ask your doctor: what symptoms should make me call you?\n"
+            "- Seek urgent care or call 911 if you develop a high fever\n"
+        )
+        if config:
+            text = json.dumps({"display_markdown": markdown, "context_patch": {}})
+        else:
+            text = f"{markdown}\n<context>{json.dumps({'last_advice': 'next steps shared'})}</context>"
+        return {"text": text, "prompt_tokens": len(prompt) // 4, "output_tokens": len(text) // 4}
+
+def make_backend(model: str, fake_latency: float = 0.0):
+    """Return the backend for a model name; names starting with 'fake' run offline"""
+    if model.startswith("fake"):
+        return FakeBackend(model, fake_latency)
+    return GeminiBackend(model)
+
+# --- Response cache ---
+
+def cache_key(model: str, prompt_template: str, context: Dict[str, Any], user_input: str,
+              config: Optional[Dict[str, Any]] = None) -> str:
+    """Hash of model, prompt, response schema and context that identifies a cached response"""
+    context_hash = hashlib.sha256(json.dumps(context, sort_keys=True).encode("utf-8")).hexdigest()
+    schema = config["response_schema"].model_json_schema() if config else None
+    material = json.dumps([model, prompt_template, context_hash, user_input, schema], sort_keys=True)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+def _cache_get(cache_dir: Path, key: str) -> Optional[Dict[str, Any]]:
+    path = cache_dir / key[:2] / f"{key}.json"
+    if path.exists():
+        return json.loads(path.read_text(encoding="utf-8"))
+    return None
+
+def _cache_put(cache_dir: Path, key: str, value: Dict[str, Any]):
+    path = cache_dir / key[:2] / f"{key}.json"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(value), encoding="utf-8")
+    tmp_path.replace(path)
+
+# --- Scoring ---
+
+def _display_text(response: str) -> str:
+    return re.sub(r'<context>.*?</context>', '', response, flags=re.DOTALL)
+
+COMMON_CHECKS: List[Tuple[str, Callable[[str, Dict[str, Any]], bool]]] = [
+    ("non_empty", lambda text, ctx: bool(_display_text(text).strip())),
+    ("uses_markdown_headers", lambda text, ctx: bool(re.search(r'^#{2,3} ', text, re.MULTILINE))),
+    ("uses_lists", lambda text, ctx: bool(re.search(r'^\s*[-*] ', text, re.MULTILINE))),
+    ("addresses_patient", lambda text, ctx: ctx.get("name", "").split()[0].lower() in text.lower()
+                                            if ctx.get("name") else True),
+]
+
+RUBRIC_CHECKS: Dict[str, List[Tuple[str, Callable[[str, Dict[str, Any]], bool]]]] = {
+    "find_care_groups": [
+        ("mentions_support_group", lambda text, ctx: "support group" in text.lower()),
+        ("uses_zip_code", lambda text, ctx: ctx.get("zip_code", "") in text if ctx.get("zip_code") else True),
+    ],
+    "medication_reminder": [
+        ("mentions_side_effects", lambda text, ctx: "side effect" in text.lower()),
+    ],
+    "appointment_preparation": [
+        ("suggests_questions", lambda text, ctx: "?" in _display_text(text)),
+    ],
+    "symptom_check": [
+        ("gives_escalation_guidance", lambda text, ctx: bool(re.search(r'911|emergency|urgent|seek', text, re.I))),
+    ],
+}
+
+def score_response(prompt_type: str, response: str, context: Dict[str, Any],
+                   structured: bool = False) -> Tuple[bool, Dict[str, bool]]:
+    """
+    Return (context extracted cleanly, rubric check results)
+
+    Structured responses are parsed like the app does, and the rubric is
+    checked against the markdown shown to the patient.
+    """
+    if structured:
+        parsed = parse_structured_response(response, prompt_type)
+        context_extracted = parsed is not None
+        response = parsed[0] if parsed else ""
+    else:
+        extracted = extract_context(response)
+        context_extracted = bool(extracted) and "raw_context" not in extracted
+    rubric = {
+        name: bool(check(response, context))
+        for name, check in COMMON_CHECKS + RUBRIC_CHECKS.get(prompt_type, [])
+    }
+    return context_extracted, rubric
+
+# --- Runner ---
+
+def run_case(backend, case: EvalCase, cache_dir: Path, structured: bool = STRUCTURED_OUTPUT) -> EvalResult:
+    """Run one case against one model, using the cache when possible; its fixture must be stored"""
+    # Same template and response schema as the app sends
+    prompt_template, config = prompt_request(case.prompt_type, structured)
+    context = build_enhanced_context(get_patient(case.patient_id))
+    prompt_context = build_prompt_context(case.patient_id, context, case.user_input)
+    key = cache_key(backend.model, prompt_template, prompt_context, case.user_input, config)
+
+    cached = _cache_get(cache_dir, key)
+    if cached is None:
+        prompt = build_full_prompt(prompt_template, prompt_context, case.user_input)
+        start = time.perf_counter()
+        output = backend.generate(prompt, config)
+        output["latency_seconds"] = time.perf_counter() - start
+        _cache_put(cache_dir, key, output)
+
+    output = cached or output
+    context_extracted, rubric = score_response(case.prompt_type, output["text"], context, config is not None)
+    return EvalResult(
+        model=backend.model,
+        fixture=case.fixture,
+        prompt_type=case.prompt_type,
+        response=output["text"],
+        latency_seconds=output["latency_seconds"],
+        prompt_tokens=output["prompt_tokens"],
+        output_tokens=output["output_tokens"],
+        cached=cached is not None,
+        context_extracted=context_extracted,
+        rubric=rubric,
+    )
+
+def _run_case_safely(backend, case: EvalCase, cache_dir: Path, structured: bool) -> Optional[EvalResult]:
+    try:
+        return run_case(backend, case, cache_dir, structured)
+    except Exception as e:
+        print(f"[{backend.model}] {case.fixture}/{case.prompt_type} failed: {e}")
+        return None
+
+def run_bench(backends, cases: List[EvalCase], concurrency: int = 4, cache_dir: Path = CACHE_DIR,
+              structured: bool = STRUCTURED_OUTPUT) -> List[EvalResult]:
+    """Run every case against every backend with at most `concurrency` calls in flight"""
+    cache_dir = Path(cache_dir).resolve()
+    with bench_database(), ThreadPoolExecutor(max_workers=concurrency) as pool:
+        store_fixtures(cases)
+        futures = [
+            pool.submit(_run_case_safely, backend, case, cache_dir, structured)
+            for backend in backends
+            for case in cases
+        ]
+        return [result for result in (future.result() for future in futures) if result]
+
+def summarize(results: List[EvalResult]) -> Dict[str, Dict[str, Any]]:
+    """Aggregate per-model latency, token usage and quality scores"""
+    summary = {}
+    for model in sorted({result.model for result in results}):
+        model_results = [result for result in results if result.model == model]
+        latencies = sorted(result.latency_seconds for result in model_results)
+        checks = [passed for result in model_results for passed in result.rubric.values()]
+        summary[model] = {
+            "cases": len(model_results),
+            "cached": sum(result.cached for result in model_results),
+            "latency_p50": statistics.median(latencies),
+            "latency_p95": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+            "avg_prompt_tokens": statistics.mean(result.prompt_tokens for result in model_results),
+            "avg_output_tokens": statistics.mean(result.output_tokens for result in model_results),
+            "context_extraction_rate": sum(result.context_extracted for result in model_results) / len(model_results),
+            "rubric_pass_rate": sum(checks) / len(checks) if checks else 0.0,
+        }
+    return summary
+
+def pick_model(summary: Dict[str, Dict[str, Any]], min_extraction: float, min_rubric: float) -> Optional[str]:
+    """Fastest model (by p50 latency) that meets the quality bar"""
+    qualified = [
+        (stats["latency_p50"], model)
+        for model, stats in summary.items()
+        if stats["context_extraction_rate"] >= min_extraction and stats["rubric_pass_rate"] >= min_rubric
+    ]
+    return min(qualified)[1] if qualified else None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--models", default="fake", help="Comma-separated model names; 'fake*' runs offline")
+    parser.add_argument("--fixtures", type=Path, default=FIXTURES_DIR)
+    parser.add_argument("--prompt-types", default=None, help="Comma-separated subset of PROMPT_TEMPLATES")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--cache-dir", type=Path, default=CACHE_DIR)
+    parser.add_argument("--fake-latency", type=float, default=0.05, help="Simulated latency for fake models")
+    parser.add_argument("--min-extraction", type=float, default=0.9)
+    parser.add_argument("--min-rubric", type=float, default=0.8)
+    parser.add_argument("--output", type=Path, help="Write per-case results as JSON")
+    parser.add_argument("--structured", action=argparse.BooleanOptionalAction, default=STRUCTURED_OUTPUT,
+                        help="Request and score schema-constrained JSON like the app (default: CAREBEARS_STRUCTURED_OUTPUT)")
+    args = parser.parse_args()
+
+    backends = [make_backend(model.strip(), args.fake_latency) for model in args.models.split(",") if model.strip()]
+    prompt_types = args.prompt_types.split(",") if args.prompt_types else None
+    cases = build_cases(args.fixtures, prompt_types)
+    results = run_bench(backends, cases, args.concurrency, args.cache_dir, args.structured)
+    summary = summarize(results)
+
+    print(f"{'model':<24} {'cases':>5} {'cached':>6} {'p50':>7} {'p95':>7} {'in tok':>7} {'out tok':>7} {'ctx ok':>6} {'rubric':>6}")
+    for model, stats in summary.items():
+        print(
+            f"{model:<24} {stats['cases']:>5} {stats['cached']:>6} "
+            f"{stats['latency_p50']:>6.2f}s {stats['latency_p95']:>6.2f}s "
+            f"{stats['avg_prompt_tokens']:>7.0f} {stats['avg_output_tokens']:>7.0f} "
+            f"{stats['context_extraction_rate']:>6.0%} {stats['rubric_pass_rate']:>6.0%}"
+        )
+    best = pick_model(summary, args.min_extraction, args.min_rubric)
+    print(f"\nFastest model meeting the quality bar: {best or 'none'}")
+
+    if args.output:
+        args.output.write_text(json.dumps([result.model_dump() for result in results], indent=2), encoding="utf-8")
+
+if __name__ == "__main__":
+    main()
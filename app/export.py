@@ -0,0 +1,242 @@
+"""
+Streaming bulk export of patients and interactions.
+
+Records are read shard by shard in keyset-paginated batches
+(``EXPORT_BATCH_SIZE`` rows per query), so memory stays flat and no read
+transaction is held open while the client consumes the stream; writers and
+WAL checkpoints only ever wait for one batch. Stored JSON columns are spliced
+into NDJSON output as-is, and archived interactions are filled in from the
+archive.
+
+Exports can be incremental: with ``since`` only patients updated and
+interactions created at or after that time are included. Take the watermark
+with ``export_watermark()`` before starting and pass it as ``since`` next
+time. Rows written while an export runs may appear in both exports, so
+consumers should upsert by (patient_id, id).
+
+Formats:
+
+* ``ndjson``: one ``{"type": "patient" | "interaction", ...}`` object per line
+* ``fhir``: one FHIR R4 ``collection`` Bundle per batch and line, holding
+  Patient and Condition resources for patients and Communication resources
+  for interactions. Context snapshots are not part of the FHIR output.
+"""
+import logging
+import os
+import zlib
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional
+
+from database import all_shards, get_db_connection, decompress_text, _load_json_column
+from archive import load_archived_interaction
+from serialization import dumps, json_object
+
+try:
+    import zstandard
+except ImportError:  # zstd output is optional, gzip always works
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+EXPORT_BATCH_SIZE = int(os.getenv("CAREBEARS_EXPORT_BATCH_SIZE", "500"))
+FORMATS = ("ndjson", "fhir")
+COMPRESSIONS = ("none", "gzip", "zstd")
+MEDIA_TYPES = {"ndjson": "application/x-ndjson", "fhir": "application/fhir+ndjson"}
+# Compressed exports are files in their own right, not a transfer encoding
+COMPRESSED_MEDIA_TYPES = {"gzip": "application/gzip", "zstd": "application/zstd"}
+FILE_SUFFIXES = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+
+# SQLite CURRENT_TIMESTAMP format, so watermarks compare as text
+_TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+def export_watermark() -> str:
+    """Current time as a ``since`` value for the next incremental export"""
+    return datetime.now(timezone.utc).strftime(_TIMESTAMP_FORMAT)
+
+def normalize_since(value) -> Optional[str]:
+    """Turn an ISO date/datetime (naive means UTC) into the stored timestamp format"""
+    if value is None or value == "":
+        return None
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc)
+    return value.strftime(_TIMESTAMP_FORMAT)
+
+# --- Batched reads ---
+
+def iter_patient_batches(since: Optional[str] = None, batch_size: int = EXPORT_BATCH_SIZE) -> Iterator[List[Dict[str, Any]]]:
+    """Patients updated at or after ``since``, in id order per shard"""
+    for shard in all_shards():
+        last_id = 0
+        while True:
+            with get_db_connection(shard) as conn:
+                rows = conn.execute(
+                    '''
+                    SELECT * FROM patients
+                    WHERE id > ? AND COALESCE(updated_at, created_at) >= ?
+                    ORDER BY id LIMIT ?
+                    ''',
+                    (last_id, since or "", batch_size)
+                ).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1]["id"]
+            yield [dict(row) for row in rows]
+
+def iter_interaction_batches(since: Optional[str] = None, batch_size: int = EXPORT_BATCH_SIZE) -> Iterator[List[Dict[str, Any]]]:
+    """Interactions created at or after ``since``, in (created_at, id) order per shard"""
+    for shard in all_shards():
+        last = (since or "", 0)
+        while True:
+            with get_db_connection(shard) as conn:
+                rows = conn.execute(
+                    '''
+                    SELECT * FROM interactions
+                    WHERE (created_at, id) > (?, ?)
+                    ORDER BY created_at, id LIMIT ?
+                    ''',
+                    (*last, batch_size)
+                ).fetchall()
+            if not rows:
+                break
+            last = (rows[-1]["created_at"], rows[-1]["id"])
+            yield [dict(row) for row in rows]
+
+def _hydrate(row):
+    """Fill in an archived interaction; returns (row, contexts already parsed)"""
+    if not row.get("archive_ref"):
+        return row, False
+    archived = load_archived_interaction(row["id"], row["archive_ref"])
+    if archived is None:
+        # The summary stays in place of the response
+        return row, False
+    return {**row, **{key: archived.get(key) for key in ("response", "context_before", "context_after")}}, True
+
+# --- NDJSON ---
+
+def _ndjson_patients(batch):
+    lines = []
+    for row in batch:
+        context = decompress_text(row.pop("context"))
+        lines.append(json_object({"type": "patient", **row}, raw={"context": context or None}))
+    return lines
+
+def _ndjson_interactions(batch):
+    lines = []
+    for row in batch:
+        row, parsed = _hydrate(row)
+        row["response"] = decompress_text(row["response"])
+        contexts = {key: row.pop(key) for key in ("context_before", "context_after")}
+        if parsed:
+            lines.append(dumps({"type": "interaction", **row, **contexts}))
+        else:
+            raw = {key: decompress_text(value) or None for key, value in contexts.items()}
+            lines.append(json_object({"type": "interaction", **row}, raw=raw))
+    return lines
+
+# --- FHIR ---
+
+def _fhir_instant(timestamp):
+    return timestamp.replace(" ", "T") + "Z" if timestamp else None
+
+def _fhir_date(dob):
+    for date_format in ("%m/%d/%Y", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(dob, date_format).strftime("%Y-%m-%d")
+        except (TypeError, ValueError):
+            continue
+    return None
+
+def _fhir_patient(row):
+    resources = [{
+        "resourceType": "Patient",
+        "id": str(row["id"]),
+        "meta": {"lastUpdated": _fhir_instant(row.get("updated_at") or row["created_at"])},
+        "name": [{"text": row["name"]}],
+        **({"birthDate": _fhir_date(row["dob"])} if _fhir_date(row["dob"]) else {}),
+        "address": [{"text": row["location"]}],
+    }]
+    if row["diagnosis"]:
+        resources.append({
+            "resourceType": "Condition",
+            "id": f"{row['id']}-diagnosis",
+            "subject": {"reference": f"Patient/{row['id']}"},
+            "code": {"text": row["diagnosis"]},
+        })
+    return resources
+
+def _fhir_communication(row):
+    row, _ = _hydrate(row)
+    return {
+        "resourceType": "Communication",
+        "id": f"{row['patient_id']}-{row['id']}",
+        "status": "completed",
+        "subject": {"reference": f"Patient/{row['patient_id']}"},
+        "sent": _fhir_instant(row["created_at"]),
+        "category": [{"text": row["prompt_type"]}],
+        "payload": [{"contentString": row["user_input"]}, {"contentString": decompress_text(row["response"])}],
+    }
+
+def _fhir_bundle(resources):
+    return dumps({
+        "resourceType": "Bundle",
+        "type": "collection",
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "entry": [{"resource": resource} for resource in resources],
+    })
+
+# --- Streams ---
+
+def iter_export(since=None, fmt: str = "ndjson", batch_size: int = EXPORT_BATCH_SIZE,
+                counts: Optional[Dict[str, int]] = None) -> Iterator[bytes]:
+    """
+    Yield the export as uncompressed chunks, one per batch
+
+    Args:
+        since: Only include changes at or after this time (see ``normalize_since``)
+        fmt: ``ndjson`` or ``fhir``
+        counts: Updated with the number of patients and interactions written
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown export format {fmt!r}, expected one of {FORMATS}")
+    since = normalize_since(since)
+    counts = counts if counts is not None else {}
+    counts.setdefault("patients", 0)
+    counts.setdefault("interactions", 0)
+
+    for batch in iter_patient_batches(since, batch_size):
+        counts["patients"] += len(batch)
+        if fmt == "fhir":
+            yield _fhir_bundle([resource for row in batch for resource in _fhir_patient(row)]) + b"\n"
+        else:
+            yield b"\n".join(_ndjson_patients(batch)) + b"\n"
+    for batch in iter_interaction_batches(since, batch_size):
+        counts["interactions"] += len(batch)
+        if fmt == "fhir":
+            yield _fhir_bundle([_fhir_communication(row) for row in batch]) + b"\n"
+        else:
+            yield b"\n".join(_ndjson_interactions(batch)) + b"\n"
+
+def _compressor(compression):
+    if compression == "gzip":
+        return zlib.compressobj(6, zlib.DEFLATED, 31)
+    if compression == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstd export requires the zstandard package")
+        return zstandard.ZstdCompressor(level=3).compressobj()
+    raise ValueError(f"Unknown compression {compression!r}, expected one of {COMPRESSIONS}")
+
+def export_stream(since=None, fmt: str = "ndjson", compression: Optional[str] = None,
+                  batch_size: int = EXPORT_BATCH_SIZE, counts: Optional[Dict[str, int]] = None) -> Iterator[bytes]:
+    """``iter_export``, compressed on the fly with gzip or zstd"""
+    chunks = iter_export(since, fmt, batch_size, counts)
+    if compression in (None, "none"):
+        yield from chunks
+        return
+    compressor = _compressor(compression)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
@@ -0,0 +1,156 @@
+"""
+HTTP caching helpers: patient-version validators and precompressed static files.
+
+Patient pages and APIs use a weak ETag built from the patient's ``version``
+column (bumped on every context update and interaction write), so a repeat
+request only costs one primary-key lookup and a 304.
+
+Static assets are served with long-lived cache headers when requested with a
+content-hash ``?v=`` query (see ``static_version``), and from build-time
+``.br``/``.gz`` siblings written by ``precompress.py`` when the client accepts
+them.
+"""
+import hashlib
+import mimetypes
+import os
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from functools import lru_cache
+
+from fastapi import Request, Response
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+
+from database import get_patient_version
+
+STATIC_MAX_AGE = 365 * 24 * 3600
+UNVERSIONED_STATIC_MAX_AGE = 3600
+PRECOMPRESSED_ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+def tree_version(*directories):
+    """Short content hash of every file under the given directories"""
+    digest = hashlib.sha256()
+    for directory in directories:
+        for root, _, files in sorted(os.walk(directory)):
+            for name in sorted(files):
+                if name.endswith((".br", ".gz")):
+                    continue
+                path = os.path.join(root, name)
+                digest.update(path[len(directory):].encode("utf-8"))
+                with open(path, "rb") as f:
+                    digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+def patient_validators(patient_id, variant=""):
+    """
+    Build the ETag and Last-Modified values for a patient resource
+
+    Args:
+        patient_id: Patient whose version identifies the resource
+        variant: Extra discriminator for different representations
+                 (e.g. the interactions limit or the template version)
+
+    Returns:
+        (etag, last_modified) tuple, or None if the patient does not exist
+    """
+    version = get_patient_version(patient_id)
+    if not version:
+        return None
+    etag = f'W/"p{patient_id}-v{version["version"]}{variant}"'
+    updated_at = datetime.strptime(str(version["updated_at"])[:19], "%Y-%m-%d %H:%M:%S")
+    last_modified = format_datetime(updated_at.replace(tzinfo=timezone.utc), usegmt=True)
+    return etag, last_modified
+
+def is_not_modified(request: Request, etag, last_modified):
+    """Evaluate If-None-Match (preferred) or If-Modified-Since against the validators"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        return "*" in tags or etag.removeprefix("W/") in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return parsedate_to_datetime(last_modified) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def cache_headers(etag, last_modified):
+    """Headers for private, always-revalidated patient resources"""
+    return {
+        "ETag": etag,
+        "Last-Modified": last_modified,
+        "Cache-Control": "private, no-cache",
+    }
+
+def not_modified_response(etag, last_modified):
+    return Response(status_code=304, headers=cache_headers(etag, last_modified))
+
+def accepted_encodings(accept_encoding):
+    """Map each content coding in an Accept-Encoding header to its q-value"""
+    accepted = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[coding] = quality
+    return accepted
+
+class CachedStaticFiles(StaticFiles):
+    """StaticFiles that serves precompressed variants and long-lived cache headers"""
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        request_headers = Headers(scope=scope)
+        accepted = accepted_encodings(request_headers.get("accept-encoding", ""))
+        headers = {"Vary": "Accept-Encoding"}
+
+        response = None
+        for encoding, suffix in PRECOMPRESSED_ENCODINGS:
+            # q=0 means "not acceptable"; "*" covers codings not listed
+            if accepted.get(encoding, accepted.get("*", 0)) <= 0:
+                continue
+            variant_path = f"{full_path}{suffix}"
+            try:
+                variant_stat = os.stat(variant_path)
+            except OSError:
+                continue
+            if variant_stat.st_mtime < stat_result.st_mtime:
+                continue  # stale build artifact
+            response = FileResponse(
+                variant_path,
+                status_code=status_code,
+                stat_result=variant_stat,
+                media_type=mimetypes.guess_type(str(full_path))[0],
+                headers={**headers, "Content-Encoding": encoding},
+            )
+            break
+        if response is None:
+            response = FileResponse(full_path, status_code=status_code, stat_result=stat_result, headers=headers)
+
+        if b"v=" in scope.get("query_string", b""):
+            response.headers["Cache-Control"] = f"public, max-age={STATIC_MAX_AGE}, immutable"
+        else:
+            response.headers["Cache-Control"] = f"public, max-age={UNVERSIONED_STATIC_MAX_AGE}"
+
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
+
+def make_static_version(static_dir):
+    """Return a Jinja helper giving the content hash used to version a static URL"""
+    @lru_cache(maxsize=None)
+    def static_version(path):
+        full_path = os.path.join(static_dir, path.lstrip("/"))
+        with open(full_path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()[:12]
+    return static_version
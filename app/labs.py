@@ -0,0 +1,323 @@
+"""
+Lab and vitals time series with vectorized trend analysis.
+
+Each patient has one ``lab_series`` row per analyte holding the whole
+history as two packed arrays (int64 epoch seconds, float64 values), sorted by
+time. Ingestion merges a batch of readings into the arrays in one write per
+analyte, and every statistic (trend slope, rolling means, out-of-range flags)
+is computed over whole arrays with NumPy.
+
+Only ``lab_trend_summary`` output goes into prompts: one short line per
+analyte, never the raw history.
+"""
+import logging
+import re
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+
+from database import get_patient_connection, patient_write_connection
+
+logger = logging.getLogger(__name__)
+
+DAY_SECONDS = 86400
+ROLLING_WINDOW_DAYS = 90
+PROMPT_ANALYTES = 8
+
+# Canonical analyte -> (display name, unit, reference low, reference high)
+REFERENCE_RANGES = {
+    "hba1c": ("HbA1c", "%", 4.0, 5.6),
+    "glucose": ("Fasting glucose", "mg/dL", 70.0, 99.0),
+    "ldl": ("LDL cholesterol", "mg/dL", None, 100.0),
+    "hdl": ("HDL cholesterol", "mg/dL", 40.0, None),
+    "triglycerides": ("Triglycerides", "mg/dL", None, 150.0),
+    "creatinine": ("Creatinine", "mg/dL", 0.6, 1.2),
+    "egfr": ("eGFR", "mL/min/1.73m2", 60.0, None),
+    "hemoglobin": ("Hemoglobin", "g/dL", 12.0, 17.5),
+    "wbc": ("White blood cells", "10^3/uL", 4.0, 11.0),
+    "platelets": ("Platelets", "10^3/uL", 150.0, 450.0),
+    "anc": ("Absolute neutrophil count", "10^3/uL", 1.5, 8.0),
+    "systolic_bp": ("Systolic blood pressure", "mmHg", 90.0, 120.0),
+    "diastolic_bp": ("Diastolic blood pressure", "mmHg", 60.0, 80.0),
+    "heart_rate": ("Heart rate", "bpm", 60.0, 100.0),
+    "weight": ("Weight", "lb", None, None),
+}
+
+ANALYTE_ALIASES = {
+    "a1c": "hba1c",
+    "hemoglobin_a1c": "hba1c",
+    "fasting_glucose": "glucose",
+    "blood_glucose": "glucose",
+    "ldl_cholesterol": "ldl",
+    "hdl_cholesterol": "hdl",
+    "hgb": "hemoglobin",
+    "white_blood_cells": "wbc",
+    "plt": "platelets",
+    "absolute_neutrophil_count": "anc",
+    "systolic": "systolic_bp",
+    "diastolic": "diastolic_bp",
+    "pulse": "heart_rate",
+    "hr": "heart_rate",
+}
+
+def normalize_analyte(name: str) -> str:
+    """Canonical key for an analyte name, e.g. "Hemoglobin A1c" -> "hba1c" """
+    key = re.sub(r"[^a-z0-9]+", "_", name.lower()).strip("_")
+    return ANALYTE_ALIASES.get(key, key)
+
+def _parse_time(value) -> int:
+    """Epoch seconds for an ISO date/datetime, MM/DD/YYYY date or number"""
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, datetime):
+        moment = value
+    else:
+        try:
+            moment = datetime.strptime(value, "%m/%d/%Y")
+        except ValueError:
+            moment = datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return int(moment.timestamp())
+
+def _iso(seconds) -> str:
+    return datetime.fromtimestamp(int(seconds), tz=timezone.utc).strftime("%Y-%m-%d")
+
+# --- Extraction ---
+
+_LAB_LINE = re.compile(
+    r"(?P<analyte>[A-Za-z][A-Za-z0-9 ]{0,30}?)\s*[:=]?\s+(?P<value>-?\d+(?:\.\d+)?)\s*"
+    r"(?P<unit>%|[A-Za-z][A-Za-z0-9^/.]*)?[^\n]*?(?P<date>\d{1,2}/\d{1,2}/\d{4}|\d{4}-\d{2}-\d{2})"
+)
+
+def extract_lab_results(text: str) -> List[Dict[str, Any]]:
+    """
+    Find dated lab lines such as ``HbA1c: 6.1 % (03/01/2024)`` in a record
+
+    Only known analytes with a real date are returned, so prose with numbers
+    and dates in it is not mistaken for results.
+    """
+    results = []
+    for line in text.splitlines():
+        match = _LAB_LINE.match(line.strip().lstrip("-*• "))
+        if not match:
+            continue
+        analyte = normalize_analyte(match.group("analyte"))
+        if analyte not in REFERENCE_RANGES:
+            continue
+        try:
+            _parse_time(match.group("date"))
+        except ValueError:
+            continue  # e.g. 02/30/2024
+        results.append({
+            "analyte": analyte,
+            "value": float(match.group("value")),
+            "unit": match.group("unit"),
+            "taken_at": match.group("date"),
+        })
+    return results
+
+# --- Storage ---
+
+def _same_unit(a: Optional[str], b: Optional[str]) -> bool:
+    return a is None or b is None or a.lower() == b.lower()
+
+def ingest_lab_results(patient_id: int, results: Iterable[Dict[str, Any]],
+                       skip_mismatched_units: bool = False) -> Dict[str, int]:
+    """
+    Merge readings into a patient's series
+
+    Args:
+        results: Dicts with ``analyte``, ``value``, ``taken_at`` and optional
+                 ``unit``, ``ref_low``, ``ref_high``. A reading at the same
+                 time as an existing one replaces it.
+        skip_mismatched_units: Drop an analyte's readings whose unit differs
+                 from its series instead of rejecting the whole batch
+
+    Returns:
+        Dictionary of analyte -> readings in the series after ingestion
+
+    Raises:
+        ValueError: If a timestamp does not parse, or an analyte's readings
+                    are in a different unit than each other or than its
+                    stored series (values are never converted)
+    """
+    batches = {}
+    mismatched = {}  # analyte -> why its readings are rejected
+    for result in results:
+        analyte = normalize_analyte(result["analyte"])
+        batch = batches.setdefault(analyte, {"times": [], "values": [], "meta": {}})
+        if not _same_unit(batch["meta"].get("unit"), result.get("unit")):
+            mismatched[analyte] = f"{analyte} readings mix {batch['meta']['unit']} and {result['unit']}"
+        batch["times"].append(_parse_time(result["taken_at"]))
+        batch["values"].append(float(result["value"]))
+        for key in ("unit", "ref_low", "ref_high"):
+            if result.get(key) is not None:
+                batch["meta"][key] = result[key]
+    if not batches:
+        return {}
+
+    counts = {}
+    with patient_write_connection(patient_id) as conn:
+        rows = {}
+        for analyte, batch in batches.items():
+            rows[analyte] = conn.execute(
+                'SELECT unit, ref_low, ref_high, times, readings FROM lab_series WHERE patient_id = ? AND analyte = ?',
+                (patient_id, analyte)
+            ).fetchone()
+            if rows[analyte] and not _same_unit(rows[analyte]["unit"], batch["meta"].get("unit")):
+                mismatched[analyte] = f"{analyte} is stored in {rows[analyte]['unit']}, not {batch['meta']['unit']}"
+        if mismatched:
+            problems = "; ".join(mismatched[analyte] for analyte in sorted(mismatched))
+            if not skip_mismatched_units:
+                raise ValueError(problems)
+            logger.warning(f"Skipping lab readings for patient {patient_id}: {problems}")
+            for analyte in mismatched:
+                del batches[analyte]
+
+        for analyte, batch in batches.items():
+            row = rows[analyte]
+            _, default_unit, default_low, default_high = REFERENCE_RANGES.get(analyte, (None, None, None, None))
+            meta = {"unit": default_unit, "ref_low": default_low, "ref_high": default_high}
+            times = np.asarray(batch["times"], dtype=np.int64)
+            values = np.asarray(batch["values"], dtype=np.float64)
+            if row:
+                meta = {key: row[key] for key in meta}
+                # New readings go first so they win when deduplicating by time
+                times = np.concatenate([times, np.frombuffer(row["times"], dtype=np.int64)])
+                values = np.concatenate([values, np.frombuffer(row["readings"], dtype=np.float64)])
+            meta.update(batch["meta"])
+
+            times, first = np.unique(times, return_index=True)
+            values = values[first]
+            conn.execute(
+                '''
+                INSERT OR REPLACE INTO lab_series
+                (patient_id, analyte, unit, ref_low, ref_high, times, readings, count, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+                ''',
+                (patient_id, analyte, meta["unit"], meta["ref_low"], meta["ref_high"],
+                 times.tobytes(), values.tobytes(), len(times))
+            )
+            counts[analyte] = len(times)
+        conn.commit()
+    logger.info(f"Ingested {sum(len(b['times']) for b in batches.values())} lab readings for patient {patient_id}")
+    return counts
+
+def _load_series(patient_id: int, analyte: Optional[str] = None):
+    query = 'SELECT * FROM lab_series WHERE patient_id = ?'
+    params = [patient_id]
+    if analyte is not None:
+        query += ' AND analyte = ?'
+        params.append(normalize_analyte(analyte))
+    with get_patient_connection(patient_id) as conn:
+        rows = conn.execute(query + ' ORDER BY updated_at DESC, analyte', params).fetchall()
+    return [
+        (row, np.frombuffer(row["times"], dtype=np.int64), np.frombuffer(row["readings"], dtype=np.float64))
+        for row in rows
+    ]
+
+# --- Analysis ---
+
+def out_of_range(values, ref_low, ref_high):
+    """Boolean mask of values outside the reference range"""
+    mask = np.zeros(len(values), dtype=bool)
+    if ref_low is not None:
+        mask |= values < ref_low
+    if ref_high is not None:
+        mask |= values > ref_high
+    return mask
+
+def rolling_mean(times, values, window_days=ROLLING_WINDOW_DAYS):
+    """Mean of each reading and all readings in the window_days before it"""
+    sums = np.concatenate([[0.0], np.cumsum(values)])
+    starts = np.searchsorted(times, times - window_days * DAY_SECONDS, side="left")
+    ends = np.arange(1, len(values) + 1)
+    return (sums[ends] - sums[starts]) / (ends - starts)
+
+def trend_slope(times, values):
+    """Least-squares change per 30 days, or None with fewer than two readings"""
+    if len(values) < 2 or times[-1] == times[0]:
+        return None
+    days = (times - times[0]) / DAY_SECONDS
+    centered = days - days.mean()
+    slope_per_day = float(np.dot(centered, values - values.mean()) / np.dot(centered, centered))
+    return slope_per_day * 30
+
+def _direction(slope, values, ref_low, ref_high):
+    if slope is None:
+        return "single reading"
+    # Changes smaller than 2% of the reference span (or the mean) per month are noise
+    scale = (ref_high - ref_low) if ref_low is not None and ref_high is not None else abs(float(values.mean()))
+    if abs(slope) <= 0.02 * (scale or 1.0):
+        return "stable"
+    return "rising" if slope > 0 else "falling"
+
+def summarize_series(row, times, values, window_days=ROLLING_WINDOW_DAYS) -> Dict[str, Any]:
+    """Trend statistics for one analyte"""
+    flags = out_of_range(values, row["ref_low"], row["ref_high"])
+    recent = times >= times[-1] - window_days * DAY_SECONDS
+    slope = trend_slope(times, values)
+    return {
+        "analyte": row["analyte"],
+        "name": REFERENCE_RANGES.get(row["analyte"], (row["analyte"],))[0],
+        "unit": row["unit"],
+        "ref_low": row["ref_low"],
+        "ref_high": row["ref_high"],
+        "count": int(len(values)),
+        "first_at": _iso(times[0]),
+        "latest_at": _iso(times[-1]),
+        "latest": float(values[-1]),
+        "previous": float(values[-2]) if len(values) > 1 else None,
+        "min": float(values.min()),
+        "max": float(values.max()),
+        "window_mean": round(float(values[recent].mean()), 3),
+        "slope_per_30_days": round(slope, 3) if slope is not None else None,
+        "direction": _direction(slope, values, row["ref_low"], row["ref_high"]),
+        "latest_out_of_range": bool(flags[-1]),
+        "out_of_range_count": int(flags.sum()),
+    }
+
+def get_lab_trends(patient_id: int, window_days: int = ROLLING_WINDOW_DAYS) -> List[Dict[str, Any]]:
+    """Trend summaries for every analyte of a patient, most recently updated first"""
+    return [summarize_series(row, times, values, window_days) for row, times, values in _load_series(patient_id)]
+
+def get_lab_series(patient_id: int, analyte: str, window_days: int = ROLLING_WINDOW_DAYS) -> Optional[Dict[str, Any]]:
+    """Full series for one analyte with rolling means and out-of-range flags"""
+    series = _load_series(patient_id, analyte)
+    if not series:
+        return None
+    row, times, values = series[0]
+    flags = out_of_range(values, row["ref_low"], row["ref_high"])
+    means = rolling_mean(times, values, window_days)
+    return {
+        **summarize_series(row, times, values, window_days),
+        "window_days": window_days,
+        "points": [
+            {"taken_at": _iso(t), "value": float(v), "rolling_mean": round(float(m), 3), "out_of_range": bool(f)}
+            for t, v, m, f in zip(times, values, means, flags)
+        ],
+    }
+
+def _format_value(value):
+    return f"{value:g}"
+
+def lab_trend_summary(patient_id: int, limit: int = PROMPT_ANALYTES) -> List[str]:
+    """
+    One line per analyte for the prompt context, e.g.
+    ``HbA1c 6.4 % on 2024-03-01 (ref 4-5.6, OUT OF RANGE), rising +0.2/30d over 5 readings``
+    """
+    lines = []
+    for trend in get_lab_trends(patient_id)[:limit]:
+        line = f"{trend['name']} {_format_value(trend['latest'])}{' ' + trend['unit'] if trend['unit'] else ''} on {trend['latest_at']}"
+        if trend["ref_low"] is not None or trend["ref_high"] is not None:
+            low = _format_value(trend["ref_low"]) if trend["ref_low"] is not None else ""
+            high = _format_value(trend["ref_high"]) if trend["ref_high"] is not None else ""
+            line += f" (ref {low}-{high}{', OUT OF RANGE' if trend['latest_out_of_range'] else ''})"
+        if trend["slope_per_30_days"] is not None:
+            line += f", {trend['direction']} {trend['slope_per_30_days']:+g}/30d over {trend['count']} readings"
+        if trend["out_of_range_count"]:
+            line += f", {trend['out_of_range_count']} out of range"
+        lines.append(line)
+    return lines
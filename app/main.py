@@ -1,13 +1,16 @@
 import os
+import hmac
 import logging
 import json
 import re
 from fastapi import FastAPI, HTTPException, Request, Form, Depends, File, UploadFile
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import HTMLResponse, RedirectResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from tempfile import NamedTemporaryFile
 from pathlib import Path
+from datetime import datetime, timedelta, timezone
+from typing import Optional
 from markupsafe import Markup
 from dotenv import load_dotenv
 
@@ -15,29 +18,44 @@ from dotenv import load_dotenv
 from models import (
     PatientCreate, PatientResponse, 
     InteractionCreate, InteractionResponse,
-    PromptRequest, PromptResponse
+    PromptRequest, PromptResponse,
+    LabIngestRequest, AppointmentCreate, AppointmentReschedule, CaregiverCreate, CaregiverResponse, CaregiverPatientLink, DashboardPatient, DashboardResponse
 )
 from database import (
     init_db, add_patient, get_patient, 
-    get_patient_interactions, update_patient_context
+    get_patient_interactions, update_patient_context,
+    add_caregiver, get_caregiver, link_caregiver_patient, unlink_caregiver_patient,
+    get_caregiver_dashboard
 )
 from services import process_prompt, initialize_gemini, extract_patient_info_from_text
+from admission import AdmissionRejected, controller as admission
+from archive import hydrate_archived_interactions
+from export import (
+    COMPRESSED_MEDIA_TYPES, COMPRESSIONS, FILE_SUFFIXES, FORMATS, MEDIA_TYPES,
+    export_stream, export_watermark, normalize_since
+)
+from retrieval import index_patient_document, get_patient_documents
+from appointments import (
+    add_appointment, cancel_appointment, check_appointment_conflicts, get_appointments,
+    get_caregiver_calendar, reschedule_appointment, scheduler as reminder_scheduler
+)
+from labs import extract_lab_results, get_lab_series, get_lab_trends, ingest_lab_results
+from serialization import FastJSONResponse, RawJSONResponse, construct_trusted, json_object, json_rows
+from http_cache import (
+    CachedStaticFiles, cache_headers, is_not_modified, make_static_version,
+    not_modified_response, patient_validators, tree_version
+)
 
 # Import Logfire for observability
 import logfire
+import telemetry
 
 # load_dotenv
 load_dotenv()
 
-# --- Logfire Configuration ---
+# --- Logfire and logging configuration (sampling and queued logging, see telemetry.py) ---
 LOGFIRE_TOKEN = os.getenv("LOGFIRE_TOKEN")
-logfire.configure(
-    token=LOGFIRE_TOKEN,
-    service_name="carebears-app"
-)
-
-# Configure standard logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+telemetry.configure(service_name="carebears-app", token=LOGFIRE_TOKEN)
 logger = logging.getLogger(__name__)
 logger.info("CareBears application starting up.")
 
@@ -58,11 +76,20 @@ app = FastAPI(
     version="1.0.0"
 )
 
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected_handler(request: Request, exc: AdmissionRejected):
+    """Tell clients to back off when LLM work is shed"""
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={"detail": exc.detail},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
 # --- Helper Functions for Templating ---
 def format_llm_response(text):
     """
     Format LLM response by:
-    1. Extracting and formatting the 'response' field from JSON if present
+    1. Extracting and formatting the 'display_markdown' or 'response' field from JSON if present
     2. Detecting and formatting JSON blocks
     3. Converting markdown-like formatting to HTML
     4. Hiding context tags from display
@@ -74,8 +101,11 @@ def format_llm_response(text):
     try:
         # Try to parse the entire text as JSON
         json_obj = json.loads(text)
+        # Structured output that was stored whole shows its display markdown
+        if isinstance(json_obj, dict) and isinstance(json_obj.get('display_markdown'), str):
+            text = json_obj['display_markdown']
         # If it's a JSON object with a 'response' key, extract and process that
-        if isinstance(json_obj, dict) and 'response' in json_obj:
+        elif isinstance(json_obj, dict) and 'response' in json_obj:
             # The 'response' field might contain markdown, so we'll process it
             response_text = json_obj['response']
             # Continue processing with the extracted response text
@@ -186,10 +216,26 @@ def format_llm_response(text):
 
 # --- Templating and Static Files Setup ---
 templates = Jinja2Templates(directory=TEMPLATES_DIR)
-app.mount("/static", StaticFiles(directory=STATIC_FILES_DIR), name="static")
+app.mount("/static", CachedStaticFiles(directory=STATIC_FILES_DIR), name="static")
 
 # Register custom filters
 templates.env.filters["format_llm_response"] = format_llm_response
+templates.env.globals["static_version"] = make_static_version(STATIC_FILES_DIR)
+
+# Rendered pages change when either the patient or the templates/assets change
+UI_VERSION = tree_version(TEMPLATES_DIR, STATIC_FILES_DIR)
+
+# Fields written around the stored JSON columns in passthrough responses
+PATIENT_RESPONSE_FIELDS = tuple(name for name in PatientResponse.model_fields if name != "context")
+RAW_INTERACTION_COLUMNS = ("context_before", "context_after")
+
+# Every worker starts the reminder scheduler, but only the one holding the
+# sender lock sends; the others wait to take over. Set to 0 to use cron.
+REMINDER_SCHEDULER_ENABLED = os.getenv("CAREBEARS_REMINDER_SCHEDULER", "1") == "1"
+
+# Bulk export over HTTP hands out every patient's records, so it is off
+# unless an admin token is configured; `manage.py export` always works
+EXPORT_API_TOKEN = os.getenv("CAREBEARS_EXPORT_TOKEN")
 
 # --- Startup Event to Initialize Database and Gemini ---
 @app.on_event("startup")
@@ -197,11 +243,19 @@ async def startup_event():
     init_db()
     initialize_gemini()
     logger.info("Database and Gemini model initialized")
+    if REMINDER_SCHEDULER_ENABLED:
+        reminder_scheduler.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    reminder_scheduler.stop()
 
 # --- API Routes ---
 
 # Patient routes
-@app.post("/api/patients", response_model=PatientResponse)
+# Routes that build trusted models return them as responses directly, so
+# `responses=` documents the schema without FastAPI validating them again
+@app.post("/api/patients", responses={200: {"model": PatientResponse}})
 @logfire.instrument("Create patient")
 async def create_patient(patient: PatientCreate):
     """Create a new patient record"""
@@ -217,7 +271,7 @@ async def create_patient(patient: PatientCreate):
         # Get the created patient to return
         created_patient = get_patient(patient_id)
         if created_patient:
-            return created_patient
+            return FastJSONResponse(construct_trusted(PatientResponse, created_patient).model_dump(mode="json"))
         else:
             raise HTTPException(status_code=500, detail="Failed to retrieve created patient")
     except Exception as e:
@@ -227,47 +281,226 @@ async def create_patient(patient: PatientCreate):
 
 @app.get("/api/patients/{patient_id}", response_model=PatientResponse)
 @logfire.instrument("Get patient")
-async def get_patient_info(patient_id: int):
+async def get_patient_info(request: Request, patient_id: int):
     """Get a patient's information"""
-    patient_data = get_patient(patient_id)
+    validators = patient_validators(patient_id)
+    if not validators:
+        raise HTTPException(status_code=404, detail=f"Patient with ID {patient_id} not found")
+    if is_not_modified(request, *validators):
+        return not_modified_response(*validators)
+
+    # The stored context is copied into the body without parsing it
+    patient_data = get_patient(patient_id, raw_json=True)
     if patient_data:
-        return patient_data
+        fields = {name: patient_data[name] for name in PATIENT_RESPONSE_FIELDS}
+        fields["created_at"] = construct_trusted(PatientResponse, patient_data).created_at.isoformat()
+        body = json_object(fields, raw={"context": patient_data["context"] or "{}"})
+        return RawJSONResponse(body, headers=cache_headers(*validators))
     raise HTTPException(status_code=404, detail=f"Patient with ID {patient_id} not found")
 
 @app.get("/api/patients/{patient_id}/interactions")
 @logfire.instrument("Get patient interactions")
-async def get_interactions(patient_id: int, limit: int = 10):
+async def get_interactions(request: Request, patient_id: int, limit: int = 10):
     """Get a patient's recent interactions"""
-    patient_data = get_patient(patient_id)
-    if not patient_data:
+    validators = patient_validators(patient_id, variant=f"-i{limit}")
+    if not validators:
         raise HTTPException(status_code=404, detail=f"Patient with ID {patient_id} not found")
+    if is_not_modified(request, *validators):
+        return not_modified_response(*validators)
         
-    interactions = get_patient_interactions(patient_id, limit)
-    return {"interactions": interactions}
+    interactions = get_patient_interactions(patient_id, limit, raw_json=True)
+    if any(interaction["archive_ref"] for interaction in interactions):
+        # Archived rows are merged with their archive copies, so parse them
+        interactions = hydrate_archived_interactions(get_patient_interactions(patient_id, limit))
+        return FastJSONResponse({"interactions": interactions}, headers=cache_headers(*validators))
+    body = json_object({}, raw={"interactions": json_rows(interactions, RAW_INTERACTION_COLUMNS)})
+    return RawJSONResponse(body, headers=cache_headers(*validators))
+
+@app.post("/api/patients/{patient_id}/documents")
+@logfire.instrument("Add patient document")
+async def add_patient_document(patient_id: int, file: UploadFile = File(...)):
+    """Add a medical record to a patient's indexed documents"""
+    if not get_patient(patient_id):
+        raise HTTPException(status_code=404, detail=f"Patient with ID {patient_id} not found")
+    try:
+        text = (await file.read()).decode("utf-8")
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="Documents must be UTF-8 text")
+    document_id = index_patient_document(patient_id, text, source=file.filename)
+    labs = ingest_lab_results(patient_id, extract_lab_results(text), skip_mismatched_units=True)
+    return {"document_id": document_id, "labs": labs, "documents": get_patient_documents(patient_id)}
+
+@app.get("/api/patients/{patient_id}/documents")
+@logfire.instrument("Get patient documents")
+async def get_documents(patient_id: int):
+    """List a patient's indexed documents"""
+    if not get_patient(patient_id):
+        raise HTTPException(status_code=404, detail=f"Patient with ID {patient_id} not found")
+    return {"documents": get_patient_documents(patient_id)}
+
+# Lab routes
+@app.post("/api/patients/{patient_id}/labs")
+@logfire.instrument("Ingest lab results")
+async def add_lab_results(patient_id: int, request: LabIngestRequest):
+    """Bulk-add lab and vitals readings to a patient's series"""
+    if not get_patient(patient_id):
+        raise HTTPException(status_code=404, detail=f"Patient with ID {patient_id} not found")
+    try:
+        counts = ingest_lab_results(patient_id, [result.model_dump() for result in request.results])
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid lab result: {str(e)}")
+    return {"series": counts}
+
+@app.get("/api/patients/{patient_id}/labs")
+@logfire.instrument("Get lab trends")
+async def get_labs(patient_id: int, window_days: int = 90):
+    """Trend summary for each of a patient's analytes"""
+    if not get_patient(patient_id):
+        raise HTTPException(status_code=404, detail=f"Patient with ID {patient_id} not found")
+    return FastJSONResponse({"trends": get_lab_trends(patient_id, window_days)})
+
+@app.get("/api/patients/{patient_id}/labs/{analyte}")
+@logfire.instrument("Get lab series")
+async def get_lab(patient_id: int, analyte: str, window_days: int = 90):
+    """One analyte's readings with rolling means and out-of-range flags"""
+    series = get_lab_series(patient_id, analyte, window_days)
+    if series is None:
+        raise HTTPException(status_code=404, detail=f"No {analyte} results for patient {patient_id}")
+    return FastJSONResponse(series)
+
+# Appointment routes
+def _appointment_end(request):
+    if request.ends_at is not None:
+        return request.ends_at
+    return request.starts_at + timedelta(minutes=request.duration_minutes)
+
+@app.post("/api/patients/{patient_id}/appointments")
+@logfire.instrument("Add appointment")
+async def create_appointment(patient_id: int, request: AppointmentCreate):
+    """Book an appointment; overlaps with the patient's other appointments are returned as conflicts"""
+    if not get_patient(patient_id):
+        raise HTTPException(status_code=404, detail=f"Patient with ID {patient_id} not found")
+    try:
+        appointment = add_appointment(
+            patient_id, request.provider, request.starts_at, _appointment_end(request),
+            location=request.location, purpose=request.purpose,
+            remind_before_minutes=request.remind_before_minutes
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return FastJSONResponse({"appointment": appointment, "conflicts": check_appointment_conflicts(appointment)})
+
+@app.get("/api/patients/{patient_id}/appointments")
+@logfire.instrument("Get appointments")
+async def get_patient_appointments(patient_id: int, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                                   days: int = 30, include_cancelled: bool = False):
+    """A patient's appointments overlapping [start, end), by default the next 30 days"""
+    if not get_patient(patient_id):
+        raise HTTPException(status_code=404, detail=f"Patient with ID {patient_id} not found")
+    start = start or datetime.now(timezone.utc)
+    end = end or start + timedelta(days=days)
+    return FastJSONResponse({
+        "appointments": get_appointments([patient_id], start, end, include_cancelled=include_cancelled)
+    })
+
+@app.put("/api/patients/{patient_id}/appointments/{appointment_id}")
+@logfire.instrument("Reschedule appointment")
+async def move_appointment(patient_id: int, appointment_id: int, request: AppointmentReschedule):
+    """Move a scheduled appointment to a new time"""
+    try:
+        appointment = reschedule_appointment(
+            patient_id, appointment_id, request.starts_at, _appointment_end(request),
+            remind_before_minutes=request.remind_before_minutes
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if appointment is None:
+        raise HTTPException(status_code=404, detail=f"No scheduled appointment {appointment_id} for patient {patient_id}")
+    return FastJSONResponse({"appointment": appointment, "conflicts": check_appointment_conflicts(appointment)})
+
+@app.delete("/api/patients/{patient_id}/appointments/{appointment_id}")
+@logfire.instrument("Cancel appointment")
+async def delete_appointment(patient_id: int, appointment_id: int):
+    """Cancel a scheduled appointment"""
+    if not cancel_appointment(patient_id, appointment_id):
+        raise HTTPException(status_code=404, detail=f"No scheduled appointment {appointment_id} for patient {patient_id}")
+    return {"patient_id": patient_id, "appointment_id": appointment_id, "status": "cancelled"}
 
 # Prompt processing route
-@app.post("/api/prompts", response_model=PromptResponse)
+@app.post("/api/prompts", responses={200: {"model": PromptResponse}})
 @logfire.instrument("Process prompt")
 async def process_user_prompt(request: PromptRequest):
     """Process a user prompt with the Gemini model and update patient context"""
     try:
-        # Process the prompt and get response with updated context
-        response_text, updated_context = process_prompt(
-            prompt_type=request.prompt_type,
-            patient_id=request.patient_id,
-            user_input=request.user_input
-        )
+        # Process the prompt and get response with updated context. The model
+        # slot is awaited on the event loop, then the blocking call runs in a thread
+        async with admission.admit_async(request.prompt_type, request.patient_id):
+            response_text, updated_context = await run_in_threadpool(
+                process_prompt,
+                prompt_type=request.prompt_type,
+                patient_id=request.patient_id,
+                user_input=request.user_input
+            )
         
         # Return the model response and updated context
-        return PromptResponse(
+        return FastJSONResponse(PromptResponse.model_construct(
             response=response_text,
             updated_context=updated_context
-        )
+        ).model_dump(mode="json"))
+    except AdmissionRejected:
+        raise
     except Exception as e:
         logger.error(f"Error processing prompt: {e}")
         logfire.error("Prompt processing failed", error=str(e))
         raise HTTPException(status_code=500, detail=f"Failed to process prompt: {str(e)}")
 
+# Caregiver routes
+@app.post("/api/caregivers", response_model=CaregiverResponse)
+@logfire.instrument("Create caregiver")
+async def create_caregiver(caregiver: CaregiverCreate):
+    """Create a caregiver who can follow several patients"""
+    caregiver_id = add_caregiver(name=caregiver.name, email=caregiver.email)
+    return get_caregiver(caregiver_id)
+
+@app.post("/api/caregivers/{caregiver_id}/patients")
+@logfire.instrument("Link caregiver patient")
+async def add_caregiver_patient(caregiver_id: int, link: CaregiverPatientLink):
+    """Add a patient to a caregiver's dashboard"""
+    if not get_caregiver(caregiver_id):
+        raise HTTPException(status_code=404, detail=f"Caregiver with ID {caregiver_id} not found")
+    if not get_patient(link.patient_id):
+        raise HTTPException(status_code=404, detail=f"Patient with ID {link.patient_id} not found")
+    link_caregiver_patient(caregiver_id, link.patient_id, link.relationship)
+    return {"caregiver_id": caregiver_id, "patient_id": link.patient_id}
+
+@app.delete("/api/caregivers/{caregiver_id}/patients/{patient_id}")
+@logfire.instrument("Unlink caregiver patient")
+async def remove_caregiver_patient(caregiver_id: int, patient_id: int):
+    """Remove a patient from a caregiver's dashboard"""
+    if not unlink_caregiver_patient(caregiver_id, patient_id):
+        raise HTTPException(status_code=404, detail=f"Patient {patient_id} is not on caregiver {caregiver_id}'s dashboard")
+    return {"caregiver_id": caregiver_id, "patient_id": patient_id}
+
+@app.get("/api/caregivers/{caregiver_id}/dashboard", responses={200: {"model": DashboardResponse}})
+@logfire.instrument("Get caregiver dashboard")
+async def get_dashboard(caregiver_id: int):
+    """Get a caregiver's patients with their latest activity, care gaps and reminders"""
+    caregiver = get_caregiver(caregiver_id)
+    if not caregiver:
+        raise HTTPException(status_code=404, detail=f"Caregiver with ID {caregiver_id} not found")
+    return FastJSONResponse(DashboardResponse.model_construct(
+        caregiver=construct_trusted(CaregiverResponse, caregiver),
+        patients=[construct_trusted(DashboardPatient, row) for row in get_caregiver_dashboard(caregiver_id)]
+    ).model_dump(mode="json"))
+
+@app.get("/api/caregivers/{caregiver_id}/appointments")
+@logfire.instrument("Get caregiver calendar")
+async def get_caregiver_appointments(caregiver_id: int, days: int = 7):
+    """The next days of appointments for all of a caregiver's patients, with conflicts across them"""
+    if not get_caregiver(caregiver_id):
+        raise HTTPException(status_code=404, detail=f"Caregiver with ID {caregiver_id} not found")
+    return FastJSONResponse(get_caregiver_calendar(caregiver_id, days))
+
 # --- Web UI Routes ---
 
 @app.get("/", response_class=HTMLResponse)
@@ -299,7 +532,8 @@ async def upload_patient_file(request: Request, file: UploadFile = File(...)):
         os.unlink(temp_file_path)
         
         # Extract patient information using the LLM
-        patient_data = extract_patient_info_from_text(file_content)
+        async with admission.admit_async("patient_extraction"):
+            patient_data = await run_in_threadpool(extract_patient_info_from_text, file_content)
         
         # Check if extraction was successful
         if "error" in patient_data:
@@ -315,12 +549,18 @@ async def upload_patient_file(request: Request, file: UploadFile = File(...)):
             location=patient_data.get("location", ""),
             diagnosis=patient_data.get("diagnosis", ""),
             care_gaps=patient_data.get("care_gaps", None),
-            context={"source": "file_upload", "raw_text": file_content}
+            context={"source": "file_upload"}
         )
+
+        # Index the record for retrieval instead of storing it in the context
+        index_patient_document(patient_id, file_content, source=file.filename)
+        ingest_lab_results(patient_id, extract_lab_results(file_content), skip_mismatched_units=True)
         
         # Redirect to the patient page
         return RedirectResponse(url=f"/patients/{patient_id}", status_code=303)
         
+    except AdmissionRejected:
+        raise
     except Exception as e:
         logger.error(f"Error processing patient file: {e}")
         logfire.error("Patient file processing failed", error=str(e))
@@ -333,13 +573,20 @@ async def upload_patient_file(request: Request, file: UploadFile = File(...)):
 @logfire.instrument("Get patient UI")
 async def get_patient_ui(request: Request, patient_id: int):
     """Display the patient interface"""
+    validators = patient_validators(patient_id, variant=f"-ui{UI_VERSION}")
+    if not validators:
+        return RedirectResponse(url="/")
+    if is_not_modified(request, *validators):
+        return not_modified_response(*validators)
+
     patient_data = get_patient(patient_id)
     if not patient_data:
         return RedirectResponse(url="/")
         
     return templates.TemplateResponse(
         "patient.html", 
-        {"request": request, "patient": patient_data}
+        {"request": request, "patient": patient_data},
+        headers=cache_headers(*validators)
     )
 
 @app.post("/patients/{patient_id}/prompt", response_class=HTMLResponse)
@@ -355,12 +602,14 @@ async def post_patient_prompt(
     if not patient_data:
         return RedirectResponse(url="/")
     
-    # Process the prompt
-    response_text, updated_context = process_prompt(
-        prompt_type=prompt_type,
-        patient_id=patient_id,
-        user_input=user_input
-    )
+    # Process the prompt once admission control grants a model slot
+    async with admission.admit_async(prompt_type, patient_id):
+        response_text, updated_context = await run_in_threadpool(
+            process_prompt,
+            prompt_type=prompt_type,
+            patient_id=patient_id,
+            user_input=user_input
+        )
     
     # Get the patient's updated information
     updated_patient = get_patient(patient_id)
@@ -386,5 +635,51 @@ def health_check():
     """Simple health check endpoint"""
     return {"status": "ok"}
 
+@app.get("/api/export")
+@logfire.instrument("Export data")
+async def export_data(request: Request, since: Optional[str] = None, format: str = "ndjson", compress: str = "gzip"):
+    """
+    Stream every patient and interaction (or only changes since a watermark)
+
+    Requires ``Authorization: Bearer $CAREBEARS_EXPORT_TOKEN``; without a
+    configured token the endpoint doesn't exist. Compressed exports are sent
+    as a gzip or zstd file attachment. The ``X-Export-Watermark`` header is
+    the ``since`` to use for the next incremental export.
+    """
+    if not EXPORT_API_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token.encode(), EXPORT_API_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Export token required", headers={"WWW-Authenticate": "Bearer"})
+    if format not in FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(FORMATS)}")
+    if compress not in COMPRESSIONS:
+        raise HTTPException(status_code=400, detail=f"compress must be one of {', '.join(COMPRESSIONS)}")
+    try:
+        since = normalize_since(since)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="since must be an ISO date or datetime")
+    filename = f"carebears-export.{'fhir.' if format == 'fhir' else ''}ndjson{FILE_SUFFIXES[compress]}"
+    headers = {
+        "X-Export-Watermark": export_watermark(),
+        "Content-Disposition": f'attachment; filename="{filename}"',
+        "Cache-Control": "no-store",
+    }
+    return StreamingResponse(
+        export_stream(since, format, None if compress == "none" else compress),
+        media_type=COMPRESSED_MEDIA_TYPES.get(compress, MEDIA_TYPES[format]),
+        headers=headers
+    )
+
+@app.get("/api/metrics/admission")
+def admission_metrics():
+    """LLM queue depths, recent queue wait percentiles and shed counts"""
+    return admission.stats()
+
+@app.get("/api/metrics/telemetry")
+def telemetry_metrics():
+    """Trace sampling settings and log queue depth and drops"""
+    return telemetry.stats()
+
 # Run the application using:
 # GOOGLE_API_KEY="YOUR_GOOGLE_API_KEY" LOGFIRE_TOKEN="YOUR_LOGFIRE_TOKEN" uvicorn app.main:app --reload
@@ -0,0 +1,164 @@
+"""
+Maintenance commands for the CareBears database.
+
+Run from the app directory, e.g.:
+    python manage.py compress-columns
+    python manage.py train-zstd-dict data/carebears.zdict
+    python manage.py archive-interactions --retention-days 180
+    python manage.py export data/export.ndjson.gz --state-file data/export.watermark
+    CAREBEARS_SHARDS=4 python manage.py rebalance-shards
+"""
+import argparse
+import json
+import os
+import sys
+from pathlib import Path
+
+import appointments
+import archive
+import database
+import export
+import sharding
+
+def compress_columns(args):
+    """Compress rows written before column compression was enabled"""
+    database.init_db()
+    stats = database.migrate_compress_columns(batch_size=args.batch_size, pause_seconds=args.pause)
+    print(json.dumps(stats, indent=2))
+
+def train_zstd_dict(args):
+    """Train a shared zstd dictionary from existing rows"""
+    path = database.train_zstd_dictionary(args.output, dict_size=args.size)
+    print(f"Wrote dictionary to {path}; set CAREBEARS_ZSTD_DICT={path} to use it")
+
+def archive_interactions(args):
+    """Move old interactions into compressed archive segments"""
+    database.init_db()
+    stats = archive.archive_old_interactions(
+        retention_days=args.retention_days,
+        batch_size=args.batch_size,
+        max_batches=args.max_batches,
+    )
+    print(json.dumps(stats, indent=2))
+
+def enable_incremental_vacuum(args):
+    """Convert an existing database to incremental auto-vacuum (runs a full VACUUM)"""
+    changed = archive.enable_incremental_vacuum()
+    print("Converted to incremental auto-vacuum" if changed else "Already using incremental auto-vacuum")
+
+def shard_status(args):
+    """Show the number of patients in each shard"""
+    database.init_db()
+    print(json.dumps(sharding.shard_sizes(), indent=2))
+
+def move_patient(args):
+    """Move one patient to another shard"""
+    database.init_db()
+    stats = sharding.move_patient(args.patient_id, args.shard)
+    print(json.dumps(stats, indent=2) if stats else f"Patient {args.patient_id} is already on shard {args.shard}")
+
+def rebalance_shards(args):
+    """Spread patients evenly over CAREBEARS_SHARDS shards"""
+    database.init_db()
+    moves = sharding.rebalance(max_moves=args.max_moves)
+    for patient_id, source, target in moves:
+        print(f"patient {patient_id}: shard {source} -> {target}")
+    print(json.dumps(sharding.shard_sizes(), indent=2))
+
+def rebuild_rollups(args):
+    """Recompute caregiver dashboard rollups from the interactions"""
+    database.init_db()
+    print(f"Rebuilt {database.rebuild_patient_rollups()} patient rollups")
+
+def send_reminders(args):
+    """Send appointment reminders that are due (the app also does this on a timer)"""
+    database.init_db()
+    print(f"Sent {appointments.scheduler.run_due()} reminders")
+
+def export_data(args):
+    """Stream patients and interactions to an NDJSON or FHIR file"""
+    database.init_db()
+    since = args.since
+    state_file = Path(args.state_file) if args.state_file else None
+    if since is None and state_file and state_file.exists():
+        since = state_file.read_text().strip() or None
+    compression = args.compress or ("gzip" if args.output.endswith(".gz") else "zstd" if args.output.endswith(".zst") else "none")
+    watermark = export.export_watermark()
+    counts = {}
+    chunks = export.export_stream(since, args.format, compression, batch_size=args.batch_size, counts=counts)
+
+    if args.output == "-":
+        for chunk in chunks:
+            sys.stdout.buffer.write(chunk)
+        sys.stdout.buffer.flush()
+    else:
+        # Written under a temporary name so a failed run leaves no partial export
+        partial = Path(args.output + ".partial")
+        partial.parent.mkdir(parents=True, exist_ok=True)
+        with open(partial, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.replace(partial, args.output)
+    if state_file:
+        state_file.write_text(watermark + "\n")
+    print(f"Exported {counts['patients']} patients and {counts['interactions']} interactions"
+          f"{f' since {since}' if since else ''}; next watermark {watermark}", file=sys.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    compress = subparsers.add_parser("compress-columns", help=compress_columns.__doc__)
+    compress.add_argument("--batch-size", type=int, default=200)
+    compress.add_argument("--pause", type=float, default=0.05, help="Seconds to sleep between batches")
+    compress.set_defaults(func=compress_columns)
+
+    train = subparsers.add_parser("train-zstd-dict", help=train_zstd_dict.__doc__)
+    train.add_argument("output")
+    train.add_argument("--size", type=int, default=64 * 1024, help="Dictionary size in bytes")
+    train.set_defaults(func=train_zstd_dict)
+
+    archive_parser = subparsers.add_parser("archive-interactions", help=archive_interactions.__doc__)
+    archive_parser.add_argument("--retention-days", type=int, default=None,
+                                help=f"Defaults to CAREBEARS_INTERACTION_RETENTION_DAYS ({archive.RETENTION_DAYS})")
+    archive_parser.add_argument("--batch-size", type=int, default=200)
+    archive_parser.add_argument("--max-batches", type=int, default=None)
+    archive_parser.set_defaults(func=archive_interactions)
+
+    vacuum = subparsers.add_parser("enable-incremental-vacuum", help=enable_incremental_vacuum.__doc__)
+    vacuum.set_defaults(func=enable_incremental_vacuum)
+
+    status = subparsers.add_parser("shard-status", help=shard_status.__doc__)
+    status.set_defaults(func=shard_status)
+
+    move = subparsers.add_parser("move-patient", help=move_patient.__doc__)
+    move.add_argument("patient_id", type=int)
+    move.add_argument("shard", type=int)
+    move.set_defaults(func=move_patient)
+
+    rebalance = subparsers.add_parser("rebalance-shards", help=rebalance_shards.__doc__)
+    rebalance.add_argument("--max-moves", type=int, default=None)
+    rebalance.set_defaults(func=rebalance_shards)
+
+    rollups = subparsers.add_parser("rebuild-rollups", help=rebuild_rollups.__doc__)
+    rollups.set_defaults(func=rebuild_rollups)
+
+    reminders = subparsers.add_parser("send-reminders", help=send_reminders.__doc__)
+    reminders.set_defaults(func=send_reminders)
+
+    export_parser = subparsers.add_parser("export", help=export_data.__doc__)
+    export_parser.add_argument("output", help="File to write, or - for stdout")
+    export_parser.add_argument("--format", choices=export.FORMATS, default="ndjson")
+    export_parser.add_argument("--compress", choices=export.COMPRESSIONS, default=None,
+                               help="Defaults to gzip for .gz and zstd for .zst outputs")
+    export_parser.add_argument("--since", default=None, help="Only export changes at or after this ISO datetime (UTC)")
+    export_parser.add_argument("--state-file", default=None,
+                               help="Read --since from this file and store the new watermark in it after a successful run")
+    export_parser.add_argument("--batch-size", type=int, default=export.EXPORT_BATCH_SIZE)
+    export_parser.set_defaults(func=export_data)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
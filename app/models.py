@@ -1,4 +1,4 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, create_model
 from typing import Optional, Dict, List, Any
 from datetime import datetime
 
@@ -38,6 +38,61 @@ class InteractionResponse(InteractionBase):
     class Config:
         from_attributes = True
 
+class LabResult(BaseModel):
+    analyte: str
+    value: float
+    taken_at: str = Field(description="ISO date/datetime or MM/DD/YYYY")
+    unit: Optional[str] = None
+    ref_low: Optional[float] = None
+    ref_high: Optional[float] = None
+
+class LabIngestRequest(BaseModel):
+    results: List[LabResult]
+
+class CaregiverCreate(BaseModel):
+    name: str
+    email: Optional[str] = None
+
+class CaregiverResponse(CaregiverCreate):
+    id: int
+    created_at: datetime
+
+class CaregiverPatientLink(BaseModel):
+    patient_id: int
+    relationship: Optional[str] = None
+
+class DashboardPatient(BaseModel):
+    patient_id: int
+    name: str
+    diagnosis: Optional[str] = None
+    relationship: Optional[str] = None
+    care_gaps: List[str] = Field(default_factory=list)
+    pending_reminders: int = 0
+    interaction_count: int = 0
+    prompt_counts: Dict[str, int] = Field(default_factory=dict)
+    last_interaction_at: Optional[datetime] = None
+    last_prompt_type: Optional[str] = None
+    last_summary: Optional[str] = None
+
+class DashboardResponse(BaseModel):
+    caregiver: CaregiverResponse
+    patients: List[DashboardPatient]
+
+class AppointmentCreate(BaseModel):
+    provider: str
+    starts_at: datetime = Field(description="Naive datetimes are taken as UTC")
+    ends_at: Optional[datetime] = None
+    duration_minutes: int = Field(default=30, gt=0)
+    location: Optional[str] = None
+    purpose: Optional[str] = None
+    remind_before_minutes: Optional[int] = Field(default=None, ge=0)
+
+class AppointmentReschedule(BaseModel):
+    starts_at: datetime
+    ends_at: Optional[datetime] = None
+    duration_minutes: int = Field(default=30, gt=0)
+    remind_before_minutes: Optional[int] = Field(default=None, ge=0)
+
 class PromptRequest(BaseModel):
     prompt_type: str
     patient_id: int
@@ -47,41 +102,42 @@ class PromptResponse(BaseModel):
     response: str
     updated_context: Dict[str, Any]
 
-# Define a mapping of prompt types to their full text
-PROMPT_TEMPLATES = {
+# Instructions for how the model should hand back updated context as
+# <context> tags (legacy, unstructured mode)
+CONTEXT_TAG_INSTRUCTION = (
+    "Make sure you return the output so that it includes updated context "
+    "in the format — <context> info </context>"
+)
+
+# Define a mapping of prompt types to their instructions, without the
+# context output format
+PROMPT_INSTRUCTIONS = {
     "base": (
         "You are a care buddy and you help patients and you are compassionate but very action oriented. "
         "Use the patient's context which includes name, date of birth, location, diagnosis and potential care gaps. "
         "Format your response using markdown for better readability. Use headers (##, ###), "
-        "lists (- item), emphasis (**bold**, *italic*), and other markdown formatting to make the response look nice. "
-        "Output the context as <context> info </context> but this will not be displayed to the user."
+        "lists (- item), emphasis (**bold**, *italic*), and other markdown formatting to make the response look nice."
     ),
     "find_care_groups": (
         "Using the patient's information find relevant support groups in the zip code of patient. "
         "The patient's zip code should be available in the context. "
         "Use search to find appropriate local support groups. "
         "Format your response using markdown for better readability. Use headers (##, ###), "
-        "lists (- item), emphasis (**bold**, *italic*), and other markdown formatting to make the response look nice. "
-        "Make sure you return the output so that it includes updated context "
-        "in the format — <context> info </context>"
+        "lists (- item), emphasis (**bold**, *italic*), and other markdown formatting to make the response look nice."
     ),
     "medication_reminder": (
         "Based on the patient's diagnosis and context, suggest an appropriate medication schedule. "
         "Be specific about timing and potential side effects to watch for. "
         "Consider any regional medication availability based on the patient's location in the context. "
         "Format your response using markdown for better readability. Use headers (##, ###), "
-        "lists (- item), emphasis (**bold**, *italic*), and other markdown formatting to make the response look nice. "
-        "Make sure you return the output so that it includes updated context "
-        "in the format — <context> info </context>"
+        "lists (- item), emphasis (**bold**, *italic*), and other markdown formatting to make the response look nice."
     ),
     "appointment_preparation": (
         "Help the patient prepare for their upcoming medical appointments. "
         "Suggest questions they should ask based on their diagnosis and care gaps from the context. "
         "If there are any previous appointments or notes in the context, reference those. "
         "Format your response using markdown for better readability. Use headers (##, ###), "
-        "lists (- item), emphasis (**bold**, *italic*), and other markdown formatting to make the response look nice. "
-        "Make sure you return the output so that it includes updated context "
-        "in the format — <context> info </context>"
+        "lists (- item), emphasis (**bold**, *italic*), and other markdown formatting to make the response look nice."
     ),
     "symptom_check": (
         "Assess the patient's symptoms based on their input and context. "
@@ -90,8 +146,91 @@ PROMPT_TEMPLATES = {
         "schedule an appointment, or manage at home. "
         "If local healthcare facilities are in the context, mention relevant ones. "
         "Format your response using markdown for better readability. Use headers (##, ###), "
-        "lists (- item), emphasis (**bold**, *italic*), and other markdown formatting to make the response look nice. "
-        "Make sure you return the output so that it includes updated context "
-        "in the format — <context> info </context>"
+        "lists (- item), emphasis (**bold**, *italic*), and other markdown formatting to make the response look nice."
     )
-}
\ No newline at end of file
+}
+
+# Full prompt text for the legacy <context> tag mode
+PROMPT_TEMPLATES = {
+    prompt_type: f"{instructions} {CONTEXT_TAG_INSTRUCTION}"
+    for prompt_type, instructions in PROMPT_INSTRUCTIONS.items()
+}
+PROMPT_TEMPLATES["base"] = (
+    f"{PROMPT_INSTRUCTIONS['base']} "
+    "Output the context as <context> info </context> but this will not be displayed to the user."
+)
+
+# --- Structured output ---
+# Each prompt type declares the schema of the context patch the model may
+# return. In structured mode Gemini is constrained to a JSON response that
+# separates the markdown shown to the user from this patch.
+
+class SupportGroup(BaseModel):
+    name: str
+    location: Optional[str] = None
+    contact: Optional[str] = None
+    meeting_schedule: Optional[str] = None
+
+class Medication(BaseModel):
+    name: str
+    dose: Optional[str] = None
+    schedule: Optional[str] = None
+    side_effects_to_watch: List[str] = Field(default_factory=list)
+
+class Appointment(BaseModel):
+    provider: str
+    date: Optional[str] = None
+    purpose: Optional[str] = None
+
+class BaseContextPatch(BaseModel):
+    care_gaps: List[str] = Field(default_factory=list)
+    notes: List[str] = Field(default_factory=list)
+
+class CareGroupsContextPatch(BaseModel):
+    support_groups: List[SupportGroup] = Field(default_factory=list)
+
+class MedicationContextPatch(BaseModel):
+    medications: List[Medication] = Field(default_factory=list)
+
+class AppointmentContextPatch(BaseModel):
+    upcoming_appointments: List[Appointment] = Field(default_factory=list)
+    questions_for_provider: List[str] = Field(default_factory=list)
+
+class SymptomContextPatch(BaseModel):
+    reported_symptoms: List[str] = Field(default_factory=list)
+    triage_level: Optional[str] = Field(
+        default=None, description="One of: emergency, urgent, routine, self_care"
+    )
+
+PROMPT_CONTEXT_SCHEMAS = {
+    "base": BaseContextPatch,
+    "find_care_groups": CareGroupsContextPatch,
+    "medication_reminder": MedicationContextPatch,
+    "appointment_preparation": AppointmentContextPatch,
+    "symptom_check": SymptomContextPatch,
+}
+
+STRUCTURED_OUTPUT_INSTRUCTION = (
+    "Respond with JSON matching the response schema. Put the markdown shown to the patient in "
+    "display_markdown. Put only new or changed facts about the patient in context_patch, "
+    "leaving fields empty when nothing changed. Do not include <context> tags."
+)
+
+STRUCTURED_PROMPT_TEMPLATES = {
+    prompt_type: f"{instructions} {STRUCTURED_OUTPUT_INSTRUCTION}"
+    for prompt_type, instructions in PROMPT_INSTRUCTIONS.items()
+}
+
+def _structured_response_model(prompt_type: str, patch_model: type) -> type:
+    name = "".join(part.title() for part in prompt_type.split("_")) + "StructuredResponse"
+    return create_model(
+        name,
+        display_markdown=(str, ...),
+        context_patch=(patch_model, Field(default_factory=patch_model)),
+    )
+
+# Typed model responses: {"display_markdown": str, "context_patch": <schema>}
+STRUCTURED_RESPONSE_MODELS = {
+    prompt_type: _structured_response_model(prompt_type, patch_model)
+    for prompt_type, patch_model in PROMPT_CONTEXT_SCHEMAS.items()
+}
@@ -0,0 +1,52 @@
+"""
+Write gzip and brotli variants of static assets at deploy time.
+
+Both the app (CachedStaticFiles) and nginx (gzip_static / brotli_static) serve
+``<file>.gz``/``<file>.br`` directly when the client accepts them, so assets
+are compressed once per deploy instead of on every request. The app container
+runs this at startup so the variants also land in bind-mounted static dirs.
+
+Run from the app directory:
+    python precompress.py [static_dir]
+"""
+import gzip
+import os
+import sys
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip variants are always written
+    brotli = None
+
+COMPRESSIBLE_EXTENSIONS = (".css", ".js", ".svg", ".html", ".json", ".txt")
+MIN_SIZE = 256
+
+def precompress(static_dir):
+    """Write .gz (and .br if available) next to every compressible file"""
+    written = []
+    for root, _, files in os.walk(static_dir):
+        for name in files:
+            if not name.endswith(COMPRESSIBLE_EXTENSIONS):
+                continue
+            path = os.path.join(root, name)
+            with open(path, "rb") as f:
+                data = f.read()
+            if len(data) < MIN_SIZE:
+                continue
+
+            variants = [(".gz", gzip.compress(data, compresslevel=9, mtime=0))]
+            if brotli is not None:
+                variants.append((".br", brotli.compress(data, quality=11)))
+            for suffix, compressed in variants:
+                with open(path + suffix, "wb") as f:
+                    f.write(compressed)
+                # Keep the source mtime so Last-Modified matches the original
+                stat = os.stat(path)
+                os.utime(path + suffix, (stat.st_atime, stat.st_mtime))
+                written.append((path + suffix, len(data), len(compressed)))
+    return written
+
+if __name__ == "__main__":
+    static_dir = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+    for path, original, compressed in precompress(static_dir):
+        print(f"{path}: {original} -> {compressed} bytes")
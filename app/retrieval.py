@@ -0,0 +1,321 @@
+"""
+Local retrieval over uploaded patient documents.
+
+Documents are split into overlapping chunks and each chunk is stored with a
+sparse hashed term-frequency vector (unigrams and bigrams hashed into
+``FEATURE_DIM`` buckets). At prompt time the patient's chunks are scored
+against the user input with TF-IDF cosine similarity computed in NumPy, and
+only the top-k chunks are sent to the model, so prompt size stays flat as a
+patient's history grows.
+
+Everything runs on the CPU with no model downloads. Per-patient indexes are
+cached in-process as sparse CSR arrays (term ids, weights and row offsets),
+so a chunk costs a few bytes per distinct term rather than a ``FEATURE_DIM``
+row, and are appended to in amortized chunks as new documents are indexed.
+"""
+import hashlib
+import logging
+import os
+import re
+import threading
+import zlib
+from collections import Counter, OrderedDict
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from database import (
+    allocate_row_ids, get_patient_connection, patient_write_connection, shard_for_patient, shard_path, compress_text,
+    _load_json_column, update_patient_context
+)
+
+logger = logging.getLogger(__name__)
+
+FEATURE_DIM = 1 << 12
+CHUNK_CHARS = int(os.getenv("CAREBEARS_CHUNK_CHARS", "800"))
+TOP_K = int(os.getenv("CAREBEARS_RETRIEVAL_TOP_K", "4"))
+INDEX_CACHE_SIZE = 128
+
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:\.[0-9]+)?")
+_STOPWORDS = frozenset(
+    "a an and are as at be by for from has have i in is it its me my of on or so that the this to was "
+    "were what when will with you your".split()
+)
+
+# --- Chunking and features ---
+
+def chunk_text(text: str, max_chars: int = CHUNK_CHARS) -> List[str]:
+    """Split a document into paragraph-aligned chunks of roughly max_chars"""
+    paragraphs = [p.strip() for p in re.split(r"\n\s*\n", text) if p.strip()]
+    chunks, current = [], []
+    for paragraph in paragraphs:
+        # Hard-wrap paragraphs that are longer than a chunk on their own
+        while len(paragraph) > max_chars:
+            cut = paragraph.rfind(" ", 0, max_chars)
+            cut = cut if cut > 0 else max_chars
+            pieces, paragraph = paragraph[:cut], paragraph[cut:].strip()
+            if current:
+                chunks.append("\n\n".join(current))
+                current = []
+            chunks.append(pieces)
+        if current and sum(len(p) for p in current) + len(paragraph) > max_chars:
+            chunks.append("\n\n".join(current))
+            # Carry the last paragraph over so context spanning a boundary isn't lost
+            current = current[-1:] if len(current[-1]) < max_chars // 2 else []
+        current.append(paragraph)
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+def _tokens(text: str) -> List[str]:
+    words = [word for word in _TOKEN_PATTERN.findall(text.lower()) if word not in _STOPWORDS]
+    return words + [f"{a}_{b}" for a, b in zip(words, words[1:])]
+
+def hash_features(text: str):
+    """Return (term ids, log-scaled term frequencies) for a piece of text"""
+    counts = Counter(zlib.crc32(token.encode("utf-8")) % FEATURE_DIM for token in _tokens(text))
+    if not counts:
+        return np.zeros(0, dtype=np.uint16), np.zeros(0, dtype=np.float32)
+    term_ids = np.fromiter(counts.keys(), dtype=np.uint16, count=len(counts))
+    weights = 1.0 + np.log(np.fromiter(counts.values(), dtype=np.float32, count=len(counts)))
+    return term_ids, weights
+
+# --- Per-patient index ---
+
+def _grow(array, size):
+    """Return the array with room for ``size`` items, at least doubling its capacity"""
+    if size <= len(array):
+        return array
+    grown = np.empty(max(size, 2 * len(array), 64), dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+class PatientIndex:
+    """Sparse TF rows (CSR) and document frequencies for one patient's chunks"""
+
+    def __init__(self):
+        # Arrays have spare capacity; count and indptr[count] give the used part
+        self.count = 0
+        self.chunk_ids = np.zeros(0, dtype=np.int64)
+        self.indptr = np.zeros(1, dtype=np.int64)
+        self.indices = np.zeros(0, dtype=np.uint16)
+        self.data = np.zeros(0, dtype=np.float32)
+        self.doc_freq = np.zeros(FEATURE_DIM, dtype=np.float32)
+        self._idf = None
+        self._row_norms = None
+        self._rows = None
+
+    @property
+    def last_chunk_id(self) -> int:
+        return int(self.chunk_ids[self.count - 1]) if self.count else 0
+
+    @property
+    def nbytes(self) -> int:
+        return sum(array.nbytes for array in (self.chunk_ids, self.indptr, self.indices, self.data, self.doc_freq))
+
+    def add(self, rows):
+        """Append (chunk id, term ids, weights) rows to the index"""
+        if not rows:
+            return
+        nnz, count = int(self.indptr[self.count]), self.count + len(rows)
+        term_ids = np.concatenate([row[1] for row in rows])
+        lengths = np.fromiter((len(row[1]) for row in rows), dtype=np.int64, count=len(rows))
+
+        self.chunk_ids = _grow(self.chunk_ids, count)
+        self.indptr = _grow(self.indptr, count + 1)
+        self.indices = _grow(self.indices, nnz + len(term_ids))
+        self.data = _grow(self.data, nnz + len(term_ids))
+        self.chunk_ids[self.count:count] = [row[0] for row in rows]
+        self.indptr[self.count + 1:count + 1] = nnz + np.cumsum(lengths)
+        self.indices[nnz:nnz + len(term_ids)] = term_ids
+        self.data[nnz:nnz + len(term_ids)] = np.concatenate([row[2] for row in rows])
+        # Term ids are unique within a chunk, so each one counts one document
+        self.doc_freq += np.bincount(term_ids, minlength=FEATURE_DIM)
+        self.count = count
+        # IDF depends on every chunk, so weighted norms are recomputed lazily
+        self._idf = self._row_norms = self._rows = None
+
+    def _weights(self):
+        if self._idf is None:
+            nnz = int(self.indptr[self.count])
+            self._idf = np.log((1.0 + self.count) / (1.0 + self.doc_freq)) + 1.0
+            # Row number of every stored entry, for summing entries per chunk
+            self._rows = np.repeat(np.arange(self.count), np.diff(self.indptr[:self.count + 1]))
+            weighted = self.data[:nnz] * self._idf[self.indices[:nnz]]
+            self._row_norms = np.sqrt(np.bincount(self._rows, weights=weighted * weighted, minlength=self.count))
+        return self._idf, self._row_norms, self._rows
+
+    def search(self, query: str, k: int):
+        """Return [(chunk id, score)] for the k best matching chunks"""
+        term_ids, weights = hash_features(query)
+        if not self.count or not len(term_ids):
+            return []
+        idf, row_norms, rows = self._weights()
+        # Hash collisions within the query are summed, like in the chunk vectors
+        query_vector = np.zeros(FEATURE_DIM, dtype=np.float64)
+        np.add.at(query_vector, term_ids, weights)
+        query_vector *= idf
+
+        # Only entries in the query's columns contribute to the dot product
+        indices = self.indices[:int(self.indptr[self.count])]
+        matched = np.flatnonzero(query_vector[indices])
+        if not len(matched):
+            return []
+        columns = indices[matched]
+        scores = np.bincount(
+            rows[matched], weights=self.data[matched] * idf[columns] * query_vector[columns], minlength=self.count
+        )
+        norms = row_norms * np.linalg.norm(query_vector)
+        scores = np.divide(scores, norms, out=np.zeros_like(scores), where=norms > 0)
+
+        k = min(k, self.count)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(self.chunk_ids[i]), float(scores[i])) for i in top if scores[i] > 0]
+
+# Keyed by (database file, patient id)
+_index_cache: "OrderedDict[tuple, PatientIndex]" = OrderedDict()
+_index_lock = threading.Lock()
+
+def _load_rows(conn, patient_id: int, after_id: int):
+    rows = conn.execute(
+        '''
+        SELECT id, term_ids, term_weights FROM document_chunks
+        WHERE patient_id = ? AND id > ?
+        ORDER BY id
+        ''',
+        (patient_id, after_id)
+    ).fetchall()
+    return [
+        (row["id"], np.frombuffer(row["term_ids"], dtype=np.uint16), np.frombuffer(row["term_weights"], dtype=np.float32))
+        for row in rows
+    ]
+
+def _search(conn, patient_id: int, query: str, k: int):
+    """Search the patient's cached index after loading any chunks added since"""
+    key = (os.path.abspath(shard_path(shard_for_patient(patient_id))), patient_id)
+    with _index_lock:
+        index = _index_cache.pop(key, None) or PatientIndex()
+        index.add(_load_rows(conn, patient_id, index.last_chunk_id))
+        _index_cache[key] = index
+        while len(_index_cache) > INDEX_CACHE_SIZE:
+            _index_cache.popitem(last=False)
+        return index.search(query, k)
+
+def _insert_document(cursor, patient_id: int, text: str, source: Optional[str]) -> int:
+    """Insert and chunk a document unless the same text from the same source is already stored"""
+    content_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    existing = cursor.execute(
+        'SELECT id FROM patient_documents WHERE patient_id = ? AND content_hash = ? AND source IS ?',
+        (patient_id, content_hash, source)
+    ).fetchone()
+    if existing:
+        return existing["id"]
+
+    chunks = chunk_text(text)
+    document_id = allocate_row_ids("patient_documents")
+    cursor.execute(
+        'INSERT INTO patient_documents (id, patient_id, source, text, content_hash) VALUES (?, ?, ?, ?, ?)',
+        (document_id, patient_id, source, compress_text(text), content_hash)
+    )
+    first_chunk_id = allocate_row_ids("document_chunks", len(chunks)) if chunks else None
+    rows = []
+    for chunk_index, chunk in enumerate(chunks):
+        term_ids, weights = hash_features(chunk)
+        rows.append((first_chunk_id + chunk_index, patient_id, document_id, chunk_index, chunk,
+                     term_ids.tobytes(), weights.tobytes()))
+    cursor.executemany(
+        '''
+        INSERT INTO document_chunks (id, patient_id, document_id, chunk_index, text, term_ids, term_weights)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''',
+        rows
+    )
+    logger.info(f"Indexed document {document_id} for patient {patient_id} ({len(chunks)} chunks)")
+    return document_id
+
+# --- Public API ---
+
+def index_patient_document(patient_id: int, text: str, source: Optional[str] = None) -> int:
+    """
+    Store a document for a patient and index its chunks
+
+    Indexing the same text from the same source again returns the existing
+    document instead of adding a duplicate.
+
+    Args:
+        patient_id: Patient the document belongs to
+        text: Full document text
+        source: Where the document came from (e.g. the uploaded file name)
+
+    Returns:
+        The document id
+    """
+    with patient_write_connection(patient_id) as conn:
+        document_id = _insert_document(conn.cursor(), patient_id, text, source)
+        conn.commit()
+    return document_id
+
+def migrate_raw_text(patient_id: int) -> Optional[Dict[str, Any]]:
+    """
+    Move a legacy ``raw_text`` record out of the patient context into the index
+
+    The document and the context without ``raw_text`` are written in one
+    transaction, so a failure afterwards (e.g. in the model call) can't leave
+    the record in the context to be indexed again.
+
+    Returns:
+        The patient context without ``raw_text``, or None if there was nothing to move
+    """
+    with patient_write_connection(patient_id) as conn:
+        row = conn.execute('SELECT context FROM patients WHERE id = ?', (patient_id,)).fetchone()
+        context = _load_json_column(row["context"]) if row and row["context"] else None
+        if not context or not context.get("raw_text"):
+            conn.rollback()
+            return None
+        raw_text = context.pop("raw_text")
+        _insert_document(conn.cursor(), patient_id, raw_text, context.get("source"))
+        update_patient_context(patient_id, context, conn=conn)
+    return context
+
+def retrieve_relevant_chunks(patient_id: int, query: str, k: int = TOP_K) -> List[Dict[str, Any]]:
+    """Return the k document chunks most relevant to the query, best first"""
+    with get_patient_connection(patient_id) as conn:
+        matches = _search(conn, patient_id, query, k)
+        if not matches:
+            return []
+        placeholders = ", ".join("?" for _ in matches)
+        rows = conn.execute(
+            f'''
+            SELECT c.id, c.document_id, c.text, d.source
+            FROM document_chunks c JOIN patient_documents d ON d.id = c.document_id
+            WHERE c.id IN ({placeholders})
+            ''',
+            [chunk_id for chunk_id, _ in matches]
+        ).fetchall()
+    by_id = {row["id"]: row for row in rows}
+    return [
+        {
+            "document_id": by_id[chunk_id]["document_id"],
+            "source": by_id[chunk_id]["source"],
+            "score": round(score, 3),
+            "text": by_id[chunk_id]["text"],
+        }
+        for chunk_id, score in matches
+        if chunk_id in by_id
+    ]
+
+def get_patient_documents(patient_id: int) -> List[Dict[str, Any]]:
+    """List a patient's documents (without their text)"""
+    with get_patient_connection(patient_id) as conn:
+        rows = conn.execute(
+            '''
+            SELECT d.id, d.source, d.created_at, COUNT(c.id) AS chunks
+            FROM patient_documents d LEFT JOIN document_chunks c ON c.document_id = d.id
+            WHERE d.patient_id = ?
+            GROUP BY d.id
+            ORDER BY d.id
+            ''',
+            (patient_id,)
+        ).fetchall()
+    return [dict(row) for row in rows]
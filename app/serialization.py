@@ -0,0 +1,108 @@
+"""
+Fast JSON encoding for DB JSON columns and API responses.
+
+Uses orjson when it is installed and falls back to the standard library.
+Patient contexts are stored as JSON text, so endpoints that return them
+unchanged splice the stored text straight into the response body
+(``json_object``) instead of parsing it and encoding it again. Rows read from
+our own database are turned into response models with ``construct_trusted``,
+which skips pydantic validation.
+"""
+import json
+from datetime import datetime
+from typing import Any, Dict, Iterable, Optional
+
+from starlette.responses import JSONResponse, Response
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, the stdlib encoder always works
+    orjson = None
+
+def dumps(value: Any, indent: bool = False) -> bytes:
+    """Encode a value as UTF-8 JSON bytes"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(value, option=orjson.OPT_INDENT_2 if indent else 0)
+        except TypeError:
+            pass  # e.g. non-string keys or integers beyond 64 bits
+    if indent:
+        return json.dumps(value, indent=2, ensure_ascii=False, default=str).encode("utf-8")
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False, default=str).encode("utf-8")
+
+def dumps_text(value: Any) -> str:
+    """Encode a value as a JSON string, e.g. for a JSON column"""
+    return dumps(value).decode("utf-8")
+
+def loads(data):
+    """Parse JSON text or bytes"""
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass  # e.g. NaN written by the stdlib encoder
+    return json.loads(data)
+
+def json_object(fields: Dict[str, Any], raw: Optional[Dict[str, Any]] = None) -> bytes:
+    """
+    Encode a JSON object, copying pre-serialized values in verbatim
+
+    Args:
+        fields: Values to encode
+        raw: Values that are already JSON text (e.g. a context column);
+             None is written as ``null``
+    """
+    body = dumps(fields)
+    if not raw:
+        return body
+    parts = [body[:-1]]
+    separator = b"," if fields else b""
+    for key, value in raw.items():
+        if isinstance(value, str):
+            value = value.encode("utf-8")
+        parts.append(separator + dumps(key) + b":" + (b"null" if value is None else value))
+        separator = b","
+    parts.append(b"}")
+    return b"".join(parts)
+
+def json_rows(rows: Iterable[Dict[str, Any]], raw_columns: Iterable[str]) -> bytes:
+    """Encode rows as a JSON array, passing the raw_columns through verbatim"""
+    raw_columns = tuple(raw_columns)
+    return b"[" + b",".join(
+        json_object(
+            {key: value for key, value in row.items() if key not in raw_columns},
+            raw={key: row[key] for key in raw_columns if key in row}
+        )
+        for row in rows
+    ) + b"]"
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+class RawJSONResponse(Response):
+    """Response for a body that is already encoded JSON"""
+    media_type = "application/json"
+
+def _parse_datetime(value):
+    # SQLite CURRENT_TIMESTAMP is "YYYY-MM-DD HH:MM:SS"
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+def construct_trusted(model, row: Dict[str, Any]):
+    """
+    Build a response model from a trusted DB row without validating it
+
+    Only the model's own fields are copied. Timestamp strings are parsed for
+    ``datetime`` fields so the model serializes the same as a validated one.
+    """
+    values = {}
+    for name, field in model.model_fields.items():
+        if name not in row:
+            continue
+        value = row[name]
+        if field.annotation in (datetime, Optional[datetime]):
+            value = _parse_datetime(value)
+        values[name] = value
+    return model.model_construct(**values)
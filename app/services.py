@@ -8,15 +8,24 @@ from typing import Dict, Tuple, Any, Optional
 from google import genai
 import logfire
 
-from models import PROMPT_TEMPLATES
+from pydantic import ValidationError
+
+from models import PROMPT_TEMPLATES, STRUCTURED_PROMPT_TEMPLATES, STRUCTURED_RESPONSE_MODELS
 from database import get_patient, update_patient_context, add_interaction
+from retrieval import migrate_raw_text, retrieve_relevant_chunks
+from serialization import dumps
+from labs import lab_trend_summary
+from appointments import get_upcoming_appointments
+from admission import AdmissionRejected, controller as admission
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Initialize the Gemini client
 gemini_client = None
+GEMINI_MODEL_NAME = os.getenv("GEMINI_MODEL_NAME", "gemini-2.0-flash")  # or any other appropriate model
+
+# Ask Gemini for schema-constrained JSON instead of free text with <context> tags
+STRUCTURED_OUTPUT = os.getenv("CAREBEARS_STRUCTURED_OUTPUT", "1") != "0"
 
 def initialize_gemini():
     """Initialize the Gemini client if API key is available"""
@@ -24,7 +33,6 @@ def initialize_gemini():
 
     # Initialize the Gemini model
     GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-    GEMINI_MODEL_NAME = "gemini-2.0-flash"  # or any other appropriate model
 
     if GOOGLE_API_KEY:
         try:
@@ -58,6 +66,80 @@ def extract_context(response_text: str) -> Optional[Dict[str, Any]]:
             return {"raw_context": context_text}
     
     return None
+
+def parse_structured_response(response_text: str, prompt_type: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+    """
+    Parse a structured model response in a single validation pass
+
+    Args:
+        response_text: JSON text returned by the model
+        prompt_type: Prompt type whose context schema the patch must match
+
+    Returns:
+        Tuple of (markdown to display, context patch) or None if the
+        response does not match the schema
+    """
+    response_model = STRUCTURED_RESPONSE_MODELS.get(prompt_type)
+    if response_model is None or not response_text:
+        return None
+    try:
+        parsed = response_model.model_validate_json(response_text)
+    except ValidationError as e:
+        logfire.warn("Structured response failed schema validation", prompt_type=prompt_type, errors=e.error_count())
+        return None
+    # Empty lists and unset fields mean "no change", so they are not merged
+    context_patch = parsed.context_patch.model_dump(exclude_none=True, exclude_defaults=True)
+    return parsed.display_markdown, context_patch
+
+def structured_display_markdown(response_text: str) -> Optional[str]:
+    """The display_markdown of a structured response, even one whose context patch is invalid"""
+    try:
+        data = json.loads(response_text)
+    except (TypeError, json.JSONDecodeError):
+        return None
+    markdown = data.get("display_markdown") if isinstance(data, dict) else None
+    return markdown if isinstance(markdown, str) and markdown.strip() else None
+
+# List fields whose items are records, and the fields that identify an item.
+# Other list fields hold plain strings.
+CONTEXT_LIST_KEYS = {
+    "medications": ("name",),
+    "support_groups": ("name",),
+    "upcoming_appointments": ("provider", "date"),
+}
+
+def _item_key(item, key_fields):
+    if isinstance(item, dict):
+        return tuple(str(item.get(field) or "").strip().casefold() for field in key_fields)
+    return str(item).strip().casefold()
+
+def merge_context_patch(context: Dict[str, Any], patch: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Apply a context patch holding only new or changed facts
+
+    Scalar fields are replaced. List fields are merged into the stored list:
+    record items (see ``CONTEXT_LIST_KEYS``) update the stored item with the
+    same key or are appended, and plain items are appended unless already present.
+    """
+    merged = dict(context)
+    for field, value in patch.items():
+        current = merged.get(field)
+        if not isinstance(value, list) or not current:
+            merged[field] = value
+            continue
+        # Legacy contexts may hold a single string (e.g. care_gaps from the patient record)
+        items = list(current) if isinstance(current, list) else [current]
+        key_fields = CONTEXT_LIST_KEYS.get(field, ("name",))
+        positions = {_item_key(item, key_fields): i for i, item in enumerate(items)}
+        for item in value:
+            key = _item_key(item, key_fields)
+            if key not in positions:
+                positions[key] = len(items)
+                items.append(item)
+            elif isinstance(item, dict) and isinstance(items[positions[key]], dict):
+                items[positions[key]] = {**items[positions[key]], **item}
+        merged[field] = items
+    return merged
     
 def extract_patient_info_from_text(text: str) -> Dict[str, Any]:
     """
@@ -101,7 +183,8 @@ def extract_patient_info_from_text(text: str) -> Dict[str, Any]:
     
     try:
         # Call the Gemini API
-        with logfire.span("Calling Gemini API for patient extraction", model=GEMINI_MODEL_NAME):
+        with admission.admit("patient_extraction"), \
+                logfire.span("Calling Gemini API for patient extraction", model=GEMINI_MODEL_NAME):
             response = gemini_client.models.generate_content(model=GEMINI_MODEL_NAME, contents=extraction_prompt)
             response_text = response.text
             
@@ -119,10 +202,89 @@ def extract_patient_info_from_text(text: str) -> Dict[str, Any]:
         except json.JSONDecodeError as e:
             logfire.error("Failed to parse patient JSON from model response", error=str(e))
             return {"error": f"Failed to parse extracted patient data: {str(e)}"}
+    except AdmissionRejected:
+        raise
     except Exception as e:
         logfire.error("Error during Gemini API call for patient extraction", error=str(e))
         return {"error": f"Error extracting patient data: {str(e)}"}
 
+def prompt_request(prompt_type: str, structured: bool = STRUCTURED_OUTPUT) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+    """
+    Prompt template and Gemini generation config for a prompt type
+
+    In structured mode the config constrains the response to the prompt
+    type's schema; otherwise it is None and the template asks for
+    <context> tags. The template is None for unknown prompt types.
+    """
+    if structured and prompt_type in STRUCTURED_RESPONSE_MODELS:
+        return STRUCTURED_PROMPT_TEMPLATES[prompt_type], {
+            "response_mime_type": "application/json",
+            "response_schema": STRUCTURED_RESPONSE_MODELS[prompt_type],
+        }
+    return PROMPT_TEMPLATES.get(prompt_type), None
+
+def build_enhanced_context(patient: Dict[str, Any]) -> Dict[str, Any]:
+    """Merge the patient's stored context with their core record fields"""
+    enhanced_context = {
+        **(patient.get('context') or {}),
+        "name": patient["name"],
+        "dob": patient["dob"],
+        "location": patient["location"],
+        "diagnosis": patient["diagnosis"]
+    }
+    
+    # Add care gaps if available
+    if patient.get("care_gaps"):
+        enhanced_context["care_gaps"] = patient["care_gaps"]
+    
+    # Try to extract zip code from location if not already in context
+    if "zip_code" not in enhanced_context and patient["location"]:
+        # Simple regex to extract US zip code pattern
+        zip_match = re.search(r'(\d{5}(?:-\d{4})?)', patient["location"])
+        if zip_match:
+            enhanced_context["zip_code"] = zip_match.group(1)
+    return enhanced_context
+
+def build_prompt_context(patient_id: int, enhanced_context: Dict[str, Any], user_input: str) -> Dict[str, Any]:
+    """
+    The context sent with a prompt, without changing the stored context
+
+    Adds the patient's records relevant to the question, one trend line per
+    lab analyte and upcoming appointments from the calendar.
+    """
+    # Only the parts of the patient's records relevant to this question are sent
+    prompt_context = dict(enhanced_context)
+    relevant_records = retrieve_relevant_chunks(patient_id, user_input)
+    if relevant_records:
+        prompt_context["relevant_records"] = [chunk["text"] for chunk in relevant_records]
+
+    # Lab histories stay in the lab store; the model sees one trend line per analyte
+    lab_trends = lab_trend_summary(patient_id)
+    if lab_trends:
+        prompt_context["lab_trends"] = lab_trends
+
+    # Booked appointments come from the calendar rather than the stored context
+    scheduled = get_upcoming_appointments(patient_id)
+    if scheduled:
+        prompt_context["scheduled_appointments"] = [
+            {key: appointment[key] for key in ("provider", "starts_at", "location", "purpose") if appointment[key]}
+            for appointment in scheduled
+        ]
+    return prompt_context
+
+def build_full_prompt(prompt_template: str, context: Dict[str, Any], user_input: str) -> str:
+    """Construct the full prompt with patient context and user input"""
+    context_json = dumps(context, indent=True).decode("utf-8")
+    return f"""
+{prompt_template}
+
+PATIENT CONTEXT:
+{context_json}
+
+USER INPUT:
+{user_input}
+"""
+
 def process_prompt(
     prompt_type: str,
     patient_id: int,
@@ -139,45 +301,26 @@ def process_prompt(
     if not patient:
         return f"Error: Patient with ID {patient_id} not found.", {}
     
+    # Records uploaded before the document store existed live in the context;
+    # move them into the index once, committed before the model is called,
+    # instead of re-sending them every turn
+    if (patient.get('context') or {}).get("raw_text"):
+        patient['context'] = migrate_raw_text(patient_id) or patient['context']
+
     # Get the current context
     current_context = patient.get('context', {})
     
     # Get the prompt template
-    prompt_template = PROMPT_TEMPLATES.get(prompt_type)
+    prompt_template, generation_config = prompt_request(prompt_type)
     if not prompt_template:
         return f"Error: Prompt type '{prompt_type}' not recognized.", current_context
     
     # Enhance the context with patient information for more personalized responses
-    enhanced_context = {
-        **current_context,
-        "name": patient["name"],
-        "dob": patient["dob"],
-        "location": patient["location"],
-        "diagnosis": patient["diagnosis"]
-    }
-    
-    # Add care gaps if available
-    if patient.get("care_gaps"):
-        enhanced_context["care_gaps"] = patient["care_gaps"]
-    
-    # Try to extract zip code from location if not already in context
-    if "zip_code" not in enhanced_context and patient["location"]:
-        # Simple regex to extract US zip code pattern
-        zip_match = re.search(r'(\d{5}(?:-\d{4})?)', patient["location"])
-        if zip_match:
-            enhanced_context["zip_code"] = zip_match.group(1)
+    enhanced_context = build_enhanced_context(patient)
+    prompt_context = build_prompt_context(patient_id, enhanced_context, user_input)
     
     # Construct the full prompt with enhanced patient context and user input
-    context_json = json.dumps(enhanced_context, indent=2)
-    full_prompt = f"""
-{prompt_template}
-
-PATIENT CONTEXT:
-{context_json}
-
-USER INPUT:
-{user_input}
-"""
+    full_prompt = build_full_prompt(prompt_template, prompt_context, user_input)
     
     # Record the start time for performance monitoring
     start_time = time.time()
@@ -191,9 +334,12 @@ USER INPUT:
             model=GEMINI_MODEL_NAME
         )
         
-        # Call the Gemini API
-        with logfire.span("Calling Gemini API", model=GEMINI_MODEL_NAME):
-            response = gemini_client.models.generate_content(model=GEMINI_MODEL_NAME, contents=full_prompt)
+        # Call the Gemini API once admission control grants a slot
+        with admission.admit(prompt_type, patient_id) as queue_wait, \
+                logfire.span("Calling Gemini API", model=GEMINI_MODEL_NAME, queue_wait_seconds=queue_wait):
+            response = gemini_client.models.generate_content(
+                model=GEMINI_MODEL_NAME, contents=full_prompt, config=generation_config
+            )
             response_text = response.text
         
         # Calculate duration
@@ -206,12 +352,23 @@ USER INPUT:
         )
         
         # Extract context from the response
-        updated_context = extract_context(response_text)
+        structured = parse_structured_response(response_text, prompt_type) if generation_config else None
+        if structured:
+            response_text, updated_context = structured
+        elif generation_config and structured_display_markdown(response_text):
+            # The patch broke the schema but the answer is fine: show it, keep the context
+            response_text, updated_context = structured_display_markdown(response_text), None
+        else:
+            updated_context = extract_context(response_text)
+            if generation_config and updated_context and "raw_context" in updated_context:
+                # Don't let unparseable output pile up in the patient's context
+                logfire.warn("Discarding unstructured context", prompt_type=prompt_type, patient_id=patient_id)
+                updated_context = None
         
         # If context was extracted, update the patient's context
         if updated_context:
-            # Merge the updated context with the enhanced context
-            merged_context = {**enhanced_context, **updated_context}
+            # The patch only holds new or changed facts, so stored lists are kept
+            merged_context = merge_context_patch(enhanced_context, updated_context)
             update_patient_context(patient_id, merged_context)
             
             # Record the interaction in the database
@@ -241,6 +398,9 @@ USER INPUT:
             
             return response_text, enhanced_context
             
+    except AdmissionRejected:
+        # Shed calls surface as 429/503 instead of an error message
+        raise
     except Exception as e:
         # Log the error
         error_message = str(e)
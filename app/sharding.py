@@ -0,0 +1,183 @@
+"""
+Moving patients between database shards.
+
+Each patient lives entirely in one shard (see ``database.shard_for_patient``).
+A move copies the patient row and every patient-keyed table into the target
+shard, re-points the directory entry and then deletes the source rows. Child
+row ids are allocated in the directory (``database.GLOBAL_ID_TABLES``), so
+they are copied as they are: ids held by clients and export consumers stay
+valid, and archived interactions keep resolving through their ``archive_ref``.
+Rows written before ids were global can collide with rows in the target;
+such a move fails with an IntegrityError and changes nothing.
+
+The copy runs without locking the source. Just before switching, the source
+shard is write-locked and the patient's ``version`` re-checked. Every write to
+a patient-keyed table bumps the version (``database.VERSIONED_TABLES``), so if
+the patient was written to during the copy the target rows are discarded and
+the move fails with ``ShardMoveConflict``, without side effects, so it can be
+retried. Reminder bookkeeping (``database.UNVERSIONED_COLUMNS``) doesn't bump
+the version; it is copied again while the source is locked.
+
+Other workers may still have the old shard cached for a few seconds. Writes
+go through ``database.patient_write_connection``, which finds the patient
+gone from the old shard inside its transaction and resolves the shard again.
+"""
+import logging
+
+import database
+from database import get_db_connection, get_directory_connection, shard_for_patient, forget_shard
+
+logger = logging.getLogger(__name__)
+
+# Tables holding per-patient rows, copied with their ids
+PATIENT_TABLES = (
+    "interactions",
+    "patient_documents",
+    "document_chunks",
+    "lab_series",
+    # appointment_intervals follows through the appointments triggers
+    "appointments",
+    "patient_rollups",
+)
+
+class ShardMoveConflict(Exception):
+    """The patient was modified while being copied to another shard"""
+
+def _columns(conn, table):
+    return [row["name"] for row in conn.execute(f'PRAGMA table_info({table})')]
+
+def _delete_patient_rows(conn, patient_id):
+    for table in reversed(PATIENT_TABLES):
+        conn.execute(f'DELETE FROM {table} WHERE patient_id = ?', (patient_id,))
+    conn.execute('DELETE FROM patients WHERE id = ?', (patient_id,))
+
+def _copy_patient(source, target, patient_id):
+    """Copy a patient's rows into the target shard and return the copied version"""
+    patient = source.execute('SELECT * FROM patients WHERE id = ?', (patient_id,)).fetchone()
+    if patient is None:
+        raise ValueError(f"Patient {patient_id} not found in shard {shard_for_patient(patient_id)}")
+
+    # Leftovers from an interrupted move to this shard are replaced
+    _delete_patient_rows(target, patient_id)
+    columns = patient.keys()
+    target.execute(
+        f'INSERT INTO patients ({", ".join(columns)}) VALUES ({", ".join("?" for _ in columns)})',
+        tuple(patient)
+    )
+
+    for table in PATIENT_TABLES:
+        columns = _columns(source, table)
+        rows = source.execute(f'SELECT {", ".join(columns)} FROM {table} WHERE patient_id = ?', (patient_id,))
+        target.executemany(
+            f'INSERT INTO {table} ({", ".join(columns)}) VALUES ({", ".join("?" for _ in columns)})',
+            [tuple(row) for row in rows]
+        )
+    return patient["version"]
+
+def _sync_unversioned_columns(source, target, patient_id):
+    """Copy columns whose writes skip the version check (database.UNVERSIONED_COLUMNS)"""
+    for table, columns in database.UNVERSIONED_COLUMNS.items():
+        rows = source.execute(
+            f'SELECT {", ".join(columns)}, id FROM {table} WHERE patient_id = ?', (patient_id,)
+        ).fetchall()
+        target.executemany(
+            f'UPDATE {table} SET {", ".join(f"{column} = ?" for column in columns)} WHERE id = ?',
+            [tuple(row) for row in rows]
+        )
+
+def move_patient(patient_id, target_shard):
+    """
+    Move a patient and all of their rows to another shard
+
+    Returns:
+        Number of rows copied per table, or None if already on the target shard
+
+    Raises:
+        ShardMoveConflict: if the patient was written to during the copy
+    """
+    source_shard = shard_for_patient(patient_id)
+    if source_shard == target_shard:
+        return None
+
+    with get_db_connection(source_shard) as source, get_db_connection(target_shard) as target:
+        version = _copy_patient(source, target, patient_id)
+        target.commit()
+
+        # Block writers on the source while checking for changes and switching
+        source.execute('BEGIN IMMEDIATE')
+        current = source.execute('SELECT version FROM patients WHERE id = ?', (patient_id,)).fetchone()
+        if current is None or current["version"] != version:
+            source.rollback()
+            _delete_patient_rows(target, patient_id)
+            target.commit()
+            raise ShardMoveConflict(f"Patient {patient_id} changed while moving to shard {target_shard}")
+        # Reminder claims don't bump the version, so bring them over under the lock
+        _sync_unversioned_columns(source, target, patient_id)
+        target.commit()
+
+        with get_directory_connection() as directory:
+            directory.execute(
+                'INSERT OR REPLACE INTO shard_map (patient_id, shard) VALUES (?, ?)', (patient_id, target_shard)
+            )
+            directory.commit()
+        forget_shard(patient_id)
+
+        stats = {
+            table: source.execute(f'SELECT COUNT(*) FROM {table} WHERE patient_id = ?', (patient_id,)).fetchone()[0]
+            for table in PATIENT_TABLES
+        }
+        _delete_patient_rows(source, patient_id)
+        source.commit()
+
+    logger.info(f"Moved patient {patient_id} from shard {source_shard} to shard {target_shard}")
+    return stats
+
+def shard_sizes():
+    """Number of patients in every shard"""
+    sizes = {}
+    for shard in database.all_shards():
+        with get_db_connection(shard) as conn:
+            sizes[shard] = conn.execute('SELECT COUNT(*) FROM patients').fetchone()[0]
+    return sizes
+
+def rebalance(max_moves=None):
+    """
+    Even out patient counts across the configured shards
+
+    Patients on shards beyond ``CAREBEARS_SHARDS`` (after shrinking the shard
+    count) are drained first. Moves that conflict with live writes are skipped
+    and picked up by the next run.
+
+    Returns:
+        List of (patient_id, source shard, target shard) moves made
+    """
+    sizes = shard_sizes()
+    active = list(range(database.SHARD_COUNT))
+    moves = []
+    skipped = set()
+    while max_moves is None or len(moves) < max_moves:
+        target = min(active, key=lambda shard: sizes[shard])
+        retired = [shard for shard in sizes if shard not in active and sizes[shard]]
+        if retired:
+            source = retired[0]
+        else:
+            source = max(active, key=lambda shard: sizes[shard])
+            if sizes[source] - sizes[target] <= 1:
+                break
+        with get_db_connection(source) as conn:
+            row = conn.execute(
+                f'SELECT id FROM patients WHERE id NOT IN ({", ".join("?" for _ in skipped)}) ORDER BY id DESC LIMIT 1',
+                tuple(skipped)
+            ).fetchone()
+        if row is None:
+            break
+        try:
+            move_patient(row["id"], target)
+        except ShardMoveConflict as e:
+            logger.warning(str(e))
+            skipped.add(row["id"])
+            continue
+        sizes[source] -= 1
+        sizes[target] += 1
+        moves.append((row["id"], source, target))
+    return moves
@@ -0,0 +1,139 @@
+"""
+Logfire and logging setup that keeps telemetry off the request path.
+
+``CAREBEARS_TELEMETRY`` selects the mode:
+
+* ``sampled`` (default): traces are tail-sampled. Every trace with a warning
+  or error is kept, and so is every trace slower than
+  ``CAREBEARS_TRACE_SLOW_SECONDS``. Only ``CAREBEARS_TRACE_SAMPLE_RATE``
+  (default 1%) of the remaining fast, healthy traces is exported.
+  ``CAREBEARS_TRACE_HEAD_RATE`` additionally drops that share of traces up
+  front, before any span is recorded.
+* ``full``: every span is exported and printed to the console, as before.
+* ``off``: spans are not recorded or exported at all.
+
+Spans go to Logfire through its batch processor: a bounded in-memory queue
+(``OTEL_BSP_MAX_QUEUE_SIZE``) drained by a background thread. Spans are
+dropped when the queue is full, and failed exports are retried from disk in
+the background, so an unreachable collector never blocks a request. The
+console exporter writes each span inline, so it is only on in ``full`` mode
+unless ``CAREBEARS_TELEMETRY_CONSOLE=1``.
+
+Standard logging goes through a ``QueueHandler``: requests only enqueue the
+record, a ``QueueListener`` thread writes it out, and records are dropped
+(and counted) when ``CAREBEARS_LOG_QUEUE_SIZE`` are already waiting.
+"""
+import atexit
+import logging
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+import logfire
+
+logger = logging.getLogger(__name__)
+
+TELEMETRY_MODE = os.getenv("CAREBEARS_TELEMETRY", "sampled")
+SAMPLE_RATE = float(os.getenv("CAREBEARS_TRACE_SAMPLE_RATE", "0.01"))
+HEAD_RATE = float(os.getenv("CAREBEARS_TRACE_HEAD_RATE", "1.0"))
+SLOW_SECONDS = float(os.getenv("CAREBEARS_TRACE_SLOW_SECONDS", "1.0"))
+LOG_QUEUE_SIZE = int(os.getenv("CAREBEARS_LOG_QUEUE_SIZE", "10000"))
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+MODES = ("sampled", "full", "off")
+
+# Give up on an unreachable collector quickly instead of the SDK default 30s
+os.environ.setdefault("OTEL_BSP_EXPORT_TIMEOUT", "10000")
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler that drops records instead of blocking when the queue is full"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+_log_handler = None
+_log_listener = None
+
+def configure_logging(level=logging.INFO, stream=None, queue_size=LOG_QUEUE_SIZE):
+    """Send standard logging through a bounded queue to a background writer"""
+    global _log_handler, _log_listener
+    stop_logging()
+
+    output = logging.StreamHandler(stream)
+    output.setFormatter(logging.Formatter(LOG_FORMAT))
+    _log_handler = DroppingQueueHandler(queue.Queue(queue_size))
+    _log_listener = QueueListener(_log_handler.queue, output, respect_handler_level=True)
+    _log_listener.start()
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(_log_handler)
+    root.setLevel(level)
+    return _log_handler
+
+def stop_logging():
+    """Write out queued records and stop the background writer"""
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
+
+atexit.register(stop_logging)
+
+def sampling_options(mode=TELEMETRY_MODE):
+    """Logfire sampling for a telemetry mode (None records everything)"""
+    if mode == "full":
+        return None
+    if mode == "off":
+        return logfire.SamplingOptions(head=0.0)
+    return logfire.SamplingOptions.level_or_duration(
+        head=HEAD_RATE, level_threshold="warn", duration_threshold=SLOW_SECONDS, background_rate=SAMPLE_RATE
+    )
+
+def configure(service_name, token=None, mode=TELEMETRY_MODE, **options):
+    """
+    Configure logging and Logfire for a telemetry mode
+
+    Extra options are passed to ``logfire.configure``. If Logfire can't be
+    configured (e.g. a malformed token) the app keeps running with export
+    turned off.
+    """
+    if mode not in MODES:
+        raise ValueError(f"CAREBEARS_TELEMETRY must be one of {', '.join(MODES)}, not {mode!r}")
+    configure_logging()
+    console_default = "1" if mode == "full" else "0"
+    settings = {
+        "service_name": service_name,
+        "token": token,
+        "sampling": sampling_options(mode),
+        "console": None if os.getenv("CAREBEARS_TELEMETRY_CONSOLE", console_default) == "1" else False,
+        **options,
+    }
+    if mode == "off":
+        settings["send_to_logfire"] = False
+    try:
+        logfire.configure(**settings)
+    except Exception as e:
+        logger.warning(f"Logfire export disabled, configuration failed: {e}")
+        logfire.configure(**{**settings, "token": None, "send_to_logfire": False})
+
+def stats():
+    """Telemetry settings and log queue health"""
+    return {
+        "mode": TELEMETRY_MODE,
+        "sample_rate": SAMPLE_RATE,
+        "head_rate": HEAD_RATE,
+        "slow_seconds": SLOW_SECONDS,
+        "log_queue": {
+            "queued": _log_handler.queue.qsize() if _log_handler else 0,
+            "capacity": _log_handler.queue.maxsize if _log_handler else 0,
+            "dropped": _log_handler.dropped if _log_handler else 0,
+        },
+    }
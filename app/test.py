@@ -1,8 +1,23 @@
+import asyncio
 import os
 import unittest
 from unittest.mock import patch, MagicMock
+import gzip
+import io
 import json
+import logging
+import queue
+import re
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+import numpy as np
 from fastapi.testclient import TestClient
+import logfire
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
 
 # Initialize environment variables for testing
 os.environ["GOOGLE_API_KEY"] = "test_api_key"
@@ -10,10 +25,27 @@ os.environ["LOGFIRE_TOKEN"] = "test_logfire_token"
 
 # Import modules after setting environment variables
 from .main import app
+from . import main as app_main
 from .database import init_db, get_db_connection
-from .models import PatientCreate, PromptRequest
+from . import database
+from . import archive
+from . import evalbench
+from . import services
+from . import retrieval
+from . import sharding
+from . import serialization
+from . import admission
+from . import labs
+from . import appointments
+from . import export
+from . import telemetry
+from . import http_cache
+from .models import PatientCreate, PatientResponse, PromptRequest
 from .services import process_prompt, extract_context
 
+# archive as the app's flat imports see it (app.archive is a separate module)
+flat_archive = sys.modules[export.load_archived_interaction.__module__]
+
 # Create a test client
 client = TestClient(app)
 
@@ -92,5 +124,1093 @@ class TestCareBears(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json(), {"status": "ok"})
 
+class TempDatabaseTestCase(unittest.TestCase):
+    """Base class for tests that need an isolated SQLite database"""
+
+    def setUp(self):
+        self._old_cwd = os.getcwd()
+        self._tmp = tempfile.TemporaryDirectory()
+        os.chdir(self._tmp.name)
+        Path("data").mkdir()
+        init_db()
+
+    def tearDown(self):
+        os.chdir(self._old_cwd)
+        self._tmp.cleanup()
+
+class TestColumnCompression(TempDatabaseTestCase):
+    """Tests for transparent column compression"""
+
+    def test_round_trip_compresses_large_values(self):
+        raw_text = "Progress note: docetaxel every 3 weeks. " * 50
+        patient_id = database.add_patient("Jane", "10/12/1985", "94538", "Breast cancer",
+                                          context={"raw_text": raw_text})
+        database.add_interaction(patient_id, "base", "hi", "## Hello\n" * 100, {}, {"raw_text": raw_text})
+
+        with get_db_connection() as conn:
+            stored = conn.execute("SELECT response, context_after FROM interactions").fetchone()
+        self.assertIsInstance(stored["response"], bytes)
+        self.assertLess(len(stored["context_after"]), len(raw_text))
+
+        self.assertEqual(database.get_patient(patient_id)["context"]["raw_text"], raw_text)
+        interaction = database.get_patient_interactions(patient_id)[0]
+        self.assertEqual(interaction["response"], "## Hello\n" * 100)
+        self.assertEqual(interaction["context_after"]["raw_text"], raw_text)
+
+    def test_column_projection_skips_context(self):
+        patient_id = database.add_patient("Jane", "10/12/1985", "94538", "Breast cancer")
+        database.add_interaction(patient_id, "base", "hi", "hello", {}, {"a": 1})
+        interaction = database.get_patient_interactions(patient_id, columns=("id", "response"))[0]
+        self.assertEqual(set(interaction), {"id", "response"})
+        with self.assertRaises(ValueError):
+            database.get_patient_interactions(patient_id, columns=("id; DROP TABLE patients",))
+
+    def test_migration_compresses_legacy_rows(self):
+        context = json.dumps({"raw_text": "legacy record " * 100})
+        with get_db_connection() as conn:
+            conn.execute(
+                "INSERT INTO patients (name, dob, location, diagnosis, context) VALUES (?, ?, ?, ?, ?)",
+                ("Old", "01/01/1950", "12345", "CHF", context)
+            )
+            conn.commit()
+
+        stats = database.migrate_compress_columns(batch_size=1)
+        self.assertEqual(stats["patients.context"], 1)
+        self.assertEqual(database.migrate_compress_columns()["patients.context"], 0)
+        self.assertEqual(database.get_patient(1)["context"], json.loads(context))
+
+class TestInteractionArchive(TempDatabaseTestCase):
+    """Tests for interaction retention and archival"""
+
+    def setUp(self):
+        super().setUp()
+        archive._read_member.cache_clear()
+
+    def test_archive_keeps_summary_and_hydrates(self):
+        patient_id = database.add_patient("Jane", "10/12/1985", "94538", "Breast cancer")
+        old_id = database.add_interaction(patient_id, "base", "old question", "## Old answer\n" + "details " * 100,
+                                          {}, {"visit": "2022"})
+        new_id = database.add_interaction(patient_id, "base", "new question", "New answer", {}, {})
+        with get_db_connection() as conn:
+            conn.execute("UPDATE interactions SET created_at = datetime('now', '-400 days') WHERE id = ?", (old_id,))
+            conn.commit()
+
+        stats = archive.archive_old_interactions(retention_days=180, batch_size=1)
+        self.assertEqual(stats, {"archived": 1, "batches": 1})
+        self.assertEqual(archive.archive_old_interactions(retention_days=180)["archived"], 0)
+
+        hot = {row["id"]: row for row in database.get_patient_interactions(patient_id)}
+        self.assertIsNotNone(hot[old_id]["archived_at"])
+        self.assertTrue(hot[old_id]["response"].startswith("Old answer"))
+        self.assertLessEqual(len(hot[old_id]["response"]), archive.SUMMARY_CHARS)
+        self.assertIsNone(hot[new_id]["archived_at"])
+
+        hydrated = {row["id"]: row for row in archive.hydrate_archived_interactions(hot.values())}
+        self.assertIn("details details", hydrated[old_id]["response"])
+        self.assertEqual(hydrated[old_id]["context_after"], {"visit": "2022"})
+        self.assertEqual(hydrated[new_id]["response"], "New answer")
+
+class TestEvalBench(unittest.TestCase):
+    """Tests for the offline model evaluation bench"""
+
+    def test_fake_run_is_cached_and_scored(self):
+        cases = evalbench.build_cases(prompt_types=["base", "symptom_check"])
+        self.assertTrue(cases)
+        self.assertEqual(cases[0].patient["name"], "Jasmine Connor")
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            backends = [evalbench.FakeBackend("fake-a"), evalbench.FakeBackend("fake-b")]
+            first = evalbench.run_bench(backends, cases, concurrency=2, cache_dir=Path(cache_dir))
+            second = evalbench.run_bench(backends, cases, concurrency=2, cache_dir=Path(cache_dir))
+
+        self.assertEqual(len(first), 2 * len(cases))
+        self.assertFalse(any(result.cached for result in first))
+        self.assertTrue(all(result.cached for result in second))
+
+        summary = evalbench.summarize(second)
+        self.assertEqual(summary["fake-a"]["context_extraction_rate"], 1.0)
+        self.assertEqual(summary["fake-a"]["rubric_pass_rate"], 1.0)
+        self.assertIn(evalbench.pick_model(summary, 0.9, 0.8), {"fake-a", "fake-b"})
+        self.assertIsNone(evalbench.pick_model(summary, 1.1, 0.8))
+
+    def test_prompts_match_what_process_prompt_sends(self):
+        cases = evalbench.build_cases(prompt_types=["base"])[:1]
+        prompts = []
+
+        class RecordingBackend(evalbench.FakeBackend):
+            def generate(self, prompt, config=None):
+                prompts.append(prompt)
+                return super().generate(prompt, config)
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            evalbench.run_bench([RecordingBackend("fake-a")], cases, cache_dir=Path(cache_dir))
+
+        context = json.loads(re.search(r'PATIENT CONTEXT:\n(.*)\n\nUSER INPUT:', prompts[0], re.DOTALL).group(1))
+        self.assertNotIn("raw_text", context)
+        self.assertTrue(context["relevant_records"])
+        self.assertLess(sum(len(text) for text in context["relevant_records"]), len(cases[0].record))
+
+    def test_structured_mode_scores_what_the_app_parses(self):
+        cases = evalbench.build_cases(prompt_types=["base", "symptom_check"])
+        backend = evalbench.FakeBackend("fake-a")
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            structured = evalbench.run_bench([backend], cases, cache_dir=Path(cache_dir), structured=True)
+            legacy = evalbench.run_bench([backend], cases, cache_dir=Path(cache_dir), structured=False)
+
+        # The modes send different templates and schemas, so neither reuses the other's cache
+        self.assertFalse(any(result.cached for result in structured + legacy))
+        for result in structured:
+            self.assertIsNotNone(services.parse_structured_response(result.response, result.prompt_type))
+        summary = evalbench.summarize(structured)
+        self.assertEqual(summary["fake-a"]["context_extraction_rate"], 1.0)
+        self.assertEqual(summary["fake-a"]["rubric_pass_rate"], 1.0)
+
+        # Tagged text is not a valid structured response
+        extracted, _ = evalbench.score_response("base", legacy[0].response, {}, structured=True)
+        self.assertFalse(extracted)
+
+class TestHttpCaching(TempDatabaseTestCase):
+    """Tests for ETag/Last-Modified handling and static asset caching"""
+
+    def test_patient_etag_round_trip(self):
+        patient_id = database.add_patient("Jane", "10/12/1985", "94538", "Breast cancer")
+        first = client.get(f"/api/patients/{patient_id}")
+        self.assertEqual(first.status_code, 200)
+        etag = first.headers["etag"]
+
+        cached = client.get(f"/api/patients/{patient_id}", headers={"If-None-Match": etag})
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(cached.headers["etag"], etag)
+
+        database.add_interaction(patient_id, "base", "hi", "hello", {}, {})
+        changed = client.get(f"/api/patients/{patient_id}", headers={"If-None-Match": etag})
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed.headers["etag"], etag)
+
+    def test_interactions_etag_depends_on_limit(self):
+        patient_id = database.add_patient("Jane", "10/12/1985", "94538", "Breast cancer")
+        etag = client.get(f"/api/patients/{patient_id}/interactions?limit=5").headers["etag"]
+        self.assertEqual(
+            client.get(f"/api/patients/{patient_id}/interactions?limit=5", headers={"If-None-Match": etag}).status_code,
+            304
+        )
+        self.assertEqual(
+            client.get(f"/api/patients/{patient_id}/interactions?limit=6", headers={"If-None-Match": etag}).status_code,
+            200
+        )
+        self.assertEqual(client.get("/api/patients/999/interactions").status_code, 404)
+
+    def test_static_versioned_assets_are_long_lived(self):
+        response = client.get("/static/css/styles.css?v=abc", headers={"Accept-Encoding": "identity"})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("immutable", response.headers["cache-control"])
+        self.assertEqual(response.headers["vary"], "Accept-Encoding")
+
+    def test_static_variant_respects_rejected_encodings(self):
+        with tempfile.TemporaryDirectory() as static_dir:
+            path = os.path.join(static_dir, "app.js")
+            with open(path, "w") as f:
+                f.write("console.log('care');\n" * 50)
+            with open(path + ".gz", "wb") as f:
+                f.write(gzip.compress(b"console.log('care');\n" * 50))
+            static_client = TestClient(http_cache.CachedStaticFiles(directory=static_dir))
+
+            self.assertEqual(static_client.get("/app.js", headers={"Accept-Encoding": "gzip"}).headers.get("content-encoding"), "gzip")
+            for accept in ("gzip;q=0", "identity", "br, gzip ; q=0.0", "*;q=0"):
+                response = static_client.get("/app.js", headers={"Accept-Encoding": accept})
+                self.assertNotIn("content-encoding", response.headers, accept)
+            response = static_client.get("/app.js", headers={"Accept-Encoding": "*"})
+            self.assertEqual(response.headers.get("content-encoding"), "gzip")
+
+        self.assertEqual(http_cache.accepted_encodings("br;q=0.5, GZIP, deflate;q=bad"), {"br": 0.5, "gzip": 1.0, "deflate": 0.0})
+
+class TestStructuredOutput(TempDatabaseTestCase):
+    """Tests for schema-constrained structured model output"""
+
+    def test_parse_structured_response(self):
+        text = json.dumps({
+            "display_markdown": "## Support groups\n- Fremont Cancer Circle",
+            "context_patch": {"support_groups": [{"name": "Fremont Cancer Circle", "location": "94538"}]}
+        })
+        display, patch = services.parse_structured_response(text, "find_care_groups")
+        self.assertTrue(display.startswith("## Support groups"))
+        self.assertEqual(patch, {"support_groups": [{"name": "Fremont Cancer Circle", "location": "94538"}]})
+
+        self.assertIsNone(services.parse_structured_response("{'name': 'John'}", "find_care_groups"))
+        self.assertIsNone(services.parse_structured_response('{"context_patch": {}}', "base"))
+
+    @patch.object(services, "gemini_client")
+    def test_process_prompt_merges_patch_only(self, mock_gemini):
+        patient_id = database.add_patient("Jane", "10/12/1985", "94538", "Breast cancer")
+        mock_response = MagicMock()
+        mock_response.text = json.dumps({
+            "display_markdown": "## Go to urgent care",
+            "context_patch": {"reported_symptoms": ["fever"], "triage_level": "urgent"}
+        })
+        mock_gemini.models.generate_content.return_value = mock_response
+
+        response_text, context = services.process_prompt("symptom_check", patient_id, "I have a fever")
+        self.assertEqual(response_text, "## Go to urgent care")
+        self.assertEqual(context["triage_level"], "urgent")
+        self.assertEqual(context["reported_symptoms"], ["fever"])
+        config = mock_gemini.models.generate_content.call_args.kwargs["config"]
+        self.assertEqual(config["response_mime_type"], "application/json")
+
+        mock_response.text = "Not JSON <context>{'junk': True}</context>"
+        _, context = services.process_prompt("symptom_check", patient_id, "Still feverish")
+        self.assertNotIn("raw_context", context)
+
+    @patch.object(services, "gemini_client")
+    def test_invalid_patch_still_shows_display_markdown(self, mock_gemini):
+        patient_id = database.add_patient("Jane", "10/12/1985", "94538", "Breast cancer", context={"notes": ["Lives alone"]})
+        mock_response = MagicMock()
+        mock_response.text = json.dumps({
+            "display_markdown": "## Go to urgent care",
+            "context_patch": {"triage_level": ["not", "a", "level"], "made_up_field": 1}
+        })
+        mock_gemini.models.generate_content.return_value = mock_response
+
+        response_text, context = services.process_prompt("symptom_check", patient_id, "I have a fever")
+        self.assertEqual(response_text, "## Go to urgent care")
+        self.assertNotIn("triage_level", context)
+        self.assertEqual(context["notes"], ["Lives alone"])
+        stored = database.get_patient_interactions(patient_id)[0]["response"]
+        self.assertEqual(stored, "## Go to urgent care")
+        # Rows stored whole before this fix still render as markdown
+        self.assertIn("Go to urgent care", app_main.format_llm_response(mock_response.text))
+        self.assertNotIn("context_patch", app_main.format_llm_response(mock_response.text))
+
+    @patch.object(services, "gemini_client")
+    def test_partial_patch_keeps_stored_lists(self, mock_gemini):
+        patient_id = database.add_patient("Jane", "10/12/1985", "94538", "Breast cancer", context={
+            "medications": [{"name": "Tamoxifen", "dose": "20mg"}, {"name": "Metformin", "dose": "500mg"}],
+            "notes": ["Prefers morning calls"],
+        })
+        mock_response = MagicMock()
+        mock_response.text = json.dumps({
+            "display_markdown": "ok",
+            "context_patch": {"medications": [{"name": "Ondansetron"}, {"name": "tamoxifen", "schedule": "daily"}]}
+        })
+        mock_gemini.models.generate_content.return_value = mock_response
+        _, context = services.process_prompt("medication_reminder", patient_id, "I was given ondansetron")
+        self.assertEqual(
+            context["medications"],
+            [{"name": "tamoxifen", "dose": "20mg", "schedule": "daily"}, {"name": "Metformin", "dose": "500mg"},
+             {"name": "Ondansetron"}]
+        )
+
+        mock_response.text = json.dumps({
+            "display_markdown": "ok", "context_patch": {"notes": ["Lives alone", "prefers morning calls"]}
+        })
+        services.process_prompt("base", patient_id, "I live alone")
+        stored = database.get_patient(patient_id)["context"]
+        self.assertEqual(stored["notes"], ["Prefers morning calls", "Lives alone"])
+        self.assertEqual(len(stored["medications"]), 3)
+
+class TestRetrieval(TempDatabaseTestCase):
+    """Tests for the patient document retrieval index"""
+
+    RECORD = (Path(__file__).resolve().parent.parent / "testpatients" / "jane.txt").read_text(encoding="utf-8")
+
+    def test_chunk_text_respects_size(self):
+        chunks = retrieval.chunk_text(self.RECORD, max_chars=300)
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(all(len(chunk) <= 600 for chunk in chunks))
+        self.assertIn("tamoxifen", " ".join(chunks))
+
+    def test_retrieves_relevant_chunks_incrementally(self):
+        patient_id = database.add_patient("Jane", "10/12/1985", "94538", "Breast cancer")
+        retrieval.index_patient_document(patient_id, self.RECORD, source="jane.txt")
+        retrieval.index_patient_document(patient_id, "Lab results\n\nHbA1c 6.1 percent, fasting glucose 102", "labs.txt")
+
+        results = retrieval.retrieve_relevant_chunks(patient_id, "What was my HbA1c glucose result?", k=1)
+        self.assertEqual(results[0]["source"], "labs.txt")
+
+        # A document added after the index was cached is picked up
+        retrieval.index_patient_document(patient_id, "Cardiology note\n\nEchocardiogram ejection fraction 55", "echo.txt")
+        results = retrieval.retrieve_relevant_chunks(patient_id, "echocardiogram ejection fraction", k=2)
+        self.assertEqual(results[0]["source"], "echo.txt")
+        self.assertEqual(len(retrieval.get_patient_documents(patient_id)), 3)
+        self.assertEqual(retrieval.retrieve_relevant_chunks(patient_id, "zzzz qqqq"), [])
+
+    def test_sparse_index_matches_dense_scoring(self):
+        chunks = retrieval.chunk_text(self.RECORD * 5, max_chars=200)
+        index = retrieval.PatientIndex()
+        for start in range(0, len(chunks), 7):
+            index.add([(i + 1, *retrieval.hash_features(chunk)) for i, chunk in enumerate(chunks[start:start + 7], start)])
+
+        dense = np.zeros((len(chunks), retrieval.FEATURE_DIM))
+        for i, chunk in enumerate(chunks):
+            term_ids, weights = retrieval.hash_features(chunk)
+            dense[i, term_ids] = weights
+        idf = np.log((1.0 + len(chunks)) / (1.0 + (dense > 0).sum(axis=0))) + 1.0
+        query = "tamoxifen dose and side effects"
+        query_vector = np.zeros(retrieval.FEATURE_DIM)
+        term_ids, weights = retrieval.hash_features(query)
+        query_vector[term_ids] = weights
+        weighted = dense * idf
+        expected = weighted @ (query_vector * idf) / (np.linalg.norm(weighted, axis=1) * np.linalg.norm(query_vector * idf))
+
+        results = index.search(query, k=3)
+        self.assertEqual([chunk_id for chunk_id, _ in results], list(np.argsort(-expected)[:3] + 1))
+        np.testing.assert_allclose([score for _, score in results], np.sort(expected)[::-1][:3], rtol=1e-5)
+        # Far smaller than one dense float32 row per chunk
+        self.assertLess(index.nbytes, len(chunks) * retrieval.FEATURE_DIM)
+
+    @patch.object(services, "gemini_client")
+    def test_prompt_sends_top_chunks_not_raw_text(self, mock_gemini):
+        patient_id = database.add_patient("Jane", "10/12/1985", "94538", "Breast cancer",
+                                          context={"source": "file_upload", "raw_text": self.RECORD * 20})
+        mock_response = MagicMock()
+        mock_response.text = json.dumps({"display_markdown": "ok", "context_patch": {}})
+        mock_gemini.models.generate_content.return_value = mock_response
+
+        _, context = services.process_prompt("medication_reminder", patient_id, "When do I take tamoxifen?")
+        prompt = mock_gemini.models.generate_content.call_args.kwargs["contents"]
+        self.assertIn("tamoxifen", prompt.lower())
+        self.assertLess(len(prompt), len(self.RECORD) * 4)
+        self.assertNotIn("raw_text", context)
+        self.assertNotIn("raw_text", database.get_patient(patient_id)["context"])
+
+    @patch.object(services, "gemini_client")
+    def test_raw_text_moves_once_even_if_the_call_fails(self, mock_gemini):
+        patient_id = database.add_patient("Jane", "10/12/1985", "94538", "Breast cancer",
+                                          context={"source": "file_upload", "raw_text": self.RECORD})
+        mock_gemini.models.generate_content.side_effect = RuntimeError("model unavailable")
+        for _ in range(3):
+            response_text, _ = services.process_prompt("base", patient_id, "How am I doing?")
+            self.assertTrue(response_text.startswith("Error processing prompt"))
+
+        self.assertEqual(len(retrieval.get_patient_documents(patient_id)), 1)
+        self.assertNotIn("raw_text", database.get_patient(patient_id)["context"])
+        # Uploading the same record again doesn't add a duplicate either
+        document_id = retrieval.get_patient_documents(patient_id)[0]["id"]
+        self.assertEqual(retrieval.index_patient_document(patient_id, self.RECORD, source="file_upload"), document_id)
+
+
+class TestSharding(TempDatabaseTestCase):
+    """Tests for sharded patient storage"""
+
+    def setUp(self):
+        super().setUp()
+        # sharding uses the app's flat imports, so configure those modules
+        self.db = sharding.database
+        patcher = patch.object(self.db, "SHARD_COUNT", 3)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.db.init_db()
+        flat_archive._read_member.cache_clear()
+
+    def test_patients_spread_over_shards(self):
+        patient_ids = [self.db.add_patient(f"P{i}", "01/01/1980", "94538", "Flu") for i in range(6)]
+        self.assertEqual(len(set(patient_ids)), 6)
+        self.assertEqual(sharding.shard_sizes(), {0: 2, 1: 2, 2: 2})
+        for patient_id in patient_ids:
+            self.db.add_interaction(patient_id, "base", "hi", f"answer {patient_id}", {}, {})
+            self.assertEqual(self.db.get_patient(patient_id)["name"], f"P{patient_ids.index(patient_id)}")
+            self.assertEqual(self.db.get_patient_interactions(patient_id)[0]["response"], f"answer {patient_id}")
+
+    def test_move_patient_keeps_history_documents_and_archive(self):
+        patient_id = self.db.add_patient("Jane", "10/12/1985", "94538", "Breast cancer")
+        source = self.db.shard_for_patient(patient_id)
+        old_id = self.db.add_interaction(patient_id, "base", "old", "Old answer " * 50, {}, {"visit": "2022"})
+        self.db.add_interaction(patient_id, "base", "new", "New answer", {}, {})
+        retrieval.index_patient_document(patient_id, "Lab results\n\nHbA1c 6.1 percent", "labs.txt")
+        with self.db.get_patient_connection(patient_id) as conn:
+            conn.execute("UPDATE interactions SET created_at = datetime('now', '-400 days') WHERE id = ?", (old_id,))
+            conn.commit()
+        self.assertEqual(flat_archive.archive_old_interactions(retention_days=180)["archived"], 1)
+
+        booked = appointments.add_appointment(patient_id, "GP", time.time() + 86400, time.time() + 88200)
+        before = {row["user_input"]: row["id"] for row in self.db.get_patient_interactions(patient_id)}
+        archive_sizes = {path: path.stat().st_size for path in flat_archive.ARCHIVE_DIR.rglob("*.ndjson.gz")}
+
+        target = (source + 1) % 3
+        stats = sharding.move_patient(patient_id, target)
+        self.assertEqual(stats, {"interactions": 2, "patient_documents": 1, "document_chunks": 1, "lab_series": 0,
+                                 "appointments": 1, "patient_rollups": 1})
+        # Ids survive the move and the archive is read in place
+        self.assertEqual({row["user_input"]: row["id"] for row in self.db.get_patient_interactions(patient_id)}, before)
+        self.assertTrue(appointments.cancel_appointment(patient_id, booked["id"]))
+        self.assertEqual(
+            {path: path.stat().st_size for path in flat_archive.ARCHIVE_DIR.rglob("*.ndjson.gz")}, archive_sizes
+        )
+        self.assertEqual(self.db.shard_for_patient(patient_id), target)
+        self.assertEqual(sharding.shard_sizes()[source], 0)
+
+        interactions = flat_archive.hydrate_archived_interactions(self.db.get_patient_interactions(patient_id))
+        by_input = {row["user_input"]: row for row in interactions}
+        self.assertEqual(by_input["old"]["context_after"], {"visit": "2022"})
+        self.assertIn("Old answer Old answer", by_input["old"]["response"])
+        results = retrieval.retrieve_relevant_chunks(patient_id, "HbA1c result")
+        self.assertEqual(results[0]["source"], "labs.txt")
+
+    def test_move_fails_if_any_patient_table_is_written_during_copy(self):
+        patient_id = self.db.add_patient("Jane", "10/12/1985", "94538", "Breast cancer")
+        source = self.db.shard_for_patient(patient_id)
+        copy_patient = sharding._copy_patient
+        writes = [
+            lambda: retrieval.index_patient_document(patient_id, "Echo\n\nEjection fraction 55", "echo.txt"),
+            lambda: labs.ingest_lab_results(patient_id, [{"analyte": "hba1c", "value": 6.1, "taken_at": "2024-03-01"}]),
+            lambda: appointments.add_appointment(patient_id, "GP", time.time() + 86400, time.time() + 88200),
+        ]
+        for write in writes:
+            def copy_then_write(source_conn, target_conn, moved_id):
+                version = copy_patient(source_conn, target_conn, moved_id)
+                write()
+                return version
+            with patch.object(sharding, "_copy_patient", copy_then_write):
+                with self.assertRaises(sharding.ShardMoveConflict):
+                    sharding.move_patient(patient_id, (source + 1) % 3)
+            self.assertEqual(self.db.shard_for_patient(patient_id), source)
+        self.assertEqual(len(retrieval.get_patient_documents(patient_id)), 1)
+        self.assertIsNotNone(labs.get_lab_series(patient_id, "hba1c"))
+
+    def test_reminder_delivered_during_move_is_not_resent(self):
+        patient_id = self.db.add_patient("Jane", "10/12/1985", "94538", "Breast cancer")
+        source = self.db.shard_for_patient(patient_id)
+        now = int(time.time())
+        appointments.add_appointment(patient_id, "GP", now + 7200, now + 9000, remind_before_minutes=60)
+        sent = []
+        copy_patient = sharding._copy_patient
+
+        def copy_then_remind(source_conn, target_conn, moved_id):
+            version = copy_patient(source_conn, target_conn, moved_id)
+            # Reminder bookkeeping doesn't bump the version, so the move goes on
+            appointments.ReminderScheduler(deliver=sent.extend).run_due(now + 3600)
+            return version
+        with patch.object(sharding, "_copy_patient", copy_then_remind):
+            sharding.move_patient(patient_id, (source + 1) % 3)
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(appointments.ReminderScheduler(deliver=sent.extend).run_due(now + 3600), 0)
+        self.assertEqual(len(sent), 1)
+
+    def test_child_ids_are_unique_across_shards(self):
+        patient_ids = [self.db.add_patient(f"P{i}", "01/01/1980", "94538", "Flu") for i in range(3)]
+        self.assertEqual(len({self.db.shard_for_patient(patient_id) for patient_id in patient_ids}), 3)
+        interaction_ids = [self.db.add_interaction(patient_id, "base", "hi", "hello", {}, {}) for patient_id in patient_ids]
+        document_ids = [retrieval.index_patient_document(patient_id, f"Note {patient_id}") for patient_id in patient_ids]
+        self.assertEqual(len(set(interaction_ids)), 3)
+        self.assertEqual(len(set(document_ids)), 3)
+
+        # Every shard now holds its patient's rows; moving one in keeps all ids
+        sharding.move_patient(patient_ids[0], self.db.shard_for_patient(patient_ids[1]))
+        self.assertEqual(self.db.get_patient_interactions(patient_ids[0])[0]["id"], interaction_ids[0])
+        self.assertEqual(retrieval.get_patient_documents(patient_ids[0])[0]["id"], document_ids[0])
+
+    def test_stale_shard_cache_follows_moved_patient(self):
+        patient_id = self.db.add_patient("Jane", "10/12/1985", "94538", "Breast cancer")
+        source = self.db.shard_for_patient(patient_id)
+        target = (source + 1) % 3
+        sharding.move_patient(patient_id, target)
+
+        # Another worker still has the old shard cached
+        key = (os.path.abspath(self.db.directory_path()), patient_id)
+        self.db._shard_cache[key] = (source, time.monotonic() + 60)
+        self.assertEqual(self.db.get_patient(patient_id)["name"], "Jane")
+        self.db._shard_cache[key] = (source, time.monotonic() + 60)
+        self.assertTrue(self.db.update_patient_context(patient_id, {"note": "moved"}))
+        self.db._shard_cache[key] = (source, time.monotonic() + 60)
+        self.db.add_interaction(patient_id, "base", "hi", "hello", {}, {})
+
+        with self.db.get_db_connection(source) as conn:
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM interactions").fetchone()[0], 0)
+        self.assertEqual(self.db.get_patient(patient_id)["context"], {"note": "moved"})
+        self.assertEqual(len(self.db.get_patient_interactions(patient_id)), 1)
+
+    def test_rebalance_drains_retired_shards(self):
+        for i in range(6):
+            self.db.add_patient(f"P{i}", "01/01/1980", "94538", "Flu")
+        with patch.object(self.db, "SHARD_COUNT", 2):
+            moves = sharding.rebalance()
+        self.assertEqual(len(moves), 2)
+        self.assertEqual(sharding.shard_sizes(), {0: 3, 1: 3, 2: 0})
+
+
+class TestCaregiverDashboard(TempDatabaseTestCase):
+    """Tests for the caregiver dashboard rollups"""
+
+    def test_rollup_tracks_interactions(self):
+        db = sharding.database
+        caregiver_id = db.add_caregiver("Michael")
+        dad = db.add_patient("Dad", "01/01/1950", "94538", "Stroke", care_gaps="No PT follow-up")
+        aunt = db.add_patient("Aunt", "01/01/1955", "94538", "Diabetes")
+        db.add_patient("Stranger", "01/01/1960", "94538", "Flu")
+        db.link_caregiver_patient(caregiver_id, dad, "son")
+        db.link_caregiver_patient(caregiver_id, aunt, "nephew")
+
+        db.add_interaction(dad, "base", "hi", "## Hello\n<context>{}</context>", {}, {})
+        db.add_interaction(dad, "medication_reminder", "meds?", "Take **aspirin** daily", {}, {
+            "care_gaps": ["Schedule PT", "Lipid panel"],
+            "medications": [{"name": "aspirin"}, {"name": "statin"}],
+        })
+        now = int(time.time())
+        for provider, starts in (("Neurology", now + 2 * 86400), ("PT", now + 3 * 86400), ("GP", now + 4 * 86400)):
+            booked = appointments.add_appointment(dad, provider, starts, starts + 1800)
+        appointments.cancel_appointment(dad, booked["id"])
+
+        dashboard = db.get_caregiver_dashboard(caregiver_id)
+        self.assertEqual([entry["patient_id"] for entry in dashboard], [dad, aunt])
+        self.assertEqual(dashboard[0]["interaction_count"], 2)
+        self.assertEqual(dashboard[0]["prompt_counts"], {"base": 1, "medication_reminder": 1})
+        self.assertEqual(dashboard[0]["last_prompt_type"], "medication_reminder")
+        self.assertEqual(dashboard[0]["last_summary"], "Take aspirin daily")
+        self.assertEqual(dashboard[0]["care_gaps"], ["Schedule PT", "Lipid panel"])
+        self.assertEqual(dashboard[0]["pending_reminders"], 2)
+        self.assertEqual(dashboard[1]["interaction_count"], 0)
+        self.assertEqual(dashboard[1]["relationship"], "nephew")
+
+        # Rebuilding from the interactions gives the same rollups
+        with db.get_db_connection(0) as conn:
+            conn.execute("DELETE FROM patient_rollups")
+            conn.commit()
+        self.assertEqual(db.rebuild_patient_rollups(), 3)
+        self.assertEqual(db.rebuild_patient_rollups(missing_only=True), 0)
+        with db.get_db_connection(0) as conn:
+            conn.execute("DELETE FROM patient_rollups WHERE patient_id = ?", (dad,))
+            conn.commit()
+        self.assertEqual(db.rebuild_patient_rollups(missing_only=True), 1)
+        rebuilt = db.get_caregiver_dashboard(caregiver_id)
+        for key in ("interaction_count", "prompt_counts", "last_prompt_type", "last_summary", "care_gaps",
+                    "pending_reminders"):
+            self.assertEqual(rebuilt[0][key], dashboard[0][key])
+
+
+class TestSerialization(TempDatabaseTestCase):
+    """Tests for the fast JSON layer and passthrough responses"""
+
+    def test_json_object_splices_raw_values(self):
+        body = serialization.json_object({"id": 1, "name": "Zoë"}, raw={"context": '{"a": [1, 2]}', "empty": None})
+        self.assertEqual(json.loads(body), {"id": 1, "name": "Zoë", "context": {"a": [1, 2]}, "empty": None})
+        self.assertEqual(json.loads(serialization.json_object({}, raw={"x": b"[]"})), {"x": []})
+        rows = [{"id": 1, "ctx": '{"b": 2}'}, {"id": 2, "ctx": None}]
+        self.assertEqual(json.loads(serialization.json_rows(rows, ["ctx"])), [{"id": 1, "ctx": {"b": 2}}, {"id": 2, "ctx": None}])
+        # Values orjson refuses fall back to the stdlib encoder
+        self.assertEqual(serialization.loads(serialization.dumps({1: "a"})), {"1": "a"})
+
+    def test_passthrough_matches_validated_response(self):
+        context = {"raw_text": "Progress note. " * 200, "médications": [{"name": "tamoxifen", "dose": None}]}
+        patient_id = database.add_patient("Jane", "10/12/1985", "94538", "Breast cancer", context=context)
+        database.add_interaction(patient_id, "base", "hi", "hello", {"before": 1}, context)
+
+        body = client.get(f"/api/patients/{patient_id}").json()
+        expected = PatientResponse.model_validate(database.get_patient(patient_id)).model_dump(mode="json")
+        self.assertEqual(body, expected)
+
+        interactions = client.get(f"/api/patients/{patient_id}/interactions").json()["interactions"]
+        self.assertEqual(interactions, database.get_patient_interactions(patient_id))
+        self.assertEqual(interactions[0]["context_after"], context)
+
+
+class TestAdmissionControl(unittest.TestCase):
+    """Tests for LLM admission control"""
+
+    def _hold(self, controller, prompt_type, patient_id, release, order=None):
+        """Start a thread that holds a slot until release is set"""
+        def run():
+            try:
+                with controller.admit(prompt_type, patient_id):
+                    if order is not None:
+                        order.append(patient_id)
+                    release.wait(5)
+            except admission.AdmissionRejected:
+                pass
+        thread = threading.Thread(target=run)
+        thread.start()
+        return thread
+
+    def _wait_for(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_critical_work_uses_reserved_slot_and_jumps_queue(self):
+        controller = admission.AdmissionController(concurrency=2, reserved=1, max_wait=5)
+        release, order = threading.Event(), []
+        threads = [self._hold(controller, "find_care_groups", 1, release, order)]
+        self._wait_for(lambda: controller.stats()["running"] == 1)
+        # Bulk work can't take the reserved slot, a symptom check can
+        threads.append(self._hold(controller, "find_care_groups", 2, release, order))
+        self._wait_for(lambda: controller.stats()["priorities"]["bulk"]["queued"] == 1)
+        with controller.admit("symptom_check", 3) as waited:
+            self.assertLess(waited, 1)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, [1, 2])
+        self.assertEqual(controller.stats()["running"], 0)
+
+    def test_sheds_with_retry_after(self):
+        controller = admission.AdmissionController(
+            concurrency=1, reserved=0, per_patient=1, max_wait=0.05, queue_limits={p: 1 for p in admission.PRIORITY_NAMES}
+        )
+        release = threading.Event()
+        holder = self._hold(controller, "base", 1, release)
+        self._wait_for(lambda: controller.stats()["running"] == 1)
+        with self.assertRaises(admission.AdmissionRejected) as per_patient:
+            with controller.admit("base", 1):
+                pass
+        self.assertEqual(per_patient.exception.status_code, 429)
+        self.assertGreaterEqual(per_patient.exception.retry_after, 1)
+
+        queued = self._hold(controller, "base", 2, threading.Event())
+        self._wait_for(lambda: controller.stats()["priorities"]["interactive"]["queued"] == 1)
+        with self.assertRaises(admission.AdmissionRejected) as full:
+            with controller.admit("base", 3):
+                pass
+        self.assertEqual(full.exception.status_code, 503)
+        queued.join()  # times out waiting and is shed
+        release.set()
+        holder.join()
+        self.assertEqual(controller.stats()["priorities"]["interactive"]["rejected"], 3)
+
+    def test_patients_take_turns_within_a_priority(self):
+        controller = admission.AdmissionController(concurrency=1, reserved=0, per_patient=3, max_wait=5)
+        release, done, order = threading.Event(), threading.Event(), []
+        done.set()
+        threads = [self._hold(controller, "base", 0, release)]
+        self._wait_for(lambda: controller.stats()["running"] == 1)
+        for queued, patient_id in enumerate((1, 1, 1, 2), start=1):
+            threads.append(self._hold(controller, "base", patient_id, done, order))
+            self._wait_for(lambda: controller.stats()["priorities"]["interactive"]["queued"] == queued)
+        release.set()
+        for thread in threads:
+            thread.join()
+        # Patient 2 doesn't wait behind all of patient 1's calls
+        self.assertEqual(order, [1, 2, 1, 1])
+
+    def test_async_waiters_hold_no_threads(self):
+        controller = admission.AdmissionController(
+            concurrency=1, reserved=0, max_wait=5, queue_limits={p: 64 for p in admission.PRIORITY_NAMES}
+        )
+        order = []
+
+        def call(patient_id):
+            # The worker thread uses the slot granted on the event loop
+            with controller.admit("base", patient_id):
+                order.append(patient_id)
+                return controller.stats()["running"]
+
+        async def request(prompt_type, patient_id):
+            async with controller.admit_async(prompt_type, patient_id):
+                return await asyncio.to_thread(call, patient_id)
+
+        async def run():
+            release = asyncio.Event()
+
+            async def holder():
+                async with controller.admit_async("base", 0):
+                    await release.wait()
+            hold = asyncio.create_task(holder())
+            await asyncio.sleep(0.01)
+            threads = threading.active_count()
+            bulk = [asyncio.create_task(request("find_care_groups", i)) for i in range(1, 61)]
+            abandoned = asyncio.create_task(request("base", 100))
+            await asyncio.sleep(0.05)
+            critical = asyncio.create_task(request("symptom_check", 99))
+            await asyncio.sleep(0.05)
+            self.assertEqual(controller.stats()["priorities"]["bulk"]["queued"], 60)
+            self.assertEqual(threading.active_count(), threads)
+
+            # A client that goes away gives up its place in line
+            abandoned.cancel()
+            await asyncio.gather(abandoned, return_exceptions=True)
+            self.assertEqual(controller.stats()["priorities"]["interactive"]["queued"], 0)
+
+            release.set()
+            running = await asyncio.gather(critical, *bulk)
+            await hold
+            return running
+
+        running = asyncio.run(run())
+        self.assertEqual(order[0], 99)
+        self.assertEqual(set(running), {1})
+        self.assertEqual(controller.stats()["running"], 0)
+
+    def test_shed_prompts_are_not_swallowed(self):
+        with patch.object(services, "gemini_client"), \
+                patch.object(services.admission, "admit", side_effect=services.AdmissionRejected(503, 7, "busy")), \
+                patch.object(services, "get_patient", return_value={"name": "Jane", "dob": "", "location": "", "diagnosis": "", "context": {}}), \
+                patch.object(services, "retrieve_relevant_chunks", return_value=[]):
+            with self.assertRaises(services.AdmissionRejected):
+                services.process_prompt("base", 1, "hi")
+
+    def test_prompt_route_returns_503_with_retry_after(self):
+        rejected = app_main.AdmissionRejected(503, 7, "Interactive queue is full")
+        with patch.object(app_main, "process_prompt", side_effect=rejected):
+            response = client.post("/api/prompts", json={"prompt_type": "base", "patient_id": 1, "user_input": "hi"})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers["retry-after"], "7")
+        self.assertEqual(response.json(), {"detail": "Interactive queue is full"})
+
+
+class TestLabs(TempDatabaseTestCase):
+    """Tests for the lab time-series store"""
+
+    RECORD = """Lab results
+- HbA1c: 6.1 % (01/05/2024)
+HbA1c 6.4 % 03/01/2024
+Fasting glucose: 92 mg/dL on 03/01/2024
+She had 3 visits in 2023, last on 12/01/2023
+"""
+
+    def test_extract_and_ingest_merges_series(self):
+        patient_id = database.add_patient("Sarah", "01/01/1970", "94538", "Type 2 diabetes")
+        results = labs.extract_lab_results(self.RECORD)
+        self.assertEqual([r["analyte"] for r in results], ["hba1c", "hba1c", "glucose"])
+        self.assertEqual(labs.ingest_lab_results(patient_id, results), {"hba1c": 2, "glucose": 1})
+
+        # A later batch adds readings and replaces the one at the same time
+        counts = labs.ingest_lab_results(patient_id, [
+            {"analyte": "Hemoglobin A1c", "value": 6.2, "taken_at": "2024-01-05"},
+            {"analyte": "a1c", "value": 6.8, "taken_at": "2024-05-01"},
+        ])
+        self.assertEqual(counts, {"hba1c": 3})
+        series = labs.get_lab_series(patient_id, "HbA1c", window_days=90)
+        self.assertEqual([p["value"] for p in series["points"]], [6.2, 6.4, 6.8])
+        self.assertEqual([p["rolling_mean"] for p in series["points"]], [6.2, 6.3, 6.6])
+        self.assertEqual(series["direction"], "rising")
+        self.assertTrue(series["latest_out_of_range"])
+
+        trends = {t["analyte"]: t for t in labs.get_lab_trends(patient_id)}
+        self.assertEqual(trends["glucose"]["out_of_range_count"], 0)
+        self.assertEqual(trends["glucose"]["direction"], "single reading")
+
+    def test_invalid_dates_and_unit_changes_are_rejected(self):
+        self.assertEqual(labs.extract_lab_results("HbA1c: 6.1 % (02/30/2024)\nHbA1c: 6.3 % (2024-13-01)"), [])
+
+        patient_id = database.add_patient("Sarah", "01/01/1970", "94538", "Type 2 diabetes")
+        labs.ingest_lab_results(patient_id, [{"analyte": "glucose", "value": 92, "unit": "mg/dL", "taken_at": "2024-01-05"}])
+        mmol = [{"analyte": "glucose", "value": 5.4, "unit": "mmol/L", "taken_at": "2024-03-01"}]
+        with self.assertRaises(ValueError):
+            labs.ingest_lab_results(patient_id, mmol)
+        with self.assertRaises(ValueError):
+            labs.ingest_lab_results(patient_id, [
+                {"analyte": "hba1c", "value": 6.1, "unit": "%", "taken_at": "2024-01-05"},
+                {"analyte": "hba1c", "value": 43, "unit": "mmol/mol", "taken_at": "2024-03-01"},
+            ])
+        self.assertEqual(labs.ingest_lab_results(patient_id, mmol, skip_mismatched_units=True), {})
+        series = labs.get_lab_series(patient_id, "glucose")
+        self.assertEqual(series["unit"], "mg/dL")
+        self.assertEqual([p["value"] for p in series["points"]], [92.0])
+
+        # Documents with a bad date or unit are indexed without those readings
+        response = client.post(
+            f"/api/patients/{patient_id}/documents",
+            files={"file": ("labs.txt", b"HbA1c: 6.1 % (02/30/2024)\nFasting glucose: 5.1 mmol/L (2024-04-01)\n", "text/plain")}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["labs"], {})
+
+    def test_rolling_mean_matches_loop(self):
+        times = np.cumsum(np.array([0, 5, 40, 100, 3, 200], dtype=np.int64)) * labs.DAY_SECONDS
+        values = np.array([1.0, 2.0, 3.0, 4.0, 5.0, 6.0])
+        expected = [values[(times >= t - 60 * labs.DAY_SECONDS) & (times <= t)].mean() for t in times]
+        np.testing.assert_allclose(labs.rolling_mean(times, values, window_days=60), expected)
+
+    @patch.object(services, "gemini_client")
+    def test_prompt_gets_trend_lines_not_history(self, mock_gemini):
+        patient_id = database.add_patient("Sarah", "01/01/1970", "94538", "Type 2 diabetes")
+        labs.ingest_lab_results(patient_id, [
+            {"analyte": "glucose", "value": 100 + i, "taken_at": f"2024-01-{i + 1:02d}"} for i in range(28)
+        ])
+        mock_response = MagicMock()
+        mock_response.text = json.dumps({"display_markdown": "ok", "context_patch": {}})
+        mock_gemini.models.generate_content.return_value = mock_response
+
+        _, context = services.process_prompt("base", patient_id, "How is my sugar?")
+        prompt = mock_gemini.models.generate_content.call_args.kwargs["contents"]
+        self.assertIn("Fasting glucose 127 mg/dL on 2024-01-28", prompt)
+        self.assertNotIn("2024-01-02", prompt)
+        self.assertNotIn("lab_trends", context)
+
+class TestAppointments(TempDatabaseTestCase):
+    """Tests for the appointment calendar and reminder scheduler"""
+
+    HOUR = 3600
+
+    def setUp(self):
+        super().setUp()
+        self.now = int(time.time())
+        self.patient_id = database.add_patient("Sarah", "01/01/1970", "94538", "Type 2 diabetes")
+        self.other_id = database.add_patient("Tom", "01/01/1950", "94538", "CHF")
+
+    def book(self, patient_id, provider, start_hours, length_hours=1, **kwargs):
+        starts = self.now + int(start_hours * self.HOUR)
+        return appointments.add_appointment(patient_id, provider, starts, starts + int(length_hours * self.HOUR), **kwargs)
+
+    def test_range_query_and_conflicts(self):
+        heart = self.book(self.patient_id, "Cardiology", 2)
+        kidney = self.book(self.patient_id, "Nephrology", 2.5)
+        self.book(self.patient_id, "Eye clinic", 24 * 10)
+        eye = self.book(self.other_id, "Eye clinic", 2.75)
+
+        week = appointments.get_appointments([self.patient_id, self.other_id], self.now, self.now + 7 * 24 * self.HOUR)
+        self.assertEqual([a["provider"] for a in week], ["Cardiology", "Nephrology", "Eye clinic"])
+        # A long appointment that started before the window still overlaps it
+        inside = appointments.get_appointments([self.patient_id], self.now + int(2.9 * self.HOUR), self.now + 3 * self.HOUR)
+        self.assertEqual([a["id"] for a in inside], [heart["id"], kidney["id"]])
+
+        conflicts = appointments.check_appointment_conflicts(kidney)
+        self.assertEqual(len(conflicts), 1)
+        self.assertEqual(conflicts[0]["kind"], "patient_double_booked")
+        self.assertEqual(conflicts[0]["overlap_minutes"], 30)
+
+        kinds = sorted(c["kind"] for c in appointments.find_conflicts(week, across_patients=True))
+        self.assertEqual(kinds, ["caregiver_overlap", "caregiver_overlap", "patient_double_booked"])
+
+        self.assertTrue(appointments.cancel_appointment(self.patient_id, heart["id"]))
+        self.assertEqual(appointments.check_appointment_conflicts(kidney), [])
+        self.assertFalse(appointments.cancel_appointment(self.other_id, heart["id"]))
+
+    def test_scheduler_sends_each_due_reminder_once(self):
+        soon = self.book(self.patient_id, "Cardiology", 3, remind_before_minutes=120)
+        self.book(self.other_id, "Eye clinic", 4, remind_before_minutes=60)
+        later = self.book(self.patient_id, "Nephrology", 24 * 5)
+
+        sent = []
+        scheduler = appointments.ReminderScheduler(deliver=sent.extend, horizon=3 * self.HOUR)
+        # Only reminders inside the horizon are held in memory
+        self.assertEqual(scheduler.refill(self.now), 2)
+        self.assertEqual(scheduler.next_due(), self.now + self.HOUR)
+        self.assertEqual(scheduler.run_due(self.now), 0)
+
+        other = appointments.ReminderScheduler(deliver=sent.extend, horizon=3 * self.HOUR)
+        other.refill(self.now)
+        self.assertEqual(scheduler.run_due(self.now + 3 * self.HOUR), 2)
+        self.assertEqual(other.run_due(self.now + 3 * self.HOUR), 0)
+        self.assertEqual(sorted(r["provider"] for r in sent), ["Cardiology", "Eye clinic"])
+        # reminded_at is only recorded once delivery succeeded
+        self.assertIsNone(sent[0]["reminded_at"])
+        delivered = appointments.get_appointments([self.patient_id], self.now, self.now + 4 * self.HOUR)
+        self.assertEqual(delivered[0]["reminded_at"], appointments._iso(self.now + 3 * self.HOUR))
+
+        # Rescheduling re-arms the reminder; the stale heap entry is ignored
+        moved = appointments.reschedule_appointment(
+            self.patient_id, later["id"], self.now + 6 * self.HOUR, self.now + 7 * self.HOUR, remind_before_minutes=60
+        )
+        self.assertEqual(moved["remind_at"], appointments._iso(self.now + 5 * self.HOUR))
+        self.assertEqual(scheduler.run_due(self.now + 5 * self.HOUR), 1)
+        self.assertEqual(sent[-1]["id"], later["id"])
+        self.assertIsNone(appointments.reschedule_appointment(self.other_id, soon["id"], self.now, self.now + 60))
+
+    def test_failed_delivery_is_retried(self):
+        self.book(self.patient_id, "Cardiology", 2, remind_before_minutes=60)
+        due = self.now + self.HOUR
+        scheduler = appointments.ReminderScheduler(
+            deliver=MagicMock(side_effect=RuntimeError("smtp down")), retry_seconds=30
+        )
+        self.assertEqual(scheduler.run_due(due), 0)
+        # Failed reminders go back on the heap with exponential backoff
+        self.assertEqual(scheduler.next_due(), due + 30)
+        self.assertEqual(scheduler.run_due(due + 30), 0)
+        self.assertEqual(scheduler.next_due(), due + 90)
+
+        sent = []
+        scheduler.deliver = sent.extend
+        self.assertEqual(scheduler.run_due(due + 60), 0)
+        self.assertEqual(scheduler.run_due(due + 90), 1)
+        self.assertEqual(scheduler.run_due(due + 3 * self.HOUR), 0)
+        self.assertEqual(len(sent), 1)
+
+    def test_claimed_but_undelivered_reminder_is_resent_after_restart(self):
+        self.book(self.patient_id, "Cardiology", 2, remind_before_minutes=60)
+        due = self.now + self.HOUR
+        crashed = appointments.ReminderScheduler(claim_timeout=300)
+        crashed.refill(due)
+        # The worker dies after claiming, before delivering
+        entries = crashed._pop_due(due)
+        self.assertEqual(len(crashed._claim(database.shard_for_patient(self.patient_id), entries, due)), 1)
+
+        sent = []
+        restarted = appointments.ReminderScheduler(deliver=sent.extend, claim_timeout=300)
+        restarted.refill(due)
+        self.assertEqual(restarted.next_due(), due + 300)
+        self.assertEqual(restarted.run_due(due + 299), 0)
+        self.assertEqual(restarted.run_due(due + 300), 1)
+        self.assertEqual(restarted.run_due(due + 900), 0)
+        self.assertEqual(len(sent), 1)
+
+    def test_reminder_bookkeeping_keeps_the_patient_version(self):
+        appointment = self.book(self.patient_id, "Cardiology", 2, remind_before_minutes=60)
+        version = database.get_patient_version(self.patient_id)["version"]
+        scheduler = appointments.ReminderScheduler(deliver=lambda reminders: None)
+        self.assertEqual(scheduler.run_due(self.now + self.HOUR), 1)
+        # Claiming and delivering don't invalidate the patient's ETag
+        self.assertEqual(database.get_patient_version(self.patient_id)["version"], version)
+
+        appointments.reschedule_appointment(
+            self.patient_id, appointment["id"], self.now + 3 * self.HOUR, self.now + 4 * self.HOUR
+        )
+        self.assertGreater(database.get_patient_version(self.patient_id)["version"], version)
+        version = database.get_patient_version(self.patient_id)["version"]
+        appointments.cancel_appointment(self.patient_id, appointment["id"])
+        self.assertGreater(database.get_patient_version(self.patient_id)["version"], version)
+
+    def test_only_one_scheduler_sends(self):
+        first = appointments.ReminderScheduler()
+        second = appointments.ReminderScheduler()
+        self.assertTrue(first._acquire_sender_lock())
+        with patch.object(appointments, "REMINDER_LOCK_RETRY_SECONDS", 0.05):
+            threading.Timer(0.2, second._stop.set).start()
+            # Waits while the first holds the lock, and gives up once stopped
+            self.assertFalse(second._acquire_sender_lock())
+            first.stop()
+            second._stop.clear()
+            self.assertTrue(second._acquire_sender_lock())
+        second.stop()
+
+    def test_appointment_endpoints(self):
+        caregiver_id = database.add_caregiver("Ana")
+        database.link_caregiver_patient(caregiver_id, self.patient_id)
+        database.link_caregiver_patient(caregiver_id, self.other_id)
+        starts = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(self.now + 2 * self.HOUR))
+
+        response = client.post(
+            f"/api/patients/{self.patient_id}/appointments",
+            json={"provider": "Cardiology", "starts_at": starts, "duration_minutes": 60}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["conflicts"], [])
+        response = client.post(
+            f"/api/patients/{self.other_id}/appointments",
+            json={"provider": "Eye clinic", "starts_at": starts, "purpose": "Retinal exam"}
+        )
+        self.assertEqual(response.json()["appointment"]["ends_at"][11:16],
+                         time.strftime("%H:%M", time.gmtime(self.now + 2 * self.HOUR + 1800)))
+
+        calendar = client.get(f"/api/caregivers/{caregiver_id}/appointments?days=1").json()
+        self.assertEqual(len(calendar["appointments"]), 2)
+        self.assertEqual([c["kind"] for c in calendar["conflicts"]], ["caregiver_overlap"])
+
+        appointment_id = response.json()["appointment"]["id"]
+        self.assertEqual(client.delete(f"/api/patients/{self.other_id}/appointments/{appointment_id}").status_code, 200)
+        listed = client.get(f"/api/patients/{self.other_id}/appointments").json()["appointments"]
+        self.assertEqual(listed, [])
+
+class TestExport(TempDatabaseTestCase):
+    """Tests for the streaming bulk export"""
+
+    def setUp(self):
+        super().setUp()
+        self.db = sharding.database
+        patcher = patch.object(self.db, "SHARD_COUNT", 2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.db.init_db()
+        self.patient_ids = [
+            self.db.add_patient(f"Patient {i}", "03/04/1950", "94538", "CHF", None, {"weights": [180 + i]})
+            for i in range(5)
+        ]
+        for patient_id in self.patient_ids:
+            for turn in range(3):
+                self.db.add_interaction(patient_id, "base", f"Question {turn}", "Answer " * 80,
+                                        {"turn": turn}, {"turn": turn + 1})
+
+    def set_timestamps(self, patient_id, timestamp):
+        with self.db.get_patient_connection(patient_id) as conn:
+            # Interaction writes touch the patient, so its timestamp is set last
+            conn.execute('UPDATE interactions SET created_at = ? WHERE patient_id = ?', (timestamp, patient_id))
+            conn.execute('UPDATE patients SET updated_at = ? WHERE id = ?', (timestamp, patient_id))
+            conn.commit()
+
+    def read_ndjson(self, **kwargs):
+        return [json.loads(line) for line in b"".join(export.export_stream(**kwargs)).splitlines()]
+
+    def test_full_export_in_batches_with_archived_rows(self):
+        self.set_timestamps(self.patient_ids[0], "2020-01-01 00:00:00")
+        self.assertEqual(flat_archive.archive_old_interactions(retention_days=180)["archived"], 3)
+
+        counts = {}
+        data = b"".join(export.export_stream(compression="gzip", batch_size=2, counts=counts))
+        records = [json.loads(line) for line in gzip.decompress(data).splitlines()]
+        self.assertEqual(counts, {"patients": 5, "interactions": 15})
+        patients = {r["id"]: r for r in records if r["type"] == "patient"}
+        self.assertEqual(sorted(patients), sorted(self.patient_ids))
+        self.assertEqual(patients[self.patient_ids[2]]["context"], {"weights": [182]})
+
+        archived = [r for r in records if r["type"] == "interaction" and r["patient_id"] == self.patient_ids[0]]
+        self.assertEqual(len(archived), 3)
+        self.assertTrue(all(r["response"] == "Answer " * 80 for r in archived))
+        self.assertEqual(sorted(r["context_after"]["turn"] for r in archived), [1, 2, 3])
+
+    def test_incremental_export_since_watermark(self):
+        for patient_id in self.patient_ids:
+            self.set_timestamps(patient_id, "2024-01-01 00:00:00")
+        self.set_timestamps(self.patient_ids[3], "2024-02-01 12:00:00")
+
+        records = self.read_ndjson(since="2024-01-15T00:00:00")
+        self.assertEqual({r["type"] for r in records}, {"patient", "interaction"})
+        self.assertEqual({r.get("patient_id", r["id"]) for r in records}, {self.patient_ids[3]})
+        self.assertEqual(len(records), 4)
+        self.assertEqual(self.read_ndjson(since="2030-01-01"), [])
+
+    def test_export_endpoint_streams_fhir(self):
+        self.assertEqual(client.get("/api/export").status_code, 404)
+        auth = {"Authorization": "Bearer s3cret"}
+        with patch.object(app_main, "EXPORT_API_TOKEN", "s3cret"):
+            self.assertEqual(client.get("/api/export").status_code, 401)
+            self.assertEqual(client.get("/api/export", headers={"Authorization": "Bearer guess"}).status_code, 401)
+            response = client.get("/api/export?format=fhir&compress=gzip", headers=auth)
+            self.assertEqual(client.get("/api/export?format=csv", headers=auth).status_code, 400)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("content-encoding", response.headers)
+        self.assertEqual(response.headers["content-type"], "application/gzip")
+        self.assertIn('filename="carebears-export.fhir.ndjson.gz"', response.headers["content-disposition"])
+        self.assertIn("x-export-watermark", response.headers)
+        bundles = [json.loads(line) for line in gzip.decompress(response.content).splitlines()]
+        resources = [entry["resource"] for bundle in bundles for entry in bundle["entry"]]
+        by_type = {}
+        for resource in resources:
+            by_type.setdefault(resource["resourceType"], []).append(resource)
+        self.assertEqual(len(by_type["Patient"]), 5)
+        self.assertEqual(by_type["Patient"][0]["birthDate"], "1950-03-04")
+        self.assertEqual(len(by_type["Communication"]), 15)
+
+class TestTelemetry(unittest.TestCase):
+    """Tests for trace sampling and queued logging"""
+
+    def test_tail_sampling_keeps_errors_and_slow_traces(self):
+        exporter = InMemorySpanExporter()
+        with patch.object(telemetry, "SAMPLE_RATE", 0.0), patch.object(telemetry, "SLOW_SECONDS", 0.05):
+            sampling = telemetry.sampling_options("sampled")
+        local = logfire.configure(
+            local=True, send_to_logfire=False, console=False, metrics=False, inspect_arguments=False,
+            sampling=sampling, additional_span_processors=[SimpleSpanProcessor(exporter)]
+        )
+        with local.span("fast"):
+            local.info("fine")
+        with local.span("warned"):
+            local.warn("schema validation failed")
+        with local.span("slow"):
+            time.sleep(0.06)
+        with self.assertRaises(ValueError):
+            with local.span("failed"):
+                raise ValueError("boom")
+        roots = {span.name for span in exporter.get_finished_spans() if span.parent is None}
+        self.assertEqual(roots, {"warned", "slow", "failed"})
+        self.assertIsNone(telemetry.sampling_options("full"))
+
+    def test_full_log_queue_drops_instead_of_blocking(self):
+        handler = telemetry.DroppingQueueHandler(queue.Queue(2))
+        log = logging.getLogger("carebears.test.telemetry")
+        log.propagate = False
+        log.addHandler(handler)
+        self.addCleanup(log.removeHandler, handler)
+        for i in range(5):
+            log.warning("record %d", i)
+        self.assertEqual(handler.queue.qsize(), 2)
+        self.assertEqual(handler.dropped, 3)
+
+    def test_logging_is_written_by_background_listener(self):
+        output = io.StringIO()
+        telemetry.configure_logging(stream=output)
+        self.addCleanup(telemetry.configure_logging)
+        logging.getLogger("carebears.test").info("queued %s", "record")
+        telemetry.stop_logging()
+        self.assertIn("carebears.test - INFO - queued record", output.getvalue())
+        self.assertEqual(client.get("/api/metrics/telemetry").json()["log_queue"]["dropped"], 0)
+
 if __name__ == "__main__":
-    unittest.main()
\ No newline at end of file
+    unittest.main()
@@ -1 +1,5 @@
 0 12 * * * docker-compose exec certbot certbot renew --quiet && docker-compose restart nginx
+
+30 3 * * * docker-compose exec -T app python manage.py archive-interactions
+
+0 2 * * * docker-compose exec -T app sh -c 'python manage.py export "data/exports/carebears-$(date +\%F).ndjson.gz" --state-file data/exports/watermark'